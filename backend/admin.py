@@ -0,0 +1,67 @@
+"""
+Operator endpoints under /api/admin.
+
+Every route requires `X-Admin-Key: $ADMIN_API_KEY`; with no ADMIN_API_KEY
+configured the admin API is disabled (403).
+"""
+import hmac
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
+
+from profiler import ProfilerBusyError, profile
+from settings import get_settings, reload_settings
+
+
+async def require_admin(request: Request):
+    admin_key = get_settings().admin_api_key
+    if not admin_key:
+        raise HTTPException(status_code=403, detail="Admin API is disabled")
+    provided = request.headers.get("X-Admin-Key", "")
+    if not hmac.compare_digest(provided.encode("utf-8"), admin_key.encode("utf-8")):
+        raise HTTPException(status_code=401, detail="Invalid or missing admin key")
+
+
+router = APIRouter(prefix="/api/admin", tags=["Admin"], dependencies=[Depends(require_admin)])
+
+
+@router.post("/settings/reload")
+async def reload_settings_endpoint():
+    """Re-reads .env and rebuilds settings (same as SIGHUP)."""
+    changed = reload_settings(dotenv=True)
+    return {"status": "reloaded", "changed": list(changed)}
+
+
+@router.get("/profile")
+async def profile_endpoint(
+    seconds: float = Query(10.0, gt=0),
+    interval_ms: float = Query(5.0, ge=1, le=1000),
+    mode: Optional[str] = Query(None, pattern="^(cpu|wall)$"),
+    idle: bool = False,
+):
+    """Samples the live process for `seconds`; returns collapsed stacks for flamegraph tools.
+
+    `mode`: cpu (event loop CPU time, the default where available) or wall (all threads).
+    """
+    settings = get_settings()
+    if not settings.profiler_enabled:
+        raise HTTPException(status_code=404, detail="Profiler is disabled")
+    if seconds > settings.profiler_max_seconds:
+        raise HTTPException(status_code=400, detail=f"seconds must be at most {settings.profiler_max_seconds:g}")
+    try:
+        sampler = await profile(seconds, interval_ms / 1000.0, include_idle=idle, mode=mode)
+    except ProfilerBusyError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    filename = time.strftime("profile-%Y%m%d-%H%M%S.folded", time.gmtime())
+    return PlainTextResponse(
+        sampler.collapsed(),
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Profile-Mode": sampler.mode,
+            "X-Profile-Samples": str(sampler.samples),
+        },
+    )
@@ -0,0 +1,138 @@
+"""
+Gemini model registry for the AI proxy.
+
+Knows which models to call and how fast they have been recently:
+- the primary model (GEMINI_MODEL) serves normal requests;
+- small prompts (<= AI_SMALL_PROMPT_TOKENS) go to GEMINI_SMALL_PROMPT_MODEL
+  when one is configured;
+- GEMINI_FALLBACK_MODEL, when set, is the hedge target: if the chosen model
+  has not answered after its recent p95 latency (or fails), the proxy sends
+  the same request to the fallback and takes whichever answers first.
+
+GEMINI_API_BASE_URL points the proxy at another upstream (e.g. a local mock).
+"""
+import math
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional, Tuple
+
+from settings import get_settings
+
+DEFAULT_GEMINI_API_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+DEFAULT_GEMINI_MODEL = "gemini-3-flash-preview"
+
+# Latencies kept per model, and how many are needed before p95 is trusted.
+_WINDOW = 200
+_MIN_SAMPLES = 20
+
+
+class ModelStats:
+    """Sliding window of successful call latencies plus call/error counters."""
+
+    def __init__(self, window: int = _WINDOW):
+        self.latencies: Deque[float] = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, seconds: float, ok: bool):
+        self.calls += 1
+        if ok:
+            self.latencies.append(seconds)
+        else:
+            self.errors += 1
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+        return ordered[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        p50 = self.percentile(50)
+        p95 = self.percentile(95)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+        }
+
+
+class ModelRegistry:
+    def __init__(
+        self,
+        base_url: str = DEFAULT_GEMINI_API_BASE_URL,
+        primary: str = DEFAULT_GEMINI_MODEL,
+        fallback: Optional[str] = None,
+        small_prompt_model: Optional[str] = None,
+        small_prompt_tokens: int = 400,
+        hedge_delay_ms: int = 2000,
+        hedge_min_delay_ms: int = 200,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.primary = primary
+        self.fallback = fallback or None
+        self.small_prompt_model = small_prompt_model or None
+        self.small_prompt_tokens = small_prompt_tokens
+        self._hedge_delay = hedge_delay_ms / 1000.0
+        self._hedge_min_delay = hedge_min_delay_ms / 1000.0
+        self._stats: Dict[str, ModelStats] = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def url_for(self, model: str) -> str:
+        return f"{self.base_url}/models/{model}:generateContent"
+
+    def stats_for(self, model: str) -> ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = ModelStats()
+        return stats
+
+    def record(self, model: str, started_at: float, ok: bool):
+        self.stats_for(model).record(time.monotonic() - started_at, ok)
+
+    def route(self, estimated_tokens: int) -> Tuple[str, Optional[str]]:
+        """Returns (model, hedge model or None) for a prompt of this size."""
+        model = self.primary
+        if self.small_prompt_model and estimated_tokens <= self.small_prompt_tokens:
+            model = self.small_prompt_model
+        hedge = self.fallback if self.fallback and self.fallback != model else None
+        return model, hedge
+
+    def hedge_delay(self, model: str) -> float:
+        """Seconds to wait for `model` before hedging: its recent p95, else the configured default."""
+        stats = self.stats_for(model)
+        if len(stats.latencies) < _MIN_SAMPLES:
+            return self._hedge_delay
+        return max(self._hedge_min_delay, stats.percentile(95))
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "primary": self.primary,
+            "fallback": self.fallback,
+            "small_prompt_model": self.small_prompt_model,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "models": {name: stats.snapshot() for name, stats in self._stats.items()},
+        }
+
+
+_REGISTRY: Optional[ModelRegistry] = None
+
+
+def get_model_registry() -> ModelRegistry:
+    global _REGISTRY
+    if _REGISTRY is None:
+        settings = get_settings()
+        _REGISTRY = ModelRegistry(
+            base_url=settings.gemini_api_base_url or DEFAULT_GEMINI_API_BASE_URL,
+            primary=settings.gemini_model or DEFAULT_GEMINI_MODEL,
+            fallback=settings.gemini_fallback_model,
+            small_prompt_model=settings.gemini_small_prompt_model,
+            small_prompt_tokens=settings.ai_small_prompt_tokens,
+            hedge_delay_ms=settings.ai_hedge_delay_ms,
+            hedge_min_delay_ms=settings.ai_hedge_min_delay_ms,
+        )
+    return _REGISTRY
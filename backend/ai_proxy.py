@@ -1,16 +1,34 @@
-import os
 import json
+import time
+import asyncio
+import logging
 import httpx
-from fastapi import APIRouter, HTTPException, Request
+from fastapi import APIRouter, Depends, HTTPException, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from typing import Optional
-from memory_service import retrieve_user_context, memorize_user_action
-from rate_limiter import get_rate_limiter
-from supabase_auth import get_supabase_user_id_from_request, is_supabase_auth_required_for_ai
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+from ai_models import get_model_registry
+from metrics import RATE_LIMIT_DENIALS, upstream_error
+from memory_service import retrieve_user_memories, memorize_user_action, get_context_cache_stats, get_memu_client
+from prompt_builder import BuiltPrompt, build_prompt, estimate_request_tokens, estimate_tokens
+from rate_limiter import client_key, enforce_quota, get_policy, get_rate_limiter, quota_key
+from settings import get_settings
+from supabase_auth import get_supabase_user_id_from_request, is_supabase_auth_required_for_ai, optional_supabase_user
+from tracing import span
+from upstream_limiter import PRIORITY_BATCH, PRIORITY_INTERACTIVE, UpstreamBusyError, get_upstream_limiter
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/ai", tags=["AI"])
 
-GEMINI_API_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-3-flash-preview:generateContent"
+# Gemini statuses that mean "too much load", not "bad request".
+_UPSTREAM_OVERLOAD_STATUSES = (429, 503)
+# Honour an upstream Retry-After for the single retry only when it is this short.
+_UPSTREAM_MAX_RETRY_WAIT_SECONDS = 2.0
+
+# Pooled Gemini clients by API base URL; calls reuse connections instead of a
+# new TCP + TLS handshake each. Closed by close_gemini_clients() on shutdown.
+_GEMINI_CLIENTS: Dict[str, httpx.AsyncClient] = {}
 
 
 class AIRequest(BaseModel):
@@ -22,105 +40,526 @@ class AIRequest(BaseModel):
     max_tokens: int = 2048
 
 
+def _get_memu_budget_seconds() -> float:
+    # Latency budget for memU retrieval; after it the prompt goes out without memory.
+    return get_settings().memu_retrieve_budget_seconds
+
+
+class _MemoryLookup:
+    """memU retrieval running in the background while auth/rate limiting proceed."""
+
+    def __init__(self, user_id: str, prompt: str):
+        self.user_id = user_id
+        self.started_at = time.monotonic()
+        self.task = asyncio.create_task(retrieve_user_memories(user_id, prompt))
+
+    def cancel(self):
+        if not self.task.done():
+            self.task.cancel()
+
+    async def result(self) -> Optional[List[str]]:
+        remaining = _get_memu_budget_seconds() - (time.monotonic() - self.started_at)
+        try:
+            return await asyncio.wait_for(self.task, timeout=max(0.0, remaining))
+        except asyncio.TimeoutError:
+            logger.info("memU retrieval exceeded latency budget; continuing without memory context.")
+        except Exception:
+            logger.warning("memU retrieval failed (non-critical).", exc_info=True)
+        return None
+
+
+class _TokenReservation:
+    """AI token quota reserved up front (estimate) and settled with real usage."""
+
+    def __init__(self, key: str, amount: int):
+        self.key = key
+        self.amount = amount
+        self._settled = False
+
+    async def settle(self, actual: int):
+        if self._settled:
+            return
+        self._settled = True
+        delta = max(0, actual) - self.amount
+        if delta:
+            limiter = get_rate_limiter()
+            await limiter.adjust("ai_tokens", self.key, delta)
+            await limiter.adjust("ai_tokens_global", "global", delta)
+
+
+async def _reserve_ai_tokens(key: str, estimate: int) -> _TokenReservation:
+    user_policy = get_policy("ai_tokens")
+    global_policy = get_policy("ai_tokens_global")
+    # A single request can never reserve more than a full minute bucket.
+    amount = max(1, min(estimate, user_policy.per_minute, global_policy.per_minute))
+    decisions = await get_rate_limiter().consume_all([
+        ("ai_tokens", key, amount),
+        ("ai_tokens_global", "global", amount),
+    ])
+    denied = [d for d in decisions if not d.allowed]
+    for policy_name, decision in zip(("ai_tokens", "ai_tokens_global"), decisions):
+        if not decision.allowed:
+            RATE_LIMIT_DENIALS.inc(policy_name)
+    if denied:
+        raise HTTPException(
+            status_code=429,
+            detail="AI token budget exceeded. Please try again shortly.",
+            headers={"Retry-After": str(max(d.retry_after_seconds for d in denied))},
+        )
+    return _TokenReservation(key, amount)
+
+
+def _usage_tokens(usage: Dict[str, Any]) -> Optional[int]:
+    total = usage.get("totalTokenCount")
+    if isinstance(total, int):
+        return total
+    parts = [usage.get("promptTokenCount"), usage.get("candidatesTokenCount")]
+    if any(isinstance(p, int) for p in parts):
+        return sum(p for p in parts if isinstance(p, int))
+    return None
+
+
 @router.get("/status")
-async def ai_status(request: Request):
+async def ai_status(request: Request, user_id: Optional[str] = Depends(optional_supabase_user)):
     """Lightweight status for frontend gating (safe to expose)."""
-    gemini_configured = bool(os.getenv("GEMINI_API_KEY", "").strip())
+    gemini_configured = bool(get_settings().gemini_api_key)
     memu_reachable = bool(getattr(request.app.state, "memu_available", False))
     require_auth = is_supabase_auth_required_for_ai()
 
     # Report configured limits for UX messaging (not security-critical).
-    try:
-        per_minute = int(os.getenv("AI_RATE_LIMIT_PER_MINUTE", "30") or 30)
-    except (TypeError, ValueError):
-        per_minute = 30
-    try:
-        per_hour = int(os.getenv("AI_RATE_LIMIT_PER_HOUR", "300") or 300)
-    except (TypeError, ValueError):
-        per_hour = 300
+    ai_policy = get_policy("ai")
+    token_policy = get_policy("ai_tokens")
+    global_token_policy = get_policy("ai_tokens_global")
+
+    limiter = get_rate_limiter()
+    token_remaining = await limiter.remaining("ai_tokens", user_id or client_key(request.scope))
+    global_token_remaining = await limiter.remaining("ai_tokens_global", "global")
 
     return {
         "ai_proxy_reachable": True,
         "gemini_configured": gemini_configured,
         "memu_reachable": memu_reachable,
+        "memu_circuit": get_memu_client().breaker.state,
         "require_supabase_auth_for_ai": require_auth,
         "rate_limits": {
-            "per_minute": per_minute,
-            "per_hour": per_hour,
+            "per_minute": ai_policy.per_minute,
+            "per_hour": ai_policy.per_hour,
         },
+        "token_budget": {
+            "per_minute": token_policy.per_minute,
+            "per_hour": token_policy.per_hour,
+            "remaining": token_remaining,
+            "global_per_minute": global_token_policy.per_minute,
+            "global_per_hour": global_token_policy.per_hour,
+            "global_remaining": global_token_remaining,
+        },
+        "upstream": get_upstream_limiter().stats(),
+        "models": get_model_registry().snapshot(),
+        "memu_context_cache": get_context_cache_stats(),
     }
 
 
-@router.post("/ask")
-async def ask_ai(req: AIRequest, request: Request):
-    api_key = os.getenv("GEMINI_API_KEY", "")
+async def _authorize_ai_request(
+    request: Request,
+    claimed_user_id: Optional[str],
+    memory_query: str,
+    cost: int,
+    token_estimate: int,
+) -> Tuple[Optional[str], Optional[_MemoryLookup], _TokenReservation]:
+    """Verifies the caller, charges the rate limiter and starts the memU lookup.
+
+    Returns (effective_user_id, lookup, reservation). The lookup overlaps with
+    auth and rate limiting and is cancelled if either rejects the request. The
+    reservation holds `token_estimate` AI tokens until it is settled.
+    """
+    require_auth = is_supabase_auth_required_for_ai()
+
+    # Without a bearer token the effective user can only be `claimed_user_id`, so
+    # the memU lookup can start speculatively and overlap with auth + rate limiting.
+    lookup: Optional[_MemoryLookup] = None
+    if claimed_user_id and not require_auth and not request.headers.get("Authorization"):
+        lookup = _MemoryLookup(claimed_user_id, memory_query)
+
+    try:
+        with span("ai.auth"):
+            user_id_from_token = await get_supabase_user_id_from_request(request, required=require_auth)
+        effective_user_id = user_id_from_token or claimed_user_id
+        if lookup is not None and lookup.user_id != effective_user_id:
+            lookup.cancel()
+            lookup = None
+        if lookup is None and effective_user_id:
+            lookup = _MemoryLookup(effective_user_id, memory_query)
+
+        # Rate limiting: per verified user (auth above put it on request.state), else by IP.
+        with span("ai.rate_limit"):
+            await enforce_quota("ai", quota_key("ai", request.scope), cost=cost)
+            reservation = await _reserve_ai_tokens(quota_key("ai_tokens", request.scope), token_estimate)
+    except BaseException:
+        if lookup is not None:
+            lookup.cancel()
+        raise
+
+    return effective_user_id, lookup, reservation
+
+
+def _get_gemini_api_key() -> str:
+    api_key = get_settings().gemini_api_key
     if not api_key:
         raise HTTPException(status_code=500, detail="Gemini API key not configured on server")
+    return api_key
 
-    require_auth = is_supabase_auth_required_for_ai()
-    user_id_from_token = await get_supabase_user_id_from_request(request, required=require_auth)
 
-    # Rate limiting: per user (preferred), else by IP.
-    limiter = get_rate_limiter()
-    limiter_key = user_id_from_token or (request.client.host if request.client else "unknown")
-    decision = await limiter.consume_ai(limiter_key, cost=1)
-    if not decision.allowed:
-        raise HTTPException(
-            status_code=429,
-            detail="Rate limit exceeded. Please try again shortly.",
-            headers={"Retry-After": str(decision.retry_after_seconds)},
-        )
+def _upstream_retry_after(response) -> float:
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", "1")))
+    except (TypeError, ValueError):
+        return 1.0
 
-    text_parts = ""
-    if req.system_prompt:
-        text_parts += req.system_prompt + "\n\n"
 
-    # memU: Inject personalized context from memory
-    effective_user_id = user_id_from_token or req.user_id
-    if effective_user_id:
-        memory_context = await retrieve_user_context(effective_user_id, req.prompt)
-        if memory_context:
-            text_parts += f"User memory (past patterns & preferences):\n{memory_context}\n\n"
+class Generation(NamedTuple):
+    text: str
+    usage_tokens: int
+    model: str
+
+
+def _generation_meta(built: BuiltPrompt, generation: Generation) -> Dict[str, Any]:
+    return {
+        "prompt": built.metadata(),
+        "model": generation.model,
+        "usage_tokens": generation.usage_tokens,
+    }
+
+
+def _gemini_client(base_url: str) -> httpx.AsyncClient:
+    client = _GEMINI_CLIENTS.get(base_url)
+    if client is None:
+        client = _GEMINI_CLIENTS[base_url] = httpx.AsyncClient(timeout=30.0)
+    return client
+
+
+async def close_gemini_clients():
+    clients = list(_GEMINI_CLIENTS.values())
+    _GEMINI_CLIENTS.clear()
+    for client in clients:
+        await client.aclose()
+
+
+async def _post_model(model: str, api_key: str, payload: Dict[str, Any], priority: int) -> httpx.Response:
+    """One Gemini call inside an upstream slot; feeds latency to the registry and the limiter."""
+    registry = get_model_registry()
+    limiter = get_upstream_limiter()
+    async with limiter.slot(priority):
+        started_at = time.monotonic()
+        try:
+            with span("gemini.call", model=model):
+                response = await _gemini_client(registry.base_url).post(
+                    registry.url_for(model),
+                    params={"key": api_key},
+                    json=payload,
+                )
+        except httpx.TimeoutException:
+            limiter.on_overload()
+            registry.record(model, started_at, ok=False)
+            upstream_error("gemini", "timeout")
+            raise
+        except asyncio.CancelledError:
+            # Lost a hedge race or the client went away; not an upstream failure.
+            raise
+        except Exception:
+            registry.record(model, started_at, ok=False)
+            upstream_error("gemini", "error")
+            raise
+
+    registry.record(model, started_at, ok=response.status_code == 200)
+    if response.status_code != 200:
+        upstream_error("gemini", str(response.status_code))
+    if response.status_code in _UPSTREAM_OVERLOAD_STATUSES:
+        limiter.on_overload()
+    elif response.status_code == 200:
+        limiter.on_success()
+    return response
+
+
+def _answered(task: "asyncio.Task") -> bool:
+    return (
+        task.done()
+        and not task.cancelled()
+        and task.exception() is None
+        and task.result().status_code == 200
+    )
 
-    if req.context:
-        text_parts += f"Context: {json.dumps(req.context)}\n\n"
-    text_parts += f"User request: {req.prompt}"
 
+def _worth_hedging(task: "asyncio.Task") -> bool:
+    """Still running, timed out, or failed in a way another model may not (5xx, 429).
+
+    A fast 4xx (bad request, bad key) would fail the same way on the hedge.
+    """
+    if not task.done():
+        return True
+    if task.cancelled():
+        return False
+    error = task.exception()
+    if error is not None:
+        return isinstance(error, httpx.TimeoutException)
+    status = task.result().status_code
+    return status >= 500 or status == 429
+
+
+async def _hedged_post(
+    api_key: str,
+    payload: Dict[str, Any],
+    priority: int,
+    model: str,
+    hedge: Optional[str],
+) -> Tuple[str, httpx.Response]:
+    """Calls `model`; if it is slower than its p95 (or times out / gets a 5xx or 429), races `hedge` against it.
+
+    Returns the model that answered and its response. The loser is cancelled.
+    When neither answers with 200, the primary's response (or error) wins.
+    """
+    if hedge is None:
+        return model, await _post_model(model, api_key, payload, priority)
+
+    registry = get_model_registry()
+    primary = asyncio.create_task(_post_model(model, api_key, payload, priority))
+    tasks = {primary: model}
+    try:
+        await asyncio.wait({primary}, timeout=registry.hedge_delay(model))
+        if _answered(primary) or not _worth_hedging(primary):
+            return model, primary.result()
+
+        registry.hedges += 1
+        tasks[asyncio.create_task(_post_model(hedge, api_key, payload, priority))] = hedge
+        pending = {task for task in tasks if not task.done()}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if _answered(task):
+                    if tasks[task] == hedge:
+                        registry.hedge_wins += 1
+                    return tasks[task], task.result()
+            if primary in done and not _worth_hedging(primary):
+                break
+        for task in tasks:
+            if task.done():
+                task.exception()  # retrieved so a failed hedge is not logged as unhandled
+        return model, primary.result()
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def _generate(
+    api_key: str,
+    text: str,
+    temperature: float,
+    max_tokens: int,
+    priority: int = PRIORITY_INTERACTIVE,
+) -> Generation:
+    """Calls Gemini; returns the text, the tokens used (usageMetadata, else estimated) and the model.
+
+    The model is routed by prompt size and hedged against the fallback model
+    (see ai_models). Calls run inside upstream concurrency slots. An upstream
+    429/503 shrinks the limiter and is retried once; if Gemini is still
+    overloaded the caller gets 503 + Retry-After rather than Gemini's 429
+    (which would read as the caller's own rate limit).
+    """
     payload = {
-        "contents": [{"parts": [{"text": text_parts}]}],
+        "contents": [{"parts": [{"text": text}]}],
         "generationConfig": {
-            "temperature": req.temperature,
-            "maxOutputTokens": req.max_tokens,
+            "temperature": temperature,
+            "maxOutputTokens": max_tokens,
         },
     }
+    model, hedge = get_model_registry().route(estimate_tokens(text))
 
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(
-                GEMINI_API_URL,
-                params={"key": api_key},
-                json=payload,
-            )
+        for attempt in range(2):
+            used_model, response = await _hedged_post(api_key, payload, priority, model, hedge)
+
+            if response.status_code in _UPSTREAM_OVERLOAD_STATUSES:
+                retry_after = _upstream_retry_after(response)
+                if attempt == 0 and retry_after <= _UPSTREAM_MAX_RETRY_WAIT_SECONDS:
+                    await asyncio.sleep(retry_after)
+                    continue
+                raise HTTPException(
+                    status_code=503,
+                    detail="AI service is busy. Please try again shortly.",
+                    headers={"Retry-After": str(max(1, int(retry_after)))},
+                )
+            break
 
         if response.status_code != 200:
             error_detail = response.text
             raise HTTPException(status_code=response.status_code, detail=f"Gemini API error: {error_detail}")
 
         data = response.json()
-        text = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
-
-        # memU: Record this AI interaction for learning
-        if effective_user_id:
-            await memorize_user_action(effective_user_id, "ai_interaction", {
-                "prompt_summary": req.prompt[:200],
-                "response_summary": text[:200],
-            })
-
-        return {"text": text}
+        reply = data.get("candidates", [{}])[0].get("content", {}).get("parts", [{}])[0].get("text", "")
+        used = _usage_tokens(data.get("usageMetadata") or {})
+        if used is None:
+            used = estimate_tokens(text) + estimate_tokens(reply)
+        return Generation(reply, used, used_model)
 
+    except UpstreamBusyError as e:
+        raise HTTPException(
+            status_code=503,
+            detail="AI service is busy. Please try again shortly.",
+            headers={"Retry-After": str(e.retry_after)},
+        )
     except httpx.TimeoutException:
         raise HTTPException(status_code=504, detail="Gemini API request timed out")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI proxy error: {str(e)}")
+
+
+@router.post("/ask")
+async def ask_ai(req: AIRequest, request: Request):
+    api_key = _get_gemini_api_key()
+    token_estimate = estimate_request_tokens(req.prompt, req.system_prompt, req.context, req.max_tokens)
+    effective_user_id, lookup, reservation = await _authorize_ai_request(
+        request, req.user_id, req.prompt, cost=1, token_estimate=token_estimate
+    )
+
+    # memU: Inject personalized context from memory
+    with span("ai.memu_wait"):
+        memories = await lookup.result() if lookup is not None else None
+    built = build_prompt(
+        req.prompt,
+        system_prompt=req.system_prompt,
+        memories=memories,
+        context=req.context,
+    )
+
+    try:
+        with span("ai.gemini"):
+            generation = await _generate(api_key, built.text, req.temperature, req.max_tokens)
+    except BaseException:
+        await reservation.settle(0)
+        raise
+    await reservation.settle(generation.usage_tokens)
+    text = generation.text
+
+    # memU: Record this AI interaction for learning
+    if effective_user_id:
+        with span("ai.memorize"):
+            await memorize_user_action(effective_user_id, "ai_interaction", {
+                "prompt_summary": req.prompt[:200],
+                "response_summary": text[:200],
+            })
+
+    return {"text": text, "meta": _generation_meta(built, generation)}
+
+
+class AIBatchItem(BaseModel):
+    id: Optional[str] = None
+    prompt: str
+    context: Optional[dict] = None
+    system_prompt: Optional[str] = None
+    temperature: float = 0.7
+    max_tokens: int = 2048
+
+
+class AIBatchRequest(BaseModel):
+    items: List[AIBatchItem]
+    # Shared defaults, overridden per item.
+    context: Optional[dict] = None
+    system_prompt: Optional[str] = None
+    user_id: Optional[str] = None
+    stream: bool = False
+
+
+@router.post("/batch")
+async def ask_ai_batch(req: AIBatchRequest, request: Request):
+    """Several prompts in one request: one auth check, one rate-limit charge
+    (cost = number of items), one memU lookup, concurrent Gemini calls."""
+    settings = get_settings()
+    max_items = settings.ai_batch_max_items
+    if not req.items:
+        raise HTTPException(status_code=400, detail="Batch must contain at least one item")
+    if len(req.items) > max_items:
+        raise HTTPException(status_code=400, detail=f"Batch is limited to {max_items} items")
+
+    api_key = _get_gemini_api_key()
+    memory_query = " ".join(item.prompt for item in req.items)
+    token_estimate = sum(
+        estimate_request_tokens(
+            item.prompt,
+            item.system_prompt or req.system_prompt,
+            item.context if item.context is not None else req.context,
+            item.max_tokens,
+        )
+        for item in req.items
+    )
+    effective_user_id, lookup, reservation = await _authorize_ai_request(
+        request, req.user_id, memory_query, cost=len(req.items), token_estimate=token_estimate
+    )
+    memories = await lookup.result() if lookup is not None else None
+
+    semaphore = asyncio.Semaphore(settings.ai_batch_concurrency)
+
+    async def run_item(index: int, item: AIBatchItem) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"index": index, "id": item.id}
+        built = build_prompt(
+            item.prompt,
+            system_prompt=item.system_prompt or req.system_prompt,
+            memories=memories,
+            context=item.context if item.context is not None else req.context,
+        )
+        try:
+            async with semaphore:
+                generation = await _generate(
+                    api_key, built.text, item.temperature, item.max_tokens, priority=PRIORITY_BATCH
+                )
+            result.update({"text": generation.text, "meta": _generation_meta(built, generation)})
+        except HTTPException as e:
+            result["error"] = {"status": e.status_code, "detail": e.detail}
+        return result
+
+    async def finish(results: List[Dict[str, Any]]):
+        await reservation.settle(sum(r["meta"]["usage_tokens"] for r in results if "meta" in r))
+        if not effective_user_id:
+            return
+        await memorize_user_action(effective_user_id, "ai_interaction", {
+            "batch": [
+                {
+                    "prompt_summary": req.items[r["index"]].prompt[:200],
+                    "response_summary": r["text"][:200],
+                }
+                for r in results if "text" in r
+            ],
+        })
+
+    tasks = [asyncio.create_task(run_item(i, item)) for i, item in enumerate(req.items)]
+
+    if not req.stream:
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            await reservation.settle(0)
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+        await finish(results)
+        return {"results": results}
+
+    async def stream_results():
+        finished: List[Dict[str, Any]] = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                finished.append(result)
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+        finally:
+            # Client went away mid-stream: don't leave Gemini calls running.
+            for task in tasks:
+                task.cancel()
+            await reservation.settle(
+                sum(r["meta"]["usage_tokens"] for r in finished if "meta" in r)
+            )
+        await finish(finished)
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
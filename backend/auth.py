@@ -1,32 +1,76 @@
-import os
-from fastapi import Request, HTTPException
-from starlette.middleware.base import BaseHTTPMiddleware
+import hmac
+from typing import Iterable, Optional
 
+from fastapi import Request
+from starlette.responses import JSONResponse
+
+from settings import Settings, get_settings, on_reload
 from supabase_auth import get_supabase_user_id_from_request
 
 PUBLIC_PATHS = {"/", "/health", "/api/calendar/feed", "/api/ai/status"}
-BEARER_AUTH_PATHS = {"/api/ai/ask", "/api/memory/track", "/api/auth/account"}
+BEARER_AUTH_PATHS = {"/api/ai/ask", "/api/ai/batch", "/api/memory/track", "/api/auth/account", "/api/calendar/subscription"}
+
+# Path classes; any path not in the table needs the API key.
+_PUBLIC = "public"
+_BEARER = "bearer"
+_API_KEY_HEADER = b"x-api-key"
+
+
+def _build_path_table(public_paths: Iterable[str], bearer_paths: Iterable[str]) -> dict:
+    table = {path: _BEARER for path in bearer_paths}
+    table.update({path: _PUBLIC for path in public_paths})
+    return table
+
+
+class APIKeyAuthMiddleware:
+    """Requires `X-API-Key: $API_SECRET_KEY` outside PUBLIC_PATHS.
+
+    BEARER_AUTH_PATHS also accept a valid Supabase bearer token instead (the
+    verification is kept on request.state for the handler). Configuration is
+    taken from settings when the middleware is built (and again on settings
+    reload unless `api_key` is given); with no API_SECRET_KEY every request
+    passes straight through.
+    """
 
+    def __init__(
+        self,
+        app,
+        api_key: Optional[str] = None,
+        public_paths: Iterable[str] = PUBLIC_PATHS,
+        bearer_paths: Iterable[str] = BEARER_AUTH_PATHS,
+    ):
+        self.app = app
+        self._paths = _build_path_table(public_paths, bearer_paths)
+        if api_key is None:
+            self._configure(get_settings())
+            on_reload(self._configure)
+        else:
+            self._api_key = api_key.encode("utf-8")
 
-class APIKeyAuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
-        if request.method == "OPTIONS":
-            return await call_next(request)
+    def _configure(self, settings: Settings):
+        self._api_key = settings.api_secret_key.encode("utf-8")
 
-        if request.url.path in PUBLIC_PATHS:
-            return await call_next(request)
+    def _has_valid_key(self, scope) -> bool:
+        for name, value in scope["headers"]:
+            if name == _API_KEY_HEADER:
+                return hmac.compare_digest(value, self._api_key)
+        return False
 
-        api_key = os.getenv("API_SECRET_KEY", "")
-        if not api_key:
-            return await call_next(request)
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._api_key or scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
 
-        provided_key = request.headers.get("X-API-Key", "")
-        if provided_key == api_key:
-            return await call_next(request)
+        path_class = self._paths.get(scope["path"])
+        if path_class == _PUBLIC or self._has_valid_key(scope):
+            await self.app(scope, receive, send)
+            return
 
-        if request.url.path in BEARER_AUTH_PATHS:
-            user_id = await get_supabase_user_id_from_request(request, required=False)
+        if path_class == _BEARER:
+            user_id = await get_supabase_user_id_from_request(Request(scope), required=False)
             if user_id:
-                return await call_next(request)
+                await self.app(scope, receive, send)
+                return
 
-        raise HTTPException(status_code=401, detail="Invalid or missing API key")
+        response = JSONResponse({"detail": "Invalid or missing API key"}, status_code=401)
+        await response(scope, receive, send)
@@ -0,0 +1,105 @@
+"""
+Microbenchmark: per-request overhead of the API key auth middleware.
+
+Drives each middleware directly over ASGI (no HTTP server, no TestClient) in
+front of a trivial endpoint and reports microseconds per request for:
+- no middleware (baseline),
+- the previous BaseHTTPMiddleware implementation,
+- the current pure ASGI APIKeyAuthMiddleware.
+
+Usage (from backend/):
+    python benchmarks/bench_auth_middleware.py [--requests 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi import HTTPException, Request  # noqa: E402
+from starlette.middleware.base import BaseHTTPMiddleware  # noqa: E402
+from starlette.responses import PlainTextResponse  # noqa: E402
+
+from auth import PUBLIC_PATHS, APIKeyAuthMiddleware  # noqa: E402
+
+API_KEY = "bench-key"
+
+
+class LegacyAPIKeyAuthMiddleware(BaseHTTPMiddleware):
+    """The BaseHTTPMiddleware version this replaced, kept here for comparison."""
+
+    async def dispatch(self, request: Request, call_next):
+        if request.method == "OPTIONS":
+            return await call_next(request)
+        if request.url.path in PUBLIC_PATHS:
+            return await call_next(request)
+        api_key = os.getenv("API_SECRET_KEY", "")
+        if not api_key:
+            return await call_next(request)
+        if request.headers.get("X-API-Key", "") == api_key:
+            return await call_next(request)
+        raise HTTPException(status_code=401, detail="Invalid or missing API key")
+
+
+async def endpoint(scope, receive, send):
+    await PlainTextResponse("ok")(scope, receive, send)
+
+
+def _scope(path: str) -> dict:
+    return {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": b"",
+        "root_path": "",
+        "headers": [(b"host", b"bench"), (b"x-api-key", API_KEY.encode())],
+        "client": ("127.0.0.1", 1234),
+        "server": ("bench", 80),
+    }
+
+
+async def _run(app, requests: int, path: str) -> float:
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    for _ in range(min(500, requests)):
+        await app(_scope(path), receive, send)
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app(_scope(path), receive, send)
+    return (time.perf_counter() - started) / requests * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    args = parser.parse_args()
+
+    os.environ["API_SECRET_KEY"] = API_KEY
+    apps = {
+        "none": endpoint,
+        "base_http_middleware": LegacyAPIKeyAuthMiddleware(endpoint),
+        "pure_asgi": APIKeyAuthMiddleware(endpoint),
+    }
+
+    for path in ("/api/persistence/load", "/health"):
+        print(f"{path} ({args.requests} requests)")
+        baseline = None
+        for name, app in apps.items():
+            per_request = asyncio.run(_run(app, args.requests, path))
+            baseline = per_request if baseline is None else baseline
+            print(f"  {name:<22} {per_request:8.2f} us/req  (+{per_request - baseline:.2f} us over none)")
+
+
+if __name__ == "__main__":
+    main()
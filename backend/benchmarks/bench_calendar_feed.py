@@ -0,0 +1,119 @@
+"""
+Benchmark: ICS feed generation time and size vs. number of routines.
+
+Renders a state with N routines (spread over a few dozen start times) plus the
+seven weekly missions and reports milliseconds per render and feed size for:
+- the previous generator, which expanded every occurrence into its own VEVENT
+  and read the clock per event (kept here for comparison, skipped above
+  --legacy-max routines because it grows with routines x days),
+- the current RRULE generator (one VEVENT per routine/mission, one clock read).
+
+Usage (from backend/):
+    python benchmarks/bench_calendar_feed.py [--sizes 10,100,1000,10000] [--repeat 3] [--legacy-max 1000]
+"""
+import argparse
+import os
+import sys
+import time as time_module
+from datetime import datetime, time, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytz  # noqa: E402
+from icalendar import Calendar, Event  # noqa: E402
+
+from calendar_gen import DEFAULT_CALENDAR_OPTIONS, generate_calendar_ics  # noqa: E402
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def legacy_generate_calendar_ics(data):
+    """The per-occurrence generator this replaced (37 VEVENTs per routine, 6 per mission)."""
+    cal = Calendar()
+    cal.add('prodid', '-//DailyWave Workflow Engine//dailywave.app//')
+    cal.add('version', '2.0')
+    cal.add('x-wr-calname', 'DailyWave Workflows')
+    cal.add('x-wr-timezone', 'Asia/Seoul')
+    tz = pytz.timezone('Asia/Seoul')
+
+    for r in data.get("routines", []):
+        time_str = r.get("time", "09:00")
+        hour, minute = map(int, time_str.split(":"))
+        base_date = datetime.now(tz).date()
+        for i in range(-7, 30):
+            event_date = base_date + timedelta(days=i)
+            dt_start = tz.localize(datetime.combine(event_date, time(hour, minute)))
+            event = Event()
+            event.add('summary', f"🌊 [루틴] {r.get('title')}")
+            event.add('dtstart', dt_start)
+            event.add('dtend', dt_start + timedelta(minutes=30))
+            event.add('dtstamp', datetime.now(tz))
+            event.add('uid', f"routine-{r.get('id')}-{event_date.isoformat()}@dailywave.app")
+            event.add('description', f"시간: {time_str}\n구분: {r.get('type')}")
+            cal.add_component(event)
+
+    for p in data.get("pipelines", []):
+        target_weekday = WEEKDAYS.index(p["id"].split("-")[1])
+        base_date = datetime.now(tz).date()
+        for i in range(-1, 5):
+            days_ahead = target_weekday - base_date.weekday()
+            current_instance = base_date + timedelta(days=days_ahead + (i * 7))
+            event = Event()
+            event.add('summary', f"📅 [미션] {p.get('title')}")
+            event.add('dtstart', current_instance)
+            event.add('dtend', current_instance + timedelta(days=1))
+            event.add('dtstamp', datetime.now(tz))
+            event.add('uid', f"mission-{p.get('id')}-{current_instance.isoformat()}@dailywave.app")
+            event.add('description', p.get('subtitle', ''))
+            cal.add_component(event)
+
+    return cal.to_ical().decode('utf-8')
+
+
+def make_state(routines: int) -> dict:
+    return {
+        "routines": [
+            {
+                "id": f"r{i}",
+                "title": f"Routine {i}",
+                "time": f"{6 + i % 16:02d}:{(i * 5) % 60:02d}",
+                "type": "morning" if i % 2 else "afternoon",
+            }
+            for i in range(routines)
+        ],
+        "pipelines": [
+            {"id": f"week-{day}", "title": f"{day} mission", "subtitle": "weekly", "steps": []}
+            for day in WEEKDAYS
+        ],
+    }
+
+
+def _time_render(render, repeat: int):
+    best = float("inf")
+    body = ""
+    for _ in range(repeat):
+        started = time_module.perf_counter()
+        body = render()
+        best = min(best, time_module.perf_counter() - started)
+    return best * 1000, len(body.encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--legacy-max", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'routines':>9} {'generator':<8} {'ms/render':>10} {'bytes':>12}")
+    for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+        state = make_state(size)
+        if size <= args.legacy_max:
+            ms, nbytes = _time_render(lambda: legacy_generate_calendar_ics(state), args.repeat)
+            print(f"{size:>9} {'legacy':<8} {ms:>10.1f} {nbytes:>12}")
+        ms, nbytes = _time_render(lambda: generate_calendar_ics(state, DEFAULT_CALENDAR_OPTIONS), args.repeat)
+        print(f"{size:>9} {'rrule':<8} {ms:>10.1f} {nbytes:>12}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""
+Measurement, reporting and baseline comparison for benchmarks/run_benchmarks.py.
+
+A scenario times one operation (sync or async) `iterations` times, spread over
+`concurrency` concurrent workers, after `warmup` untimed calls. Each run is
+repeated `rounds` times and the median of each statistic across rounds is
+reported, which keeps one noisy round from moving the result.
+
+Reports are JSON (REPORT_SCHEMA) so CI can store one as a baseline and diff
+later runs against it: a scenario regresses when its p50 latency grows or its
+throughput drops by more than the tolerance.
+"""
+import asyncio
+import inspect
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Union
+
+REPORT_SCHEMA = "dailywave-benchmarks/1"
+DEFAULT_TOLERANCE = 0.25
+
+Operation = Callable[[], Union[None, Awaitable[None]]]
+
+
+@dataclass
+class Scenario:
+    name: str
+    description: str
+    # Returns the operation to time; may be async (to set up upstreams, files, ...).
+    setup: Callable[[], Union[Operation, Awaitable[Operation]]]
+    iterations: int = 200
+    concurrency: int = 1
+    warmup: int = 10
+    params: Dict[str, Any] = field(default_factory=dict)
+
+
+def _percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies: List[float], wall: float) -> Dict[str, float]:
+    """Latency statistics in milliseconds plus throughput for one round."""
+    values = sorted(latencies)
+    return {
+        "mean_ms": statistics.fmean(values) * 1000,
+        "p50_ms": _percentile(values, 0.50) * 1000,
+        "p95_ms": _percentile(values, 0.95) * 1000,
+        "p99_ms": _percentile(values, 0.99) * 1000,
+        "max_ms": values[-1] * 1000,
+        "ops_per_sec": len(values) / wall if wall > 0 else 0.0,
+    }
+
+
+async def _run_round(op: Operation, iterations: int, concurrency: int) -> Dict[str, float]:
+    is_async = inspect.iscoroutinefunction(op)
+    latencies: List[float] = []
+    remaining = iterations
+
+    async def worker():
+        nonlocal remaining
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            if is_async:
+                await op()
+            else:
+                op()
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    return summarize(latencies, time.perf_counter() - started)
+
+
+async def run_scenario(scenario: Scenario, rounds: int = 3, scale: float = 1.0) -> Dict[str, Any]:
+    op = scenario.setup()
+    if inspect.isawaitable(op):
+        op = await op
+    iterations = max(scenario.concurrency, int(scenario.iterations * scale))
+
+    await _run_round(op, max(1, int(scenario.warmup * scale)), scenario.concurrency)
+    results = [await _run_round(op, iterations, scenario.concurrency) for _ in range(rounds)]
+
+    summary = {key: round(statistics.median(r[key] for r in results), 6) for key in results[0]}
+    return {
+        "description": scenario.description,
+        "iterations": iterations,
+        "concurrency": scenario.concurrency,
+        "rounds": rounds,
+        **({"params": scenario.params} if scenario.params else {}),
+        **summary,
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=5,
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+def environment() -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "commit": _git_commit(),
+    }
+
+
+def build_report(results: Dict[str, Dict[str, Any]], profile: str) -> Dict[str, Any]:
+    return {
+        "schema": REPORT_SCHEMA,
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "profile": profile,
+        "environment": environment(),
+        "results": results,
+    }
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = DEFAULT_TOLERANCE) -> Dict[str, Any]:
+    """Per-scenario verdicts against `baseline`; `regressions` lists the scenarios that got worse.
+
+    status: ok | regression | improvement | new (not in the baseline) | missing (only in the baseline).
+    """
+    scenarios: Dict[str, Dict[str, Any]] = {}
+    current, previous = report["results"], baseline.get("results", {})
+    for name, result in current.items():
+        base = previous.get(name)
+        if base is None:
+            scenarios[name] = {"status": "new"}
+            continue
+        latency_change = result["p50_ms"] / base["p50_ms"] - 1 if base["p50_ms"] else 0.0
+        throughput_change = result["ops_per_sec"] / base["ops_per_sec"] - 1 if base["ops_per_sec"] else 0.0
+        if latency_change > tolerance or throughput_change < -tolerance:
+            status = "regression"
+        elif latency_change < -tolerance or throughput_change > tolerance:
+            status = "improvement"
+        else:
+            status = "ok"
+        scenarios[name] = {
+            "status": status,
+            "p50_ms": {"baseline": base["p50_ms"], "current": result["p50_ms"], "change": round(latency_change, 4)},
+            "ops_per_sec": {
+                "baseline": base["ops_per_sec"],
+                "current": result["ops_per_sec"],
+                "change": round(throughput_change, 4),
+            },
+        }
+    for name in previous:
+        if name not in current:
+            scenarios[name] = {"status": "missing"}
+
+    warnings = []
+    if baseline.get("profile") != report.get("profile"):
+        warnings.append(f"baseline profile {baseline.get('profile')!r} differs from {report.get('profile')!r}")
+    if baseline.get("environment", {}).get("platform") != report["environment"]["platform"]:
+        warnings.append("baseline was recorded on a different platform; compare numbers with care")
+    return {
+        "baseline_created_at": baseline.get("created_at"),
+        "baseline_commit": baseline.get("environment", {}).get("commit"),
+        "tolerance": tolerance,
+        "warnings": warnings,
+        "regressions": sorted(name for name, v in scenarios.items() if v["status"] == "regression"),
+        "scenarios": scenarios,
+    }
+
+
+def print_table(report: Dict[str, Any], out=sys.stdout):
+    comparison = report.get("comparison", {}).get("scenarios", {})
+    print(f"{'scenario':<34} {'conc':>4} {'p50 ms':>9} {'p95 ms':>9} {'ops/s':>10}  vs baseline", file=out)
+    for name, r in report["results"].items():
+        verdict = comparison.get(name)
+        note = ""
+        if verdict is not None:
+            note = verdict["status"]
+            if "p50_ms" in verdict:
+                note += f" (p50 {verdict['p50_ms']['change']:+.0%}, ops/s {verdict['ops_per_sec']['change']:+.0%})"
+        print(
+            f"{name:<34} {r['concurrency']:>4} {r['p50_ms']:>9.3f} {r['p95_ms']:>9.3f} {r['ops_per_sec']:>10.1f}  {note}",
+            file=out,
+        )
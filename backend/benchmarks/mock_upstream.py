@@ -0,0 +1,135 @@
+"""
+Local stand-in for the services the API calls out to, for benchmarks and load tests.
+
+Serves, with a configurable artificial latency:
+- Gemini  POST /models/{model}:generateContent  (point GEMINI_API_BASE_URL here)
+- memU    GET /health, POST /retrieve, /memorize, /check-similar  (MEMU_URL)
+- Supabase JWKS  GET /auth/v1/certs  (SUPABASE_PROJECT_URL), keys set via `jwks`
+
+Usage (from backend/), to load-test a separately started API:
+    python benchmarks/mock_upstream.py [--port 8765] [--gemini-latency-ms 50] [--memu-latency-ms 5]
+    GEMINI_API_BASE_URL=http://127.0.0.1:8765 MEMU_URL=http://127.0.0.1:8765 uvicorn main:app
+
+The benchmark runner starts one in-process via MockUpstream.
+"""
+import argparse
+import asyncio
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+
+class MockState:
+    def __init__(self, gemini_latency: float = 0.0, memu_latency: float = 0.0):
+        self.gemini_latency = gemini_latency
+        self.memu_latency = memu_latency
+        self.jwks: List[Dict[str, Any]] = []
+        self.calls: Dict[str, int] = {}
+
+    def count(self, name: str):
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+
+def create_app(state: MockState) -> Starlette:
+    async def generate_content(request: Request):
+        state.count("gemini")
+        body = await request.json()
+        prompt = "".join(
+            part.get("text", "")
+            for content in body.get("contents", [])
+            for part in content.get("parts", [])
+        )
+        await asyncio.sleep(state.gemini_latency)
+        prompt_tokens = max(1, len(prompt) // 4)
+        return JSONResponse({
+            "candidates": [{"content": {"parts": [{"text": "Mock answer: take a short walk, then start the next task."}]}}],
+            "usageMetadata": {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": 16,
+                "totalTokenCount": prompt_tokens + 16,
+            },
+        })
+
+    async def health(request: Request):
+        return JSONResponse({"status": "ok"})
+
+    async def retrieve(request: Request):
+        state.count("memu.retrieve")
+        await asyncio.sleep(state.memu_latency)
+        return JSONResponse({"memories": [
+            {"content": "Prefers morning routines."},
+            {"content": "Usually skips workouts on Fridays."},
+        ]})
+
+    async def memorize(request: Request):
+        state.count("memu.memorize")
+        await asyncio.sleep(state.memu_latency)
+        return JSONResponse({"status": "ok"})
+
+    async def check_similar(request: Request):
+        await asyncio.sleep(state.memu_latency)
+        return JSONResponse({"is_similar": False})
+
+    async def certs(request: Request):
+        return JSONResponse({"keys": state.jwks})
+
+    return Starlette(routes=[
+        Route("/models/{model}:generateContent", generate_content, methods=["POST"]),
+        Route("/health", health),
+        Route("/retrieve", retrieve, methods=["POST"]),
+        Route("/memorize", memorize, methods=["POST"]),
+        Route("/check-similar", check_similar, methods=["POST"]),
+        Route("/auth/v1/certs", certs),
+    ])
+
+
+class MockUpstream:
+    """Runs the mock on a free local port in a background thread: `with MockUpstream() as mock: mock.url`."""
+
+    def __init__(self, gemini_latency: float = 0.0, memu_latency: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.state = MockState(gemini_latency, memu_latency)
+        self._server = uvicorn.Server(uvicorn.Config(
+            create_app(self.state), host=host, port=port, log_level="warning", lifespan="off",
+        ))
+        self._thread: Optional[threading.Thread] = None
+        self.url = ""
+
+    def __enter__(self) -> "MockUpstream":
+        self._thread = threading.Thread(target=self._server.run, name="mock-upstream", daemon=True)
+        self._thread.start()
+        deadline = time.monotonic() + 10
+        while not self._server.started:
+            if not self._thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("mock upstream failed to start")
+            time.sleep(0.01)
+        host, port = self._server.servers[0].sockets[0].getsockname()[:2]
+        self.url = f"http://{host}:{port}"
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--gemini-latency-ms", type=float, default=50.0)
+    parser.add_argument("--memu-latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    state = MockState(args.gemini_latency_ms / 1000, args.memu_latency_ms / 1000)
+    uvicorn.run(create_app(state), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
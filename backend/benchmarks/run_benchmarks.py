@@ -0,0 +1,378 @@
+"""
+Benchmark and load-test suite: reproducible scenarios, JSON reports, baseline comparison.
+
+Scenarios (names are stable; baselines are keyed by them):
+    storage.save[N] / storage.load[N]   StorageManager round trip, state with N routines
+                                        (plus 10N history entries) in a temp dir
+    calendar.render[N]                  ICS generation for N routines + weekly missions
+    auth.verify.hs256 / .rs256          JWT verification with the verified-token cache
+                                        cleared per call (RS256 keys from the mock JWKS)
+    auth.verify.cached                  repeat token answered from the cache
+    ratelimit.consume[c=C,keys=K]       in-memory limiter under C concurrent callers
+    api.persistence.load[c=C]           GET /api/persistence/load through the full
+                                        middleware stack (API key auth, limits, metrics)
+    api.ai.ask[c=C]                     POST /api/ai/ask with bearer auth, against the
+                                        mock Gemini/memU (benchmarks/mock_upstream.py)
+
+The app runs in-process over ASGI; only the mock upstream is real HTTP on a
+local port, so results do not depend on network or external services.
+
+Usage (from backend/):
+    python benchmarks/run_benchmarks.py [--profile quick|full] [--only PREFIX[,PREFIX]]
+        [--output report.json] [--compare benchmarks/baselines/quick.json]
+        [--tolerance 0.25] [--save-baseline benchmarks/baselines/quick.json]
+
+With --compare the report gains a `comparison` section and the exit status is 1
+when any scenario regressed by more than the tolerance (p50 latency up or
+throughput down). Record baselines on the machine that will compare against them.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harness import DEFAULT_TOLERANCE, Scenario, build_report, compare, print_table, run_scenario  # noqa: E402
+from mock_upstream import MockUpstream  # noqa: E402
+
+API_KEY = "bench-api-key"
+JWT_SECRET = "bench-jwt-secret-with-at-least-32-bytes"
+RS_KID = "bench-rs256"
+GEMINI_LATENCY = 0.010
+MEMU_LATENCY = 0.002
+PROFILES = {"quick": 0.2, "full": 1.0}
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def _configure_environment(upstream_url: str, data_dir: str):
+    """Pins every setting the scenarios depend on, before any app module is imported."""
+    os.environ.update({
+        "API_SECRET_KEY": API_KEY,
+        "GEMINI_API_KEY": "bench-gemini-key",
+        "GEMINI_API_BASE_URL": upstream_url,
+        "GEMINI_FALLBACK_MODEL": "",
+        "MEMU_URL": upstream_url,
+        "SUPABASE_PROJECT_URL": upstream_url,
+        "SUPABASE_JWT_SECRET": JWT_SECRET,
+        "SUPABASE_JWT_ISSUER": "",
+        "REQUIRE_SUPABASE_AUTH_FOR_AI": "0",
+        "REDIS_URL": "",
+        "TRACE_EXPORT_FILE": "",
+        "TRACE_EXPORT_URL": "",
+        # Quotas far above what a run consumes: measure the limiter, not 429s.
+        "AI_RATE_LIMIT_PER_MINUTE": "100000000",
+        "AI_RATE_LIMIT_PER_HOUR": "100000000",
+        "AI_TOKEN_BUDGET_PER_MINUTE": "1000000000",
+        "AI_TOKEN_BUDGET_PER_HOUR": "1000000000",
+        "AI_GLOBAL_TOKEN_BUDGET_PER_MINUTE": "1000000000",
+        "AI_GLOBAL_TOKEN_BUDGET_PER_HOUR": "1000000000",
+    })
+    import storage
+
+    storage.DATA_DIR = data_dir
+    storage.DATA_FILE = os.path.join(data_dir, "workflow_data.json")
+
+
+def make_state(routines: int) -> dict:
+    return {
+        "routines": [
+            {
+                "id": f"r{i}",
+                "title": f"Routine {i}",
+                "time": f"{6 + i % 16:02d}:{(i * 5) % 60:02d}",
+                "type": "morning" if i % 2 else "afternoon",
+            }
+            for i in range(routines)
+        ],
+        "pipelines": [
+            {
+                "id": f"week-{day}",
+                "title": f"{day} mission",
+                "subtitle": "weekly",
+                "steps": [{"id": f"{day}-{s}", "title": f"Step {s}", "description": "..."} for s in range(5)],
+            }
+            for day in WEEKDAYS
+        ],
+        "sopLibrary": [],
+        "completionHistory": [
+            {"id": f"e{i}", "at": "2026-01-29T00:00:00Z", "type": "routine_done", "routineId": f"r{i % max(routines, 1)}"}
+            for i in range(routines * 10)
+        ],
+        "chaosInbox": [],
+    }
+
+
+# --- scenarios -------------------------------------------------------------
+
+
+def _storage_save(routines: int):
+    def setup():
+        from storage import StorageManager
+
+        manager, state = StorageManager(), make_state(routines)
+        return lambda: manager.save_state(state)
+
+    return setup
+
+
+def _storage_load(routines: int):
+    def setup():
+        from storage import StorageManager
+
+        manager = StorageManager()
+        manager.save_state(make_state(routines))
+        return manager.load_state
+
+    return setup
+
+
+def _calendar_render(routines: int):
+    def setup():
+        from calendar_gen import DEFAULT_CALENDAR_OPTIONS, generate_calendar_ics
+
+        state = make_state(routines)
+        return lambda: generate_calendar_ics(state, DEFAULT_CALENDAR_OPTIONS)
+
+    return setup
+
+
+def _token(claims: dict, key, algorithm: str, headers=None) -> str:
+    import jwt
+
+    now = int(time.time())
+    return jwt.encode(
+        {"aud": "authenticated", "iat": now, "exp": now + 3600, **claims}, key, algorithm=algorithm, headers=headers
+    )
+
+
+def _verify(token_for, clear_cache: bool):
+    async def setup():
+        import supabase_auth
+
+        token = token_for()
+        await supabase_auth.verify_supabase_access_token(token)  # warms the JWKS cache for RS256
+
+        async def op():
+            if clear_cache:
+                supabase_auth.clear_token_cache()
+            await supabase_auth.verify_supabase_access_token(token)
+
+        return op
+
+    return setup
+
+
+_RS_PRIVATE_KEY = None
+
+
+def _rs_jwk():
+    import jwt
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    global _RS_PRIVATE_KEY
+    _RS_PRIVATE_KEY = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(_RS_PRIVATE_KEY.public_key()))
+    jwk.update({"kid": RS_KID, "alg": "RS256", "use": "sig"})
+    return jwk
+
+
+def _hs_token():
+    return _token({"sub": "bench-user"}, JWT_SECRET, "HS256")
+
+
+def _rs_token():
+    return _token({"sub": "bench-user"}, _RS_PRIVATE_KEY, "RS256", headers={"kid": RS_KID})
+
+
+def _rate_limiter(keys: int):
+    def setup():
+        from rate_limiter import RateLimiter
+
+        limiter = RateLimiter()
+        counter = itertools.count()
+
+        async def op():
+            await limiter.consume("ai", f"bench-{next(counter) % keys}")
+
+        return op
+
+    return setup
+
+
+_CLIENT = None
+
+
+def _api_client():
+    """One httpx client over ASGI to the real app, shared by the API scenarios."""
+    global _CLIENT
+    if _CLIENT is None:
+        import httpx
+
+        from main import app
+
+        _CLIENT = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://bench",
+            headers={"X-API-Key": API_KEY},
+        )
+    return _CLIENT
+
+
+def _api_persistence_load():
+    def setup():
+        from storage import StorageManager
+
+        StorageManager().save_state(make_state(100))
+        client = _api_client()
+
+        async def op():
+            response = await client.get("/api/persistence/load")
+            response.raise_for_status()
+
+        return op
+
+    return setup
+
+
+def _api_ai_ask(users: int = 50):
+    def setup():
+        client = _api_client()
+        tokens = [_token({"sub": f"bench-user-{i}"}, JWT_SECRET, "HS256") for i in range(users)]
+        counter = itertools.count()
+
+        async def op():
+            n = next(counter)
+            response = await client.post(
+                "/api/ai/ask",
+                # A fresh prompt per call, so memU context is not served from its cache.
+                json={"prompt": f"What should I focus on next? ({n})", "max_tokens": 256},
+                headers={"Authorization": f"Bearer {tokens[n % users]}"},
+            )
+            response.raise_for_status()
+
+        return op
+
+    return setup
+
+
+SCENARIOS: List[Scenario] = [
+    *(Scenario(f"storage.save[{n}]", f"save_state, {n} routines", _storage_save(n), iterations=it, params={"routines": n})
+      for n, it in ((10, 500), (100, 200), (1000, 30))),
+    *(Scenario(f"storage.load[{n}]", f"load_state, {n} routines", _storage_load(n), iterations=it, params={"routines": n})
+      for n, it in ((10, 500), (100, 200), (1000, 30))),
+    *(Scenario(f"calendar.render[{n}]", f"ICS for {n} routines", _calendar_render(n), iterations=it, params={"routines": n})
+      for n, it in ((10, 200), (100, 50), (1000, 10))),
+    Scenario("auth.verify.hs256", "HS256 verification, token cache cleared", _verify(_hs_token, True), iterations=2000),
+    Scenario("auth.verify.rs256", "RS256 verification via JWKS, token cache cleared", _verify(_rs_token, True), iterations=1000),
+    Scenario("auth.verify.cached", "verified-token cache hit", _verify(_hs_token, False), iterations=5000),
+    Scenario("ratelimit.consume[c=1,keys=1]", "in-memory consume, sequential", _rate_limiter(1), iterations=5000),
+    Scenario(
+        "ratelimit.consume[c=64,keys=64]", "in-memory consume, 64 callers over 64 keys",
+        _rate_limiter(64), iterations=10000, concurrency=64,
+    ),
+    Scenario(
+        "ratelimit.consume[c=64,keys=1]", "in-memory consume, 64 callers on one hot key",
+        _rate_limiter(1), iterations=10000, concurrency=64,
+    ),
+    Scenario(
+        "api.persistence.load[c=16]", "GET /api/persistence/load, 100 routines",
+        _api_persistence_load(), iterations=1000, concurrency=16,
+    ),
+    Scenario(
+        "api.ai.ask[c=1]", "POST /api/ai/ask, mock upstreams", _api_ai_ask(), iterations=100,
+        params={"gemini_latency_ms": GEMINI_LATENCY * 1000, "memu_latency_ms": MEMU_LATENCY * 1000},
+    ),
+    Scenario(
+        "api.ai.ask[c=32]", "POST /api/ai/ask, mock upstreams", _api_ai_ask(), iterations=1000, concurrency=32,
+        params={"gemini_latency_ms": GEMINI_LATENCY * 1000, "memu_latency_ms": MEMU_LATENCY * 1000},
+    ),
+]
+
+
+async def _run(scenarios: List[Scenario], rounds: int, scale: float) -> Dict[str, dict]:
+    from main import app
+
+    # One INFO line per upstream request would swamp the output.
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    results = {}
+    # Lifespan runs the memU probe and JWKS warm-up, as in production.
+    async with app.router.lifespan_context(app):
+        for scenario in scenarios:
+            print(f"running {scenario.name} ...", file=sys.stderr, flush=True)
+            results[scenario.name] = await run_scenario(scenario, rounds=rounds, scale=scale)
+    if _CLIENT is not None:
+        await _CLIENT.aclose()
+    return results
+
+
+def _write_json(path: str, data: dict):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.write("\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="full")
+    parser.add_argument("--only", default="", help="comma-separated scenario name prefixes")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--output", default="", help="write the JSON report here")
+    parser.add_argument("--compare", default="", help="baseline report to compare against")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--save-baseline", default="", help="also write the report as a baseline here")
+    parser.add_argument("--list", action="store_true", help="list scenarios and exit")
+    args = parser.parse_args()
+
+    prefixes = [p.strip() for p in args.only.split(",") if p.strip()]
+    scenarios = [s for s in SCENARIOS if not prefixes or any(s.name.startswith(p) for p in prefixes)]
+    if args.list:
+        for s in scenarios:
+            print(f"{s.name:<34} {s.description}")
+        return 0
+    if not scenarios:
+        parser.error(f"no scenario matches {args.only!r}")
+
+    data_dir = tempfile.mkdtemp(prefix="dailywave-bench-")
+    try:
+        with MockUpstream(gemini_latency=GEMINI_LATENCY, memu_latency=MEMU_LATENCY) as upstream:
+            upstream.state.jwks = [_rs_jwk()]
+            _configure_environment(upstream.url, data_dir)
+            results = asyncio.run(_run(scenarios, args.rounds, PROFILES[args.profile]))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = build_report(results, args.profile)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report["comparison"] = compare(report, json.load(f), args.tolerance)
+
+    print_table(report)
+    if args.output:
+        _write_json(args.output, report)
+    if args.save_baseline:
+        _write_json(args.save_baseline, {k: v for k, v in report.items() if k != "comparison"})
+
+    comparison = report.get("comparison")
+    if comparison:
+        for warning in comparison["warnings"]:
+            print(f"warning: {warning}", file=sys.stderr)
+        if comparison["regressions"]:
+            print(f"regressions: {', '.join(comparison['regressions'])}", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,387 @@
+"""
+Cached rendering of the ICS feed served at /api/calendar/feed.
+
+Calendar clients poll the feed constantly, but its content only changes when a
+routine or pipeline changes or the calendar date rolls over. The state file is
+re-read only when its version marker (inode/size/mtime) changes, and the ICS is
+re-rendered only when the digest of routines + pipelines or today's date
+differs from the cached render (one cached render per timezone/horizon
+requested, see CalendarOptions). The ETag is derived from that key, so every
+worker answers conditional GETs the same way without rendering anything.
+
+Per-user feeds (CalendarFeedStore) are rendered when the user publishes their
+routines and pipelines, written to DATA_DIR as plain, gzip and (with the
+optional `brotli` package) brotli bytes, and served straight from those files.
+A poll reads only a small meta.json; renders run off the event loop.
+"""
+import gzip
+import hashlib
+import json
+import os
+import secrets
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+from datetime import date, datetime, timezone
+from datetime import time as dt_time
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from calendar_gen import DEFAULT_CALENDAR_OPTIONS, CalendarOptions, generate_calendar_ics
+from metrics import cache_lookup
+
+try:
+    import brotli  # type: ignore
+except ImportError:  # optional: feeds are then stored as plain + gzip only
+    brotli = None
+
+_UNSET = object()
+
+# Horizons the public feed accepts from the query. Together with the timezone
+# allowlist (CALENDAR_FEED_TIMEZONES) this bounds how many variants anonymous
+# clients can make the server render and keep.
+PUBLIC_FEED_PAST_DAYS = (0, 7, 30)
+PUBLIC_FEED_FUTURE_DAYS = (7, 30, 90)
+
+
+@dataclass(frozen=True)
+class FeedValidators:
+    etag: str
+    last_modified: datetime
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "ETag": self.etag,
+            "Last-Modified": format_datetime(self.last_modified, usegmt=True),
+            # Clients may keep the body but must revalidate (a 304 is cheap).
+            "Cache-Control": "no-cache",
+        }
+
+    def is_not_modified(self, if_none_match: Optional[str], if_modified_since: Optional[str]) -> bool:
+        """Evaluates conditional request headers (If-None-Match wins when present)."""
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return "*" in tags or self.etag in tags
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            return self.last_modified <= since
+        return False
+
+
+@dataclass(frozen=True)
+class RenderedFeed(FeedValidators):
+    body: bytes = b""
+
+
+@dataclass(frozen=True)
+class StoredFeed(FeedValidators):
+    """A pre-rendered feed file on disk, in the best encoding the client accepts."""
+
+    path: str = ""
+    content_encoding: Optional[str] = None
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        headers = super().headers
+        headers["Vary"] = "Accept-Encoding"
+        if self.content_encoding:
+            headers["Content-Encoding"] = self.content_encoding
+        return headers
+
+
+def _validators(digest: str, now: datetime, changed_at: float, options: CalendarOptions) -> Tuple[str, datetime]:
+    """ETag and Last-Modified for a feed rendered from `digest` at `now` (in the feed's timezone)."""
+    today = now.date()
+    day_start = options.tz.localize(datetime.combine(today, dt_time.min)).timestamp()
+    last_modified = datetime.fromtimestamp(int(max(changed_at, day_start)), timezone.utc)
+    key = f"{digest}:{today.isoformat()}:{options.timezone}:{options.past_days}:{options.future_days}"
+    etag = '"' + hashlib.sha256(key.encode()).hexdigest()[:32] + '"'
+    return etag, last_modified
+
+
+def calendar_digest(data: Dict[str, Any]) -> str:
+    """Digest of the parts of the state that appear in the feed."""
+    relevant = {"routines": data.get("routines", []), "pipelines": data.get("pipelines", [])}
+    encoded = json.dumps(relevant, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+Renderer = Callable[[Dict[str, Any], CalendarOptions, datetime], str]
+
+
+class CalendarFeedCache:
+    """Rendered global feed per CalendarOptions (a bounded LRU, since options come from the query)."""
+
+    def __init__(
+        self,
+        storage,
+        render: Renderer = generate_calendar_ics,
+        clock: Callable[[], float] = time.time,
+        max_variants: int = 32,
+    ):
+        self._storage = storage
+        self._render = render
+        self._clock = clock
+        self._max_variants = max_variants
+        self._version: Any = _UNSET
+        self._data: Optional[Dict[str, Any]] = None
+        self._digest: Optional[str] = None
+        self._changed_at = 0.0
+        # options -> ((digest, date), feed)
+        self._feeds: "OrderedDict[CalendarOptions, Tuple[Tuple[str, date], RenderedFeed]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.renders = 0
+
+    def _refresh_state(self):
+        version = self._storage.state_version()
+        if version == self._version:
+            return
+        data = self._storage.load_state()
+        digest = calendar_digest(data)
+        if digest != self._digest:
+            self._data = data
+            self._digest = digest
+            # The file mtime is the same for every worker, unlike our own clock.
+            self._changed_at = version[2] / 1e9 if version is not None else self._clock()
+        self._version = version
+
+    def peek(self, options: CalendarOptions = DEFAULT_CALENDAR_OPTIONS) -> Optional[RenderedFeed]:
+        """The cached feed if still current, else None; never reads the state or renders (safe on the event loop)."""
+        if self._storage.state_version() != self._version:
+            return None
+        now = datetime.fromtimestamp(self._clock(), options.tz)
+        cached = self._feeds.get(options)
+        if cached is None or cached[0] != (self._digest, now.date()):
+            return None
+        cache_lookup("calendar_feed", True)
+        return cached[1]
+
+    def get(self, options: CalendarOptions = DEFAULT_CALENDAR_OPTIONS) -> RenderedFeed:
+        """The feed for `options`, re-reading the state and rendering as needed (blocking; thread safe)."""
+        with self._lock:
+            return self._get(options)
+
+    def _get(self, options: CalendarOptions) -> RenderedFeed:
+        self._refresh_state()
+        now = datetime.fromtimestamp(self._clock(), options.tz)
+        key = (self._digest, now.date())
+        cached = self._feeds.get(options)
+        hit = cached is not None and cached[0] == key
+        cache_lookup("calendar_feed", hit)
+        if hit:
+            self._feeds.move_to_end(options)
+            return cached[1]
+
+        body = self._render(self._data, options, now).encode("utf-8")
+        self.renders += 1
+        etag, last_modified = _validators(self._digest, now, self._changed_at, options)
+        feed = RenderedFeed(body=body, etag=etag, last_modified=last_modified)
+        self._feeds[options] = (key, feed)
+        self._feeds.move_to_end(options)
+        while len(self._feeds) > self._max_variants:
+            self._feeds.popitem(last=False)
+        return feed
+
+
+# Preferred first when the client accepts several.
+_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+_FEED_FILE = "feed.ics"
+_META_FILE = "meta.json"
+_SOURCE_FILE = "source.json"
+
+
+def _hashed(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+
+def _write_atomic(path: str, payload: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+    os.replace(tmp, path)
+
+
+def _encoded_etag(etag: str, suffix: str) -> str:
+    """Distinct strong ETag per stored representation, e.g. "abc" -> "abc-gz"."""
+    return f'{etag[:-1]}-{suffix.lstrip(".")}"'
+
+
+def _read_json(path: str) -> Optional[Dict[str, Any]]:
+    try:
+        with open(path, "rb") as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _accepted_encodings(accept_encoding: Optional[str]) -> set:
+    accepted = set()
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            accepted.add(name)
+    if "*" in accepted:
+        accepted.update(encoding for encoding, _ in _ENCODINGS)
+    return accepted
+
+
+class CalendarFeedStore:
+    """Per-user ICS feeds behind secret tokens, pre-rendered on publish.
+
+    Layout under `root`:
+        users/<sha256(user id)>.json            {"token": ...}
+        feeds/<sha256(token)>/meta.json         validators, options, encodings
+        feeds/<sha256(token)>/source.json       published routines/pipelines
+        feeds/<sha256(token)>/feed.ics[.gz|.br]
+
+    Files are replaced atomically, so every worker can serve and publish. A feed
+    is re-rendered when the published routines/pipelines differ, or lazily on the
+    first poll after the calendar date rolled over. `peek` serves current feeds
+    without rendering; `publish` and `open` may render (blocking; thread safe).
+    """
+
+    def __init__(
+        self,
+        root: str,
+        render: Renderer = generate_calendar_ics,
+        clock: Callable[[], float] = time.time,
+    ):
+        self._root = root
+        self._render = render
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.renders = 0
+
+    def _user_path(self, user_id: str) -> str:
+        return os.path.join(self._root, "users", _hashed(user_id) + ".json")
+
+    def _feed_dir(self, token: str) -> str:
+        return os.path.join(self._root, "feeds", _hashed(token))
+
+    def _today(self, options: CalendarOptions) -> str:
+        return datetime.fromtimestamp(self._clock(), options.tz).date().isoformat()
+
+    def _render_into(
+        self, feed_dir: str, data: Dict[str, Any], options: CalendarOptions, digest: str, changed_at: float
+    ) -> Dict[str, Any]:
+        now = datetime.fromtimestamp(self._clock(), options.tz)
+        body = self._render(data, options, now).encode("utf-8")
+        self.renders += 1
+        os.makedirs(feed_dir, exist_ok=True)
+        base = os.path.join(feed_dir, _FEED_FILE)
+        _write_atomic(base, body)
+        encodings = ["gzip"]
+        _write_atomic(base + ".gz", gzip.compress(body, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write_atomic(base + ".br", brotli.compress(body))
+            encodings.append("br")
+
+        etag, last_modified = _validators(digest, now, changed_at, options)
+        meta = {
+            "digest": digest,
+            "options": asdict(options),
+            "date": now.date().isoformat(),
+            "changed_at": changed_at,
+            "etag": etag,
+            "last_modified": last_modified.timestamp(),
+            "encodings": encodings,
+        }
+        _write_atomic(os.path.join(feed_dir, _META_FILE), json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+        return meta
+
+    def publish(
+        self, user_id: str, data: Dict[str, Any], options: CalendarOptions = DEFAULT_CALENDAR_OPTIONS
+    ) -> str:
+        """Stores the user's routines/pipelines and feed options, renders if they changed; returns the feed token."""
+        data = {"routines": data.get("routines", []), "pipelines": data.get("pipelines", [])}
+        with self._lock:
+            return self._publish(user_id, data, options)
+
+    def _publish(self, user_id: str, data: Dict[str, Any], options: CalendarOptions) -> str:
+        user_path = self._user_path(user_id)
+        record = _read_json(user_path)
+        if record and record.get("token"):
+            token = record["token"]
+        else:
+            token = secrets.token_urlsafe(32)
+            os.makedirs(os.path.dirname(user_path), exist_ok=True)
+            _write_atomic(user_path, json.dumps({"token": token}).encode("utf-8"))
+
+        feed_dir = self._feed_dir(token)
+        meta = _read_json(os.path.join(feed_dir, _META_FILE))
+        digest = calendar_digest(data)
+        if meta is None or meta.get("digest") != digest or meta.get("options") != asdict(options):
+            os.makedirs(feed_dir, exist_ok=True)
+            _write_atomic(os.path.join(feed_dir, _SOURCE_FILE), json.dumps(data, ensure_ascii=False).encode("utf-8"))
+            self._render_into(feed_dir, data, options, digest, self._clock())
+        elif meta.get("date") != self._today(options):
+            self._render_into(feed_dir, data, options, digest, meta["changed_at"])
+        return token
+
+    def revoke(self, user_id: str) -> bool:
+        """Deletes the user's feed; the old URL stops working and the next publish issues a new one."""
+        user_path = self._user_path(user_id)
+        record = _read_json(user_path)
+        if not record:
+            return False
+        if record.get("token"):
+            shutil.rmtree(self._feed_dir(record["token"]), ignore_errors=True)
+        try:
+            os.remove(user_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def peek(self, token: str, accept_encoding: Optional[str] = None) -> Optional[StoredFeed]:
+        """The feed file for `token` if rendered for today, else None (unknown or stale); never renders."""
+        meta = _read_json(os.path.join(self._feed_dir(token), _META_FILE))
+        if meta is None or meta["date"] != self._today(CalendarOptions(**meta["options"])):
+            return None
+        return self._stored(token, meta, accept_encoding)
+
+    def open(self, token: str, accept_encoding: Optional[str] = None) -> Optional[StoredFeed]:
+        """The feed file for `token`, re-rendering after a date rollover; None for an unknown token."""
+        feed_dir = self._feed_dir(token)
+        with self._lock:
+            meta = _read_json(os.path.join(feed_dir, _META_FILE))
+            if meta is None:
+                return None
+            options = CalendarOptions(**meta["options"])
+            if meta["date"] != self._today(options):
+                data = _read_json(os.path.join(feed_dir, _SOURCE_FILE))
+                if data is None:
+                    return None
+                meta = self._render_into(feed_dir, data, options, meta["digest"], meta["changed_at"])
+        return self._stored(token, meta, accept_encoding)
+
+    def _stored(self, token: str, meta: Dict[str, Any], accept_encoding: Optional[str]) -> StoredFeed:
+        path = os.path.join(self._feed_dir(token), _FEED_FILE)
+        etag = meta["etag"]
+        content_encoding = None
+        accepted = _accepted_encodings(accept_encoding)
+        for encoding, suffix in _ENCODINGS:
+            if encoding in accepted and encoding in meta["encodings"]:
+                path, etag, content_encoding = path + suffix, _encoded_etag(etag, suffix), encoding
+                break
+        return StoredFeed(
+            etag=etag,
+            last_modified=datetime.fromtimestamp(meta["last_modified"], timezone.utc),
+            path=path,
+            content_encoding=content_encoding,
+        )
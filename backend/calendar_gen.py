@@ -1,44 +1,101 @@
-from icalendar import Calendar, Event
+from icalendar import Calendar, Event, Timezone
+from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime, time, timedelta
 import pytz
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Optional, Tuple
 
-def generate_calendar_ics(data: Dict[str, Any]) -> str:
+from tracing import span
+
+CALENDAR_TIMEZONE = 'Asia/Seoul'
+MAX_HORIZON_DAYS = 366
+
+
+@lru_cache(maxsize=64)
+def _vtimezone(tzid: str) -> Optional[Timezone]:
+    """VTIMEZONE for `tzid`, built once: expanding the transitions costs
+    ~25ms, more than rendering a small feed. Callers only serialize it."""
+    try:
+        return Timezone.from_tzid(tzid)
+    except ValueError:
+        return None
+
+
+@dataclass(frozen=True)
+class CalendarOptions:
+    """Feed timezone and window: routines daily from `past_days` ago to
+    `future_days` ahead, missions weekly over the same span rounded up to weeks
+    (the defaults give 37 routine and 6 mission occurrences)."""
+
+    timezone: str = CALENDAR_TIMEZONE
+    past_days: int = 7
+    future_days: int = 30
+
+    def __post_init__(self):
+        if self.timezone not in pytz.all_timezones_set:
+            raise ValueError(f"Unknown timezone: {self.timezone}")
+        if not 0 <= self.past_days <= MAX_HORIZON_DAYS:
+            raise ValueError(f"past_days must be between 0 and {MAX_HORIZON_DAYS}")
+        if not 1 <= self.future_days <= MAX_HORIZON_DAYS:
+            raise ValueError(f"future_days must be between 1 and {MAX_HORIZON_DAYS}")
+
+    @property
+    def tz(self):
+        return pytz.timezone(self.timezone)
+
+    @property
+    def mission_weeks(self) -> Tuple[int, int]:
+        return -(-self.past_days // 7), -(-self.future_days // 7)
+
+
+DEFAULT_CALENDAR_OPTIONS = CalendarOptions()
+
+
+@span("calendar.render")
+def generate_calendar_ics(
+    data: Dict[str, Any],
+    options: CalendarOptions = DEFAULT_CALENDAR_OPTIONS,
+    now: Optional[datetime] = None,
+) -> str:
     """Generates an iCalendar (.ics) string from workflow data."""
     cal = Calendar()
     cal.add('prodid', '-//DailyWave Workflow Engine//dailywave.app//')
     cal.add('version', '2.0')
     cal.add('x-wr-calname', 'DailyWave Workflows')
-    cal.add('x-wr-timezone', 'Asia/Seoul')
-    
-    tz = pytz.timezone('Asia/Seoul')
-    
+    cal.add('x-wr-timezone', options.timezone)
+
+    tz = options.tz
+
+    # Everything time-dependent is derived from one clock reading per render.
+    now = now.astimezone(tz) if now is not None else datetime.now(tz)
+    today = now.date()
+    first_routine_date = today - timedelta(days=options.past_days)
+    routine_count = options.past_days + options.future_days
+    # Routines mostly share a handful of start times; localize each one once.
+    starts: Dict[str, datetime] = {}
+
     # 1. Process Routines
     routines = data.get("routines", [])
     for r in routines:
-        # We create a recurring daily event for each routine
-        # Since ics feeds are often simple, we'll just generate events for the next 30 days
-        # to ensure they show up reliably in all clients.
+        # One daily recurring event per routine covering the whole window;
+        # clients expand the RRULE, so the feed stays O(routines).
         try:
             time_str = r.get("time", "09:00")
-            hour, minute = map(int, time_str.split(":"))
-            
-            # Start from today
-            base_date = datetime.now(tz).date()
-            
-            for i in range(-7, 30): # 7 days past, 30 days future
-                event_date = base_date + timedelta(days=i)
-                dt_start = tz.localize(datetime.combine(event_date, time(hour, minute)))
-                dt_end = dt_start + timedelta(minutes=30)
-                
-                event = Event()
-                event.add('summary', f"🌊 [루틴] {r.get('title')}")
-                event.add('dtstart', dt_start)
-                event.add('dtend', dt_end)
-                event.add('dtstamp', datetime.now(tz))
-                event.add('uid', f"routine-{r.get('id')}-{event_date.isoformat()}@dailywave.app")
-                event.add('description', f"시간: {time_str}\n구분: {r.get('type')}")
-                cal.add_component(event)
+            dt_start = starts.get(time_str)
+            if dt_start is None:
+                hour, minute = map(int, time_str.split(":"))
+                dt_start = tz.localize(datetime.combine(first_routine_date, time(hour, minute)))
+                starts[time_str] = dt_start
+
+            event = Event()
+            event.add('summary', f"🌊 [루틴] {r.get('title')}")
+            event.add('dtstart', dt_start)
+            event.add('dtend', dt_start + timedelta(minutes=30))
+            event.add('dtstamp', now)
+            event.add('rrule', {'freq': 'daily', 'count': routine_count})
+            event.add('uid', f"routine-{r.get('id')}-daily@dailywave.app")
+            event.add('description', f"시간: {time_str}\n구분: {r.get('type')}")
+            cal.add_component(event)
         except Exception as e:
             print(f"Error processing routine {r.get('id')}: {e}")
 
@@ -48,33 +105,37 @@ def generate_calendar_ics(data: Dict[str, Any]) -> str:
     day_map = {
         "mon": 0, "tue": 1, "wed": 2, "thu": 3, "fri": 4, "sat": 5, "sun": 6
     }
-    
+    past_weeks, future_weeks = options.mission_weeks
+
     for p in pipelines:
         p_id = p.get("id", "")
         if p_id.startswith("week-"):
             day_key = p_id.split("-")[1]
             target_weekday = day_map.get(day_key)
-            
+
             if target_weekday is not None:
-                base_date = datetime.now(tz).date()
-                # Find the next 4 instances of this weekday
-                for i in range(-1, 5): # 1 week past, 5 weeks future
-                    # Calculate date for the target weekday
-                    days_ahead = target_weekday - base_date.weekday()
-                    current_instance = base_date + timedelta(days=days_ahead + (i * 7))
-                    
-                    event = Event()
-                    event.add('summary', f"📅 [미션] {p.get('title')}")
-                    # All day event
-                    event.add('dtstart', current_instance)
-                    event.add('dtend', current_instance + timedelta(days=1))
-                    event.add('dtstamp', datetime.now(tz))
-                    event.add('uid', f"mission-{p.get('id')}-{current_instance.isoformat()}@dailywave.app")
-                    
-                    steps_text = "\n".join([f"- {s.get('title')}: {s.get('description', '')}" for s in p.get("steps", [])])
-                    description = f"{p.get('subtitle')}\n\n주요 과제:\n{steps_text}"
-                    event.add('description', description)
-                    
-                    cal.add_component(event)
+                # This week's instance, `past_weeks` back; then weekly.
+                days_ahead = target_weekday - today.weekday()
+                first_instance = today + timedelta(days=days_ahead - 7 * past_weeks)
+
+                event = Event()
+                event.add('summary', f"📅 [미션] {p.get('title')}")
+                # All day event
+                event.add('dtstart', first_instance)
+                event.add('dtend', first_instance + timedelta(days=1))
+                event.add('dtstamp', now)
+                event.add('rrule', {'freq': 'weekly', 'count': past_weeks + future_weeks})
+                event.add('uid', f"mission-{p_id}-weekly@dailywave.app")
+
+                steps_text = "\n".join([f"- {s.get('title')}: {s.get('description', '')}" for s in p.get("steps", [])])
+                description = f"{p.get('subtitle')}\n\n주요 과제:\n{steps_text}"
+                event.add('description', description)
+
+                cal.add_component(event)
 
+    # TZID on recurring start times needs a matching VTIMEZONE.
+    for tzid in cal.get_missing_tzids():
+        vtimezone = _vtimezone(tzid)
+        if vtimezone is not None:
+            cal.add_component(vtimezone)
     return cal.to_ical().decode('utf-8')
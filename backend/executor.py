@@ -3,6 +3,7 @@ import httpx
 from urllib.parse import urlparse
 from typing import Dict, Any, List
 import logging
+from tracing import span
 from schemas import Workflow, Node, Edge
 
 # Configure logging
@@ -101,7 +102,8 @@ class WorkflowExecutor:
             visited.add(current_node.id)
             
             # Execute
-            result = await self.execute_node(current_node, results)
+            with span("workflow.node", task_type=current_node.data.task_type):
+                result = await self.execute_node(current_node, results)
             results[current_node.id] = result
             
             # Add neighbors
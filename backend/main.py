@@ -1,52 +1,87 @@
 import os
+import asyncio
 import logging
-from contextlib import asynccontextmanager
-from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Request, Response
+import signal
+from contextlib import asynccontextmanager, suppress
+from fastapi import Depends, FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from schemas import Workflow
+from schemas import CalendarSubscription, Workflow
 from executor import WorkflowExecutor
-from storage import StorageManager
-from calendar_gen import generate_calendar_ics
+from storage import DATA_DIR, StorageManager
+from calendar_feed import PUBLIC_FEED_FUTURE_DAYS, PUBLIC_FEED_PAST_DAYS, CalendarFeedCache, CalendarFeedStore
+from calendar_gen import CALENDAR_TIMEZONE, CalendarOptions
 from auth import APIKeyAuthMiddleware
-from ai_proxy import router as ai_router
-from memory_service import memorize_user_action
-from supabase_auth import get_supabase_user_id_from_request
+from rate_limiter import RateLimitMiddleware, enforce_quota, quota_key
+from ai_proxy import close_gemini_clients, router as ai_router
+from admin import router as admin_router
+from memory_service import memorize_user_action, get_memu_client, get_memu_health_interval
+from supabase_auth import require_supabase_user, warm_jwks_cache
+from settings import get_settings, load_env_file, reload_settings
+from metrics import MetricsMiddleware, metrics_response
+from tracing import TracingMiddleware, get_trace_exporter
+from profiler import LoopLagMonitor
 import supabase_admin
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 
-load_dotenv()
+load_env_file()
 logger = logging.getLogger(__name__)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    import httpx
-    memu_url = os.getenv("MEMU_URL", "http://localhost:8100")
-    try:
-        async with httpx.AsyncClient(timeout=3.0) as client:
-            r = await client.get(f"{memu_url}/health")
-            if r.status_code == 200:
-                logger.info("memU connected at %s", memu_url)
-                app.state.memu_available = True
-            else:
-                logger.warning(
-                    "memU responded with status=%s. AI personalization disabled.",
-                    r.status_code,
-                )
-                app.state.memu_available = False
-    except httpx.HTTPError:
+    memu = get_memu_client()
+    app.state.memu_url = memu.base_url
+    app.state.memu_available = await memu.probe()
+    if app.state.memu_available:
+        logger.info("memU connected at %s", memu.base_url)
+    else:
         logger.warning(
             "memU not available at %s. AI personalization disabled (app remains functional).",
-            memu_url,
+            memu.base_url,
         )
-        app.state.memu_available = False
-    except Exception:
-        logger.exception("Unexpected error while checking memU availability.")
-        app.state.memu_available = False
-    app.state.memu_url = memu_url
+
+    def _set_memu_available(available: bool):
+        app.state.memu_available = available
+
+    probe_task = asyncio.create_task(
+        memu.run_health_probe(_set_memu_available, get_memu_health_interval())
+    )
+    # Fetch the Supabase JWKS in the background so RS256 auth never waits on it.
+    jwks_task = asyncio.create_task(warm_jwks_cache())
+    background_tasks = [probe_task, jwks_task]
+    trace_exporter = get_trace_exporter()
+    if trace_exporter.enabled:
+        background_tasks.append(asyncio.create_task(trace_exporter.run()))
+    # Warns, with the offending stack, when something blocks the event loop.
+    lag_threshold = get_settings().loop_lag_threshold
+    if lag_threshold > 0:
+        background_tasks.append(asyncio.create_task(LoopLagMonitor(lag_threshold).run()))
+
+    # `kill -HUP <pid>` re-reads .env and rebuilds settings.
+    loop = asyncio.get_running_loop()
+    sighup_installed = False
+    if hasattr(signal, "SIGHUP"):
+        try:
+            loop.add_signal_handler(signal.SIGHUP, reload_settings, True)
+            sighup_installed = True
+        except (NotImplementedError, RuntimeError, ValueError):
+            logger.info("SIGHUP settings reload unavailable in this environment.")
+
     logger.info("DailyWave API started")
-    yield
+    try:
+        yield
+    finally:
+        if sighup_installed:
+            loop.remove_signal_handler(signal.SIGHUP)
+        for task in background_tasks:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+        # The pooled upstream connections belong to this event loop.
+        await memu.aclose()
+        await close_gemini_clients()
 
 
 app = FastAPI(
@@ -56,8 +91,12 @@ app = FastAPI(
     lifespan=lifespan,
 )
 storage = StorageManager()
+calendar_feed = CalendarFeedCache(storage)
+feed_store = CalendarFeedStore(os.path.join(DATA_DIR, "calendar_feeds"))
 
 app.add_middleware(APIKeyAuthMiddleware)
+# Outside auth so floods are shed before any token verification work.
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -75,7 +114,11 @@ app.add_middleware(
     allow_methods=["GET", "POST", "PUT", "DELETE"],
     allow_headers=["*"],
 )
+# Outermost, so request latency and Server-Timing include CORS, rate limiting and auth.
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 app.include_router(ai_router)
+app.include_router(admin_router)
 
 
 
@@ -94,10 +137,59 @@ async def load_persistence_state():
     return {"status": "loaded", "data": data}
 
 @app.get("/api/calendar/feed")
-async def get_calendar_feed():
-    data = storage.load_state()
-    ics_content = generate_calendar_ics(data)
-    return Response(content=ics_content, media_type="text/calendar")
+async def get_calendar_feed(
+    request: Request,
+    token: Optional[str] = None,
+    tz: str = CALENDAR_TIMEZONE,
+    past_days: int = 7,
+    future_days: int = 30,
+):
+    """Global feed (timezone/horizon from allowlisted query values), or a private feed by `token` (its own settings)."""
+    if token is not None:
+        accept_encoding = request.headers.get("accept-encoding")
+        # Today's files are served from the loop; a date-rollover render runs in a worker thread.
+        stored = feed_store.peek(token, accept_encoding) or await run_in_threadpool(
+            feed_store.open, token, accept_encoding
+        )
+        if stored is None:
+            raise HTTPException(status_code=404, detail="Calendar feed not found")
+        if stored.is_not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+            return Response(status_code=304, headers=stored.headers)
+        return FileResponse(stored.path, media_type="text/calendar; charset=utf-8", headers=stored.headers)
+
+    timezones = (CALENDAR_TIMEZONE, *get_settings().calendar_feed_timezones)
+    if tz not in timezones:
+        raise HTTPException(status_code=400, detail=f"tz must be one of: {', '.join(timezones)}")
+    if past_days not in PUBLIC_FEED_PAST_DAYS or future_days not in PUBLIC_FEED_FUTURE_DAYS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"past_days must be one of {PUBLIC_FEED_PAST_DAYS} and future_days one of {PUBLIC_FEED_FUTURE_DAYS}",
+        )
+    try:
+        options = CalendarOptions(timezone=tz, past_days=past_days, future_days=future_days)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Cache hits are answered on the loop; a render (state read + ICS build) runs in a worker thread.
+    feed = calendar_feed.peek(options) or await run_in_threadpool(calendar_feed.get, options)
+    if feed.is_not_modified(request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+        return Response(status_code=304, headers=feed.headers)
+    return Response(content=feed.body, media_type="text/calendar", headers=feed.headers)
+
+
+@app.put("/api/calendar/subscription")
+async def publish_calendar_subscription(
+    body: CalendarSubscription, request: Request, user_id: str = Depends(require_supabase_user)
+):
+    """Publishes the caller's routines/pipelines as a private ICS feed and returns its secret URL."""
+    token = await run_in_threadpool(feed_store.publish, user_id, body.model_dump(), body.calendar_options())
+    feed_url = request.url_for("get_calendar_feed").include_query_params(token=token)
+    return {"status": "published", "feed_url": str(feed_url)}
+
+
+@app.delete("/api/calendar/subscription", status_code=204)
+async def revoke_calendar_subscription(user_id: str = Depends(require_supabase_user)):
+    feed_store.revoke(user_id)
+    return Response(status_code=204)
 
 
 @app.get("/")
@@ -105,10 +197,12 @@ def read_root():
     return {"status": "ok", "message": "DailyWave API is Running", "version": "1.0.0"}
 
 @app.post("/execute")
-async def execute_workflow(workflow: Workflow):
+async def execute_workflow(workflow: Workflow, request: Request):
     """
     Executes a workflow immediately.
     """
+    # Per-request quota is charged by RateLimitMiddleware; this one is per node.
+    await enforce_quota("workflow_nodes", quota_key("workflow_nodes", request.scope), cost=max(1, len(workflow.nodes)))
     try:
         results = await executor.run(workflow)
         return {"status": "completed", "results": results}
@@ -126,7 +220,7 @@ async def track_user_action(data: Dict[str, Any]):
     return {"status": "tracked"}
 
 @app.delete("/api/auth/account", status_code=204)
-async def delete_ai_account(request: Request):
+async def delete_ai_account(user_id: str = Depends(require_supabase_user)):
     """
     Deletes the caller's Supabase account (used for AI gating).
 
@@ -137,10 +231,15 @@ async def delete_ai_account(request: Request):
       SUPABASE_PROJECT_URL (or SUPABASE_URL)
       SUPABASE_SERVICE_ROLE_KEY
     """
-    user_id = await get_supabase_user_id_from_request(request, required=True)
     await supabase_admin.delete_user(user_id)
     return Response(status_code=204)
 
 @app.get("/health")
 def health_check():
     return {"status": "healthy"}
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus text exposition for this worker process."""
+    return metrics_response()
@@ -3,29 +3,336 @@ memU Integration Service
 사용자 행동 패턴을 memU에 저장하고, AI 추천 시 개인화된 컨텍스트를 제공합니다.
 memU API: http://localhost:8100
 """
-import os
+import re
 import json
+import time
+import asyncio
 import httpx
 import logging
-from typing import Optional
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
 from datetime import datetime
 
+from metrics import cache_lookup, upstream_error
+from settings import get_settings
+from tracing import span
+
 logger = logging.getLogger(__name__)
 
-MEMU_BASE_URL = os.getenv("MEMU_URL", "http://localhost:8100")
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+class MemUUnavailableError(Exception):
+    """서킷이 열려 있어 memU 호출을 건너뜀"""
+
+
+class _CircuitBreaker:
+    """closed → (연속 실패) → open → (reset_timeout 경과) → half_open → 시험 호출 결과로 closed/open"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = self.HALF_OPEN
+            self._trial_in_flight = False
+        return self._state
+
+    def allow_request(self) -> bool:
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self._state = self.CLOSED
+        self._failures = 0
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self.trip()
+
+    def release_trial(self):
+        self._trial_in_flight = False
+
+    def trip(self):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+
+class MemUClient:
+    """memU HTTP 클라이언트: 서킷 브레이커로 장애 시 즉시 실패, 주기적 /health 재확인
+
+    연결 풀을 가진 httpx.AsyncClient 하나를 재사용한다 (요청마다 TCP/TLS 핸드셰이크 없음).
+    첫 호출 시 생성되며 lifespan 종료 시 aclose()로 닫는다.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        failure_threshold: int = 3,
+        reset_timeout: float = 30.0,
+        http_client: Optional[httpx.AsyncClient] = None,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.breaker = _CircuitBreaker(failure_threshold, reset_timeout)
+        self._http = http_client
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(timeout=10.0)
+        return self._http
+
+    async def aclose(self):
+        http, self._http = self._http, None
+        if http is not None:
+            await http.aclose()
+
+    @property
+    def available(self) -> bool:
+        return self.breaker.state != _CircuitBreaker.OPEN
+
+    async def post(self, path: str, payload: dict, timeout: float) -> httpx.Response:
+        if not self.breaker.allow_request():
+            upstream_error("memu", "circuit_open")
+            raise MemUUnavailableError("memU circuit is open")
+        try:
+            response = await self._client().post(f"{self.base_url}{path}", json=payload, timeout=timeout)
+        except asyncio.CancelledError:
+            # Caller gave up (latency budget); says nothing about memU health.
+            self.breaker.release_trial()
+            raise
+        except Exception as e:
+            self.breaker.record_failure()
+            upstream_error("memu", "timeout" if isinstance(e, httpx.TimeoutException) else "error")
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+            upstream_error("memu", str(response.status_code))
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def probe(self) -> bool:
+        """GET /health. 결과로 서킷 상태를 직접 갱신"""
+        try:
+            r = await self._client().get(f"{self.base_url}/health", timeout=3.0)
+            healthy = r.status_code == 200
+            if not healthy:
+                logger.warning("memU responded with status=%s.", r.status_code)
+        except httpx.HTTPError:
+            healthy = False
+        except Exception:
+            logger.exception("Unexpected error while checking memU availability.")
+            healthy = False
+
+        if healthy:
+            self.breaker.record_success()
+        else:
+            self.breaker.trip()
+        return healthy
+
+    async def run_health_probe(self, on_change, interval: float):
+        """interval마다 probe 실행, 가용성이 바뀌면 on_change(bool) 호출"""
+        last = self.available
+        while True:
+            await asyncio.sleep(interval)
+            healthy = await self.probe()
+            if healthy != last:
+                if healthy:
+                    logger.info("memU is reachable again at %s", self.base_url)
+                else:
+                    logger.warning("memU became unreachable at %s; failing fast until it recovers.", self.base_url)
+                on_change(healthy)
+                last = healthy
+
+
+_MEMU_CLIENT: Optional[MemUClient] = None
+
+
+def get_memu_client() -> MemUClient:
+    global _MEMU_CLIENT
+    if _MEMU_CLIENT is None:
+        settings = get_settings()
+        _MEMU_CLIENT = MemUClient(
+            settings.memu_url,
+            failure_threshold=settings.memu_cb_failure_threshold,
+            reset_timeout=settings.memu_cb_reset_seconds,
+        )
+    return _MEMU_CLIENT
+
+
+def get_memu_health_interval() -> float:
+    return get_settings().memu_health_interval
+
+
+def _get_context_cache_ttl() -> float:
+    return get_settings().memu_context_cache_ttl
+
+
+def _normalize_query(query: str) -> str:
+    return _WHITESPACE_RE.sub(" ", (query or "").strip().lower())
+
+
+class _ContextCache:
+    """사용자별 memU retrieve 결과 캐시 (짧은 TTL, memorize 시 무효화)
+
+    동시 조회는 하나의 fetch task를 공유하며, 호출자가 지연 예산 초과로 포기해도
+    fetch는 끝까지 진행되어 캐시를 채운다. 사용자별 generation은 해당 사용자의
+    fetch가 진행 중인 동안만 유지된다 (fetch 도중 memorize가 들어오면 결과 폐기).
+    """
+
+    def __init__(self, max_entries: int = 2048):
+        self._max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, List[str]]]" = OrderedDict()
+        self._keys_by_user: Dict[str, Set[Tuple[str, str]]] = {}
+        # user -> [generation, fetches in flight]; pruned when the last fetch ends.
+        self._generation: Dict[str, List[int]] = {}
+        self._inflight: Dict[Tuple[str, str], "asyncio.Task[List[str]]"] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.invalidations = 0
+
+    def get(self, key: Tuple[str, str]) -> Optional[List[str]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, memories = entry
+        if expires_at <= time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return memories
+
+    def _put(self, key: Tuple[str, str], memories: List[str], ttl: float):
+        user_id = key[0]
+        self._entries[key] = (time.monotonic() + ttl, memories)
+        self._entries.move_to_end(key)
+        self._keys_by_user.setdefault(user_id, set()).add(key)
+        while len(self._entries) > self._max_entries:
+            oldest = next(iter(self._entries))
+            self._drop(oldest)
+
+    async def lookup(
+        self,
+        key: Tuple[str, str],
+        fetch: Callable[[], Awaitable[Optional[List[str]]]],
+        ttl: float,
+    ) -> List[str]:
+        """Cached memories for `key`, else the result of one shared `fetch` (None = failed, not cached)."""
+        cached = self.get(key)
+        cache_lookup("memu_context", cached is not None)
+        if cached is not None:
+            self.hits += 1
+            return cached
+        self.misses += 1
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fill(key, fetch, ttl))
+            self._inflight[key] = task
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _fill(self, key: Tuple[str, str], fetch, ttl: float) -> List[str]:
+        user_id = key[0]
+        state = self._generation.setdefault(user_id, [0, 0])
+        state[1] += 1
+        generation = state[0]
+        try:
+            fetched = await fetch()
+            if fetched is None:
+                return []
+            # A memorize that landed while we were fetching makes this result stale.
+            if ttl > 0 and state[0] == generation:
+                self._put(key, fetched, ttl)
+            return fetched
+        finally:
+            self._inflight.pop(key, None)
+            state[1] -= 1
+            if state[1] == 0:
+                self._generation.pop(user_id, None)
+
+    def invalidate_user(self, user_id: str):
+        state = self._generation.get(user_id)
+        if state is not None:
+            state[0] += 1
+        for key in self._keys_by_user.pop(user_id, set()):
+            self._entries.pop(key, None)
+        self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_user.clear()
+        self._generation.clear()
+        self._inflight.clear()
+        self.hits = self.misses = self.coalesced = self.invalidations = 0
+
+    def _drop(self, key: Tuple[str, str]):
+        self._entries.pop(key, None)
+        keys = self._keys_by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                self._keys_by_user.pop(key[0], None)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "invalidations": self.invalidations,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_CONTEXT_CACHE = _ContextCache()
+
+
+def get_context_cache_stats() -> Dict[str, float]:
+    return _CONTEXT_CACHE.stats()
+
+
+def clear_context_cache():
+    _CONTEXT_CACHE.clear()
+
+
+# Actions that do not change what /retrieve returns for the user's queries; recording
+# them must not throw away the context cache (every /api/ai/ask records one).
+_NON_INVALIDATING_ACTIONS = {"ai_interaction"}
 
 
 async def memorize_user_action(user_id: str, action_type: str, data: dict):
-    """사용자 행동을 memU에 기록"""
+    """사용자 행동을 memU에 기록 (성공 시 해당 사용자 컨텍스트 캐시 무효화)"""
     try:
         content = (
             f"[{datetime.now().isoformat()}] User {user_id} - {action_type}\n"
             f"Data: {json.dumps(data, ensure_ascii=False, default=str)}"
         )
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            await client.post(
-                f"{MEMU_BASE_URL}/memorize",
-                json={
+        with span("memu.memorize"):
+            response = await get_memu_client().post(
+                "/memorize",
+                {
                     "content": content,
                     "metadata": {
                         "user_id": user_id,
@@ -33,44 +340,70 @@ async def memorize_user_action(user_id: str, action_type: str, data: dict):
                         "source": "dailywave",
                     },
                 },
+                timeout=10.0,
             )
+    except MemUUnavailableError:
+        logger.debug("memU memorize skipped: circuit open")
+        return
     except Exception as e:
         logger.warning(f"memU memorize failed (non-critical): {e}")
+        return
+    if 200 <= response.status_code < 300 and action_type not in _NON_INVALIDATING_ACTIONS:
+        _CONTEXT_CACHE.invalidate_user(user_id)
 
 
-async def retrieve_user_context(user_id: str, query: str) -> Optional[str]:
-    """memU에서 사용자 관련 컨텍스트를 가져옴"""
+async def _fetch_user_memories(user_id: str, query: str) -> Optional[List[str]]:
+    """memU /retrieve 호출. 실패 시 None (캐시하지 않음)"""
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.post(
-                f"{MEMU_BASE_URL}/retrieve",
-                json={
+        with span("memu.retrieve"):
+            response = await get_memu_client().post(
+                "/retrieve",
+                {
                     "query": f"user:{user_id} {query}",
                     "top_k": 5,
                 },
+                timeout=10.0,
             )
-            if response.status_code == 200:
-                data = response.json()
-                memories = data.get("memories", data.get("results", []))
-                if memories:
-                    return "\n".join(
-                        m.get("content", m.get("text", "")) for m in memories if m
-                    )
+        if response.status_code == 200:
+            data = response.json()
+            memories = data.get("memories", data.get("results", []))
+            return [
+                m.get("content", m.get("text", "")) for m in (memories or []) if m
+            ]
+    except MemUUnavailableError:
+        logger.debug("memU retrieve skipped: circuit open")
     except Exception as e:
         logger.warning(f"memU retrieve failed (non-critical): {e}")
     return None
 
 
+async def retrieve_user_memories(user_id: str, query: str) -> List[str]:
+    """memU에서 사용자 관련 메모리 목록을 가져옴 (캐시 + 동시 요청 병합)"""
+    return await _CONTEXT_CACHE.lookup(
+        (user_id, _normalize_query(query)),
+        lambda: _fetch_user_memories(user_id, query),
+        _get_context_cache_ttl(),
+    )
+
+
+async def retrieve_user_context(user_id: str, query: str) -> Optional[str]:
+    """memU에서 사용자 관련 컨텍스트를 가져옴"""
+    memories = await retrieve_user_memories(user_id, query)
+    if memories:
+        return "\n".join(memories)
+    return None
+
+
 async def check_similar(content: str) -> bool:
     """중복 콘텐츠 확인"""
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.post(
-                f"{MEMU_BASE_URL}/check-similar",
-                json={"content": content},
-            )
-            if response.status_code == 200:
-                return response.json().get("is_similar", False)
+        response = await get_memu_client().post(
+            "/check-similar",
+            {"content": content},
+            timeout=5.0,
+        )
+        if response.status_code == 200:
+            return response.json().get("is_similar", False)
     except Exception:
         pass
     return False
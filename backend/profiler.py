@@ -0,0 +1,207 @@
+"""
+Production diagnostics: an on-demand sampling profiler and an event-loop lag monitor.
+
+The profiler collects Python stacks for a bounded time and returns them as
+collapsed stacks (`thread;outer (file:line);...;leaf (file:line) N`), the input
+format of flamegraph.pl, speedscope and inferno. Only one profile runs at a
+time. Served by GET /api/admin/profile when PROFILER_ENABLED is set. Modes:
+- cpu: a SIGPROF interval timer interrupts the event loop thread (it must be
+  the main thread, as under uvicorn) in proportion to the CPU time the process
+  burns, and records the frame it was running. This is the accurate view of
+  where the loop spends CPU.
+- wall: a background thread reads every thread's stack with
+  `sys._current_frames()` at a fixed interval. It covers worker threads too,
+  but sees a busy event loop mostly at its GIL release point (`select`), so
+  short callbacks are under-counted.
+
+LoopLagMonitor runs a heartbeat task on the event loop. When a callback holds
+the loop past LOOP_LAG_THRESHOLD_MS, a watchdog thread records the loop
+thread's stack while it is still blocked, and the warning logged once the loop
+resumes names the blocking code (e.g. a synchronous json.dump in a handler).
+"""
+import asyncio
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+from typing import Dict, Optional, Set
+
+from metrics import REGISTRY, Histogram
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG_SECONDS = REGISTRY.register(Histogram(
+    "dailywave_event_loop_lag_seconds",
+    "How late the event loop heartbeat woke up (time the loop was blocked).",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
+))
+
+_BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# Leaf frames of threads that are parked, not working; dropped unless idle stacks are requested.
+_IDLE_LEAVES = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+
+
+class ProfilerBusyError(RuntimeError):
+    pass
+
+
+def _short_path(filename: str) -> str:
+    if filename.startswith(_BACKEND_DIR + os.sep):
+        return os.path.relpath(filename, _BACKEND_DIR)
+    marker = "site-packages" + os.sep
+    if marker in filename:
+        return filename.split(marker, 1)[1]
+    return os.path.basename(filename)
+
+
+class StackSampler:
+    """Counts collapsed stacks, from `sample_threads` (wall mode) or `add` (cpu mode)."""
+
+    def __init__(self, interval: float = 0.005, include_idle: bool = False, mode: str = "wall"):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.mode = mode
+        self.counts: Dict[str, int] = {}
+        self.samples = 0
+        self._labels: Dict[object, str] = {}
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def add(self, thread_name: str, frame):
+        code = frame.f_code
+        if not self.include_idle and (os.path.basename(code.co_filename), code.co_name) in _IDLE_LEAVES:
+            return
+        stack = []
+        while frame is not None:
+            stack.append(self._label(frame.f_code))
+            frame = frame.f_back
+        stack.append(thread_name.replace(" ", "_"))
+        key = ";".join(reversed(stack))
+        self.counts[key] = self.counts.get(key, 0) + 1
+
+    def sample_threads(self, skip: Set[int]):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id not in skip:
+                self.add(names.get(thread_id, f"thread-{thread_id}"), frame)
+        self.samples += 1
+
+    def run(self, duration: float):
+        """Samples all threads for `duration` seconds (blocking; call from a worker thread)."""
+        skip = {threading.get_ident()}
+        deadline = time.monotonic() + duration
+        next_at = time.monotonic()
+        while next_at < deadline:
+            self.sample_threads(skip)
+            next_at += self.interval
+            delay = next_at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+
+def cpu_mode_available() -> bool:
+    """SIGPROF sampling works on Unix when the caller (the event loop) runs on the main thread."""
+    return hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+
+
+_PROFILE_LOCK = threading.Lock()
+
+
+async def profile(
+    duration: float,
+    interval: float = 0.005,
+    include_idle: bool = False,
+    mode: Optional[str] = None,
+) -> StackSampler:
+    """Profiles the live process for `duration` seconds without blocking the loop.
+
+    `mode` is "cpu" or "wall" (see the module docstring); by default cpu when
+    available. One profile at a time; raises ProfilerBusyError otherwise.
+    """
+    mode = mode or ("cpu" if cpu_mode_available() else "wall")
+    if mode == "cpu" and not cpu_mode_available():
+        raise ValueError("cpu mode needs the event loop on the main thread of a Unix process")
+    if not _PROFILE_LOCK.acquire(blocking=False):
+        raise ProfilerBusyError("A profile is already running")
+    try:
+        sampler = StackSampler(interval, include_idle, mode)
+        if mode == "wall":
+            await asyncio.to_thread(sampler.run, duration)
+            return sampler
+
+        thread_name = threading.current_thread().name
+
+        def on_sigprof(signum, frame):
+            sampler.samples += 1
+            sampler.add(thread_name, frame)
+
+        previous = signal.signal(signal.SIGPROF, on_sigprof)
+        try:
+            signal.setitimer(signal.ITIMER_PROF, interval, interval)
+            await asyncio.sleep(duration)
+        finally:
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, previous)
+        return sampler
+    finally:
+        _PROFILE_LOCK.release()
+
+
+class LoopLagMonitor:
+    """Warns (with the blocking stack) when the event loop is blocked longer than `threshold` seconds."""
+
+    def __init__(self, threshold: float, interval: Optional[float] = None):
+        self.threshold = threshold
+        self.interval = interval if interval is not None else min(0.05, threshold / 2)
+        self.stalls = 0
+        self._beat = 0.0
+        self._loop_thread: Optional[int] = None
+        self._blocked_stack: Optional[str] = None
+        self._stop = threading.Event()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            if self._blocked_stack is None and time.monotonic() - self._beat > self.threshold:
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is not None:
+                    self._blocked_stack = "".join(traceback.format_stack(frame)[-20:])
+
+    async def run(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name="loop-lag-watchdog", daemon=True).start()
+        try:
+            while True:
+                self._beat = started = time.monotonic()
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.monotonic() - started - self.interval)
+                LOOP_LAG_SECONDS.observe(lag)
+                if lag > self.threshold:
+                    self.stalls += 1
+                    stack, self._blocked_stack = self._blocked_stack, None
+                    logger.warning(
+                        "Event loop blocked for %.0f ms (threshold %.0f ms)%s",
+                        lag * 1000,
+                        self.threshold * 1000,
+                        f"; loop thread was in:\n{stack}" if stack else "",
+                    )
+                else:
+                    self._blocked_stack = None
+        finally:
+            self._stop.set()
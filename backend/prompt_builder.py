@@ -0,0 +1,201 @@
+"""
+Prompt context builder for the AI proxy.
+
+Keeps the Gemini input within a token budget: the user request and system
+prompt are always sent, the client `context` dict is compacted (old history
+dropped, long lists capped with counts) and memU memories are ranked and
+trimmed to whatever budget remains.
+"""
+import bisect
+import json
+import re
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Sequence
+
+from settings import get_settings
+
+_DATE_KEYS = ("at", "createdAt", "completedAt", "updatedAt", "date", "timestamp")
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_MEMORY_MAX_CHARS = 600
+
+
+def get_input_token_budget() -> int:
+    return get_settings().ai_input_token_budget
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate: ~4 ASCII chars per token, ~1 token per non-ASCII char (e.g. Hangul)."""
+    if not text:
+        return 0
+    extra_bytes = len(text.encode("utf-8")) - len(text)
+    return (len(text) + 3) // 4 + extra_bytes // 2
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Longest prefix of `text` whose estimate_tokens() fits in `max_tokens` (bisects on the estimate)."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    end = bisect.bisect_right(range(len(text) + 1), max_tokens, key=lambda n: estimate_tokens(text[:n])) - 1
+    return text[:end]
+
+
+def estimate_request_tokens(
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    context: Optional[dict] = None,
+    max_tokens: int = 0,
+    memory_allowance: int = 750,
+) -> int:
+    """Upper-bound estimate (input within budget + max output) used to reserve AI token quota."""
+    input_tokens = estimate_tokens(prompt) + estimate_tokens(system_prompt or "") + memory_allowance
+    if context:
+        input_tokens += estimate_tokens(_dump_context(context))
+    return min(input_tokens, get_input_token_budget()) + max(0, max_tokens)
+
+
+@dataclass(frozen=True)
+class BuiltPrompt:
+    text: str
+    estimated_tokens: int
+    budget: int
+    memories_used: int
+    memories_dropped: int
+    context_compacted: bool
+
+    def metadata(self) -> Dict[str, Any]:
+        return {
+            "estimated_tokens": self.estimated_tokens,
+            "budget": self.budget,
+            "memories_used": self.memories_used,
+            "memories_dropped": self.memories_dropped,
+            "context_compacted": self.context_compacted,
+        }
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if not isinstance(value, str) or len(value) < 10:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def _item_timestamp(item: Any) -> Optional[datetime]:
+    if not isinstance(item, dict):
+        return None
+    for key in _DATE_KEYS:
+        ts = _parse_timestamp(item.get(key))
+        if ts is not None:
+            return ts
+    return None
+
+
+def compact_context(value: Any, cutoff: datetime, max_items: int) -> Any:
+    """Drops dated list entries older than `cutoff` and caps lists at `max_items` (most recent kept)."""
+    if isinstance(value, dict):
+        out: Dict[str, Any] = {}
+        for key, item in value.items():
+            compacted = compact_context(item, cutoff, max_items)
+            out[key] = compacted
+            if isinstance(item, list) and isinstance(compacted, list) and len(compacted) < len(item):
+                out[f"{key}_summary"] = {"total": len(item), "included": len(compacted)}
+        return out
+    if isinstance(value, list):
+        items = [
+            item for item in value
+            if (_item_timestamp(item) or cutoff) >= cutoff
+        ]
+        if len(items) > max_items:
+            items = items[-max_items:]
+        return [compact_context(item, cutoff, max_items) for item in items]
+    return value
+
+
+def rank_memories(memories: Sequence[str], prompt: str) -> List[str]:
+    """Dedupes memories and orders them by word overlap with the prompt, keeping memU's order as tie-breaker."""
+    prompt_words = {w.lower() for w in _WORD_RE.findall(prompt or "")}
+    seen = set()
+    scored = []
+    for position, memory in enumerate(memories):
+        text = (memory or "").strip()
+        if not text or text in seen:
+            continue
+        seen.add(text)
+        overlap = len(prompt_words & {w.lower() for w in _WORD_RE.findall(text)})
+        scored.append((-overlap, position, text))
+    scored.sort()
+    return [text for _, _, text in scored]
+
+
+def _dump_context(context: Any) -> str:
+    return json.dumps(context, ensure_ascii=False, separators=(",", ":"), default=str)
+
+
+def build_prompt(
+    prompt: str,
+    system_prompt: Optional[str] = None,
+    memories: Optional[Sequence[str]] = None,
+    context: Optional[dict] = None,
+    budget: Optional[int] = None,
+    now: Optional[datetime] = None,
+) -> BuiltPrompt:
+    budget = budget or get_input_token_budget()
+    now = now or datetime.now(timezone.utc)
+
+    head = f"{system_prompt}\n\n" if system_prompt else ""
+    tail = f"User request: {prompt}"
+    remaining = budget - estimate_tokens(head) - estimate_tokens(tail)
+
+    context_text = ""
+    context_compacted = False
+    if context:
+        settings = get_settings()
+        history_days = settings.ai_context_history_days
+        max_items = settings.ai_context_max_list_items
+        cutoff = now - timedelta(days=history_days)
+        dumped = _dump_context(context)
+        compacted = compact_context(context, cutoff, max_items)
+        context_text = _dump_context(compacted)
+        context_compacted = context_text != dumped
+        # Halve list caps until the context fits in what is left of the budget.
+        while estimate_tokens(context_text) > remaining and max_items > 1:
+            max_items //= 2
+            context_text = _dump_context(compact_context(context, cutoff, max_items))
+            context_compacted = True
+        if estimate_tokens(context_text) > remaining:
+            # Cut by estimated tokens, not chars: Hangul costs more than 4 chars' worth per char.
+            context_text = truncate_to_tokens(context_text, remaining - estimate_tokens("Context: \n\n"))
+            context_compacted = True
+        context_text = f"Context: {context_text}\n\n" if context_text else ""
+        remaining -= estimate_tokens(context_text)
+
+    ranked = rank_memories(memories or [], prompt)
+    selected: List[str] = []
+    header = "User memory (past patterns & preferences):\n"
+    remaining -= estimate_tokens(header)
+    for memory in ranked:
+        if len(memory) > _MEMORY_MAX_CHARS:
+            memory = memory[:_MEMORY_MAX_CHARS] + "…"
+        cost = estimate_tokens(memory) + 1
+        if cost > remaining:
+            continue
+        selected.append(memory)
+        remaining -= cost
+    memory_text = header + "\n".join(selected) + "\n\n" if selected else ""
+
+    text = head + memory_text + context_text + tail
+    return BuiltPrompt(
+        text=text,
+        estimated_tokens=estimate_tokens(text),
+        budget=budget,
+        memories_used=len(selected),
+        memories_dropped=len(ranked) - len(selected),
+        context_compacted=context_compacted,
+    )
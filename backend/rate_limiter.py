@@ -1,23 +1,41 @@
 import asyncio
-import os
+import hashlib
+import itertools
+import logging
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Tuple
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+from urllib.parse import parse_qs
 
+from fastapi import HTTPException
+from starlette.responses import JSONResponse
 
-def _parse_int_env(name: str, default: int) -> int:
-    raw = os.getenv(name, "")
-    try:
-        value = int(raw)
-        return value if value > 0 else default
-    except Exception:
-        return default
+from metrics import RATE_LIMIT_DENIALS
+from settings import QuotaPolicy, get_settings
 
+logger = logging.getLogger(__name__)
 
-def _get_ai_limits() -> Tuple[int, int]:
-    per_minute = _parse_int_env("AI_RATE_LIMIT_PER_MINUTE", 30)
-    per_hour = _parse_int_env("AI_RATE_LIMIT_PER_HOUR", 300)
-    return per_minute, per_hour
+
+# (method, path) -> policy charged once per request by RateLimitMiddleware.
+ROUTE_POLICIES = {
+    ("POST", "/execute"): "workflow",
+    ("POST", "/api/persistence/save"): "persistence_save",
+    ("PUT", "/api/calendar/subscription"): "persistence_save",
+    ("POST", "/api/memory/track"): "memory_track",
+    ("GET", "/api/calendar/feed"): "calendar_feed",
+}
+
+# Overrides for requests carrying a secret `?token=` (private calendar feeds):
+# hosted calendar fetchers poll from shared egress IPs, so these are charged
+# per token rather than per IP.
+TOKEN_ROUTE_POLICIES = {
+    ("GET", "/api/calendar/feed"): "calendar_feed_token",
+}
+
+
+def get_policy(name: str) -> QuotaPolicy:
+    return get_settings().quota_policies[name]
 
 
 @dataclass(frozen=True)
@@ -27,67 +45,118 @@ class RateLimitDecision:
     limit_per_minute: int
     limit_per_hour: int
     enforced: bool = True
+    # Tokens left in the tighter of the two buckets, when the backend reports it.
+    remaining: Optional[int] = None
 
 
-class _InMemoryDualTokenBucket:
+class BucketCharge(NamedTuple):
+    key: str
+    per_minute: int
+    per_hour: int
+    cost: int
+    want: int = 0
+    force: bool = False
+
+
+class _BucketState:
+    __slots__ = ("m_tokens", "h_tokens", "last", "full_at")
+
+    def __init__(self, m_tokens: float, h_tokens: float, now: float):
+        self.m_tokens = m_tokens
+        self.h_tokens = h_tokens
+        self.last = now
+        self.full_at = now
+
+
+class _Shard:
+    __slots__ = ("lock", "state")
+
     def __init__(self):
-        self._lock = asyncio.Lock()
-        self._state = {}
+        self.lock = asyncio.Lock()
+        # Insertion order doubles as LRU order: touched keys are re-inserted at the end.
+        self.state = {}
+
 
-    async def consume(self, key: str, per_minute: int, per_hour: int, cost: int = 1) -> RateLimitDecision:
-        # Token bucket: minute + hour buckets; both must allow.
+class _InMemoryDualTokenBucket:
+    # Entries looked at per consume when sweeping refilled (idle) keys.
+    _SWEEP_BATCH = 8
+
+    def __init__(self, shards: int = 16, max_keys: int = 100_000, clock=time.monotonic):
+        self._shards = [_Shard() for _ in range(max(1, shards))]
+        self._max_keys_per_shard = max(1, max_keys // len(self._shards))
+        self._clock = clock
+        self.evictions = 0
+
+    def _shard_for(self, key: str) -> _Shard:
+        return self._shards[hash(key) % len(self._shards)]
+
+    def __len__(self) -> int:
+        return sum(len(shard.state) for shard in self._shards)
+
+    def _evict(self, shard: _Shard, now: float):
+        state = shard.state
+        # Keys whose buckets are back at capacity carry no information: drop them.
+        for key in list(itertools.islice(state, self._SWEEP_BATCH)):
+            if state[key].full_at <= now:
+                del state[key]
+                self.evictions += 1
+        # Hard bound (e.g. IP spray): drop least recently used keys.
+        while len(state) > self._max_keys_per_shard:
+            del state[next(iter(state))]
+            self.evictions += 1
+
+    async def consume(
+        self, key: str, per_minute: int, per_hour: int, cost: int = 1, force: bool = False
+    ) -> RateLimitDecision:
+        """Token bucket: minute + hour buckets; both must allow.
+
+        With `force`, `cost` is applied unconditionally: a negative cost refunds
+        (capped at capacity), a positive one may push the buckets into debt.
+        """
         cap_m = float(per_minute)
         cap_h = float(per_hour)
         rate_m = cap_m / 60.0
         rate_h = cap_h / 3600.0
 
-        now = time.monotonic()
-
-        async with self._lock:
-            st = self._state.get(key) or {
-                "m_tokens": cap_m,
-                "m_last": now,
-                "h_tokens": cap_h,
-                "h_last": now,
-            }
-
-            # Refill minute
-            m_last = float(st.get("m_last") or now)
-            m_tokens_raw = st.get("m_tokens")
-            m_tokens = float(m_tokens_raw) if isinstance(m_tokens_raw, (int, float)) else cap_m
-            m_delta = max(0.0, now - m_last)
-            m_tokens = min(cap_m, m_tokens + (m_delta * rate_m))
-
-            # Refill hour
-            h_last = float(st.get("h_last") or now)
-            h_tokens_raw = st.get("h_tokens")
-            h_tokens = float(h_tokens_raw) if isinstance(h_tokens_raw, (int, float)) else cap_h
-            h_delta = max(0.0, now - h_last)
-            h_tokens = min(cap_h, h_tokens + (h_delta * rate_h))
-
-            # Save refilled state baseline
-            st.update({"m_tokens": m_tokens, "m_last": now, "h_tokens": h_tokens, "h_last": now})
-
-            if m_tokens < cost or h_tokens < cost:
-                retry_m = int(((cost - m_tokens) / rate_m) + 0.999) if m_tokens < cost else 0
-                retry_h = int(((cost - h_tokens) / rate_h) + 0.999) if h_tokens < cost else 0
-                self._state[key] = st
+        shard = self._shard_for(key)
+        async with shard.lock:
+            now = self._clock()
+            st = shard.state.pop(key, None)
+            if st is None:
+                st = _BucketState(cap_m, cap_h, now)
+            else:
+                delta = max(0.0, now - st.last)
+                st.m_tokens = min(cap_m, st.m_tokens + (delta * rate_m))
+                st.h_tokens = min(cap_h, st.h_tokens + (delta * rate_h))
+                st.last = now
+
+            allowed = force or (st.m_tokens >= cost and st.h_tokens >= cost)
+            if allowed:
+                st.m_tokens = min(cap_m, st.m_tokens - cost)
+                st.h_tokens = min(cap_h, st.h_tokens - cost)
+
+            st.full_at = now + max((cap_m - st.m_tokens) / rate_m, (cap_h - st.h_tokens) / rate_h, 0.0)
+            shard.state[key] = st
+            self._evict(shard, now)
+            remaining = max(0, int(min(st.m_tokens, st.h_tokens)))
+
+            if not allowed:
+                retry_m = int(((cost - st.m_tokens) / rate_m) + 0.999) if st.m_tokens < cost else 0
+                retry_h = int(((cost - st.h_tokens) / rate_h) + 0.999) if st.h_tokens < cost else 0
                 return RateLimitDecision(
                     allowed=False,
                     retry_after_seconds=max(retry_m, retry_h, 1),
                     limit_per_minute=per_minute,
                     limit_per_hour=per_hour,
+                    remaining=remaining,
                 )
 
-            # Consume
-            st["m_tokens"] = m_tokens - cost
-            st["h_tokens"] = h_tokens - cost
-            self._state[key] = st
             return RateLimitDecision(
                 allowed=True,
                 retry_after_seconds=0,
                 limit_per_minute=per_minute,
                 limit_per_hour=per_hour,
+                remaining=remaining,
             )
 
 
@@ -101,6 +170,9 @@ _REDIS_SCRIPT = r"""
 -- ARGV[5] = now_ms
 -- ARGV[6] = cost
 -- ARGV[7] = ttl_seconds
+-- ARGV[8] = want (optional lease size >= cost; grants up to this many tokens)
+-- ARGV[9] = force (optional; 1 = apply cost unconditionally, negative cost refunds)
+-- Returns {allowed, retry_after, granted, remaining}
 local cap_m = tonumber(ARGV[1])
 local rate_m = tonumber(ARGV[2])
 local cap_h = tonumber(ARGV[3])
@@ -108,6 +180,9 @@ local rate_h = tonumber(ARGV[4])
 local now_ms = tonumber(ARGV[5])
 local cost = tonumber(ARGV[6])
 local ttl = tonumber(ARGV[7])
+local want = tonumber(ARGV[8]) or cost
+if want < cost then want = cost end
+local force = tonumber(ARGV[9]) or 0
 
 local data = redis.call('HMGET', KEYS[1], 'm_tokens', 'm_last_ms', 'h_tokens', 'h_last_ms')
 local m_tokens = tonumber(data[1])
@@ -132,6 +207,13 @@ h_tokens = math.min(cap_h, h_tokens + (h_delta / 1000.0) * rate_h)
 redis.call('HMSET', KEYS[1], 'm_tokens', m_tokens, 'm_last_ms', now_ms, 'h_tokens', h_tokens, 'h_last_ms', now_ms)
 redis.call('EXPIRE', KEYS[1], ttl)
 
+if force == 1 then
+  m_tokens = math.min(cap_m, m_tokens - cost)
+  h_tokens = math.min(cap_h, h_tokens - cost)
+  redis.call('HMSET', KEYS[1], 'm_tokens', m_tokens, 'h_tokens', h_tokens)
+  return {1, 0, cost, math.max(0, math.floor(math.min(m_tokens, h_tokens)))}
+end
+
 local allowed = 1
 local retry_after = 0
 
@@ -147,23 +229,39 @@ end
 
 if allowed == 0 then
   if retry_after < 1 then retry_after = 1 end
-  return {0, retry_after}
+  return {0, retry_after, 0, math.max(0, math.floor(math.min(m_tokens, h_tokens)))}
 end
 
--- Consume from both
-m_tokens = m_tokens - cost
-h_tokens = h_tokens - cost
+-- Consume from both: at least cost, up to want while tokens remain
+local grant = math.floor(math.min(want, m_tokens, h_tokens))
+if grant < cost then grant = cost end
+m_tokens = m_tokens - grant
+h_tokens = h_tokens - grant
 redis.call('HMSET', KEYS[1], 'm_tokens', m_tokens, 'h_tokens', h_tokens)
-return {1, 0}
+return {1, 0, grant, math.max(0, math.floor(math.min(m_tokens, h_tokens)))}
 """
 
 
+def _is_noscript_error(exc: Exception) -> bool:
+    # Redis restarted / SCRIPT FLUSH: cached SHA is gone and must be reloaded.
+    return type(exc).__name__ == "NoScriptError" or str(exc).startswith("NOSCRIPT")
+
+
 class _RedisDualTokenBucket:
-    def __init__(self, redis_url: str):
+    _BACKOFF_MIN_SECONDS = 1.0
+    _BACKOFF_MAX_SECONDS = 30.0
+    _TTL_SECONDS = 2 * 3600
+
+    def __init__(self, redis_url: str, max_connections: int = 50, socket_timeout: float = 0.5):
         self._redis_url = redis_url
+        self._max_connections = max_connections
+        self._socket_timeout = socket_timeout
         self._redis = None
         self._script_sha = None
         self._lock = asyncio.Lock()
+        # After a Redis error, skip Redis (callers fall back to memory) until this time.
+        self._unavailable_until = 0.0
+        self._backoff = 0.0
 
     async def _get_redis(self):
         if self._redis is not None:
@@ -174,86 +272,285 @@ class _RedisDualTokenBucket:
         except Exception:
             return None
 
-        self._redis = redis.from_url(self._redis_url)
+        self._redis = redis.from_url(
+            self._redis_url,
+            max_connections=self._max_connections,
+            socket_timeout=self._socket_timeout,
+            socket_connect_timeout=self._socket_timeout,
+            health_check_interval=30,
+        )
         return self._redis
 
-    async def _ensure_script(self):
-        if self._script_sha:
-            return self._script_sha
-
+    async def _load_script(self, r, stale_sha=None) -> str:
         async with self._lock:
-            if self._script_sha:
+            if self._script_sha and self._script_sha != stale_sha:
                 return self._script_sha
-            r = await self._get_redis()
-            if not r:
-                return None
+            self._script_sha = await r.script_load(_REDIS_SCRIPT)
+            return self._script_sha
+
+    def _mark_failure(self):
+        if not self._backoff:
+            logger.warning("Redis rate limiter unavailable; using in-memory limits until it recovers.")
+        self._backoff = min(
+            self._BACKOFF_MAX_SECONDS,
+            max(self._BACKOFF_MIN_SECONDS, self._backoff * 2),
+        )
+        self._unavailable_until = time.monotonic() + self._backoff
+
+    def _mark_success(self):
+        if self._backoff:
+            logger.info("Redis rate limiter recovered.")
+        self._backoff = 0.0
+        self._unavailable_until = 0.0
+
+    def _script_args(self, charge: "BucketCharge") -> list:
+        cap_m = float(charge.per_minute)
+        cap_h = float(charge.per_hour)
+        return [
+            charge.key,
+            cap_m,
+            cap_m / 60.0,
+            cap_h,
+            cap_h / 3600.0,
+            int(time.time() * 1000),
+            int(charge.cost),
+            self._TTL_SECONDS,
+            int(max(charge.want, charge.cost)),
+            1 if charge.force else 0,
+        ]
+
+    async def _run(self, r, calls: List[list]) -> list:
+        """EVALSHA each call in one pipelined round trip, reloading the script once on NOSCRIPT."""
+        sha = self._script_sha or await self._load_script(r)
+        for attempt in range(2):
             try:
-                self._script_sha = await r.script_load(_REDIS_SCRIPT)
-                return self._script_sha
-            except Exception:
-                return None
+                if len(calls) == 1:
+                    return [await r.evalsha(sha, 1, *calls[0])]
+                async with r.pipeline(transaction=False) as pipe:
+                    for args in calls:
+                        pipe.evalsha(sha, 1, *args)
+                    return await pipe.execute()
+            except Exception as e:
+                if attempt or not _is_noscript_error(e):
+                    raise
+                sha = await self._load_script(r, stale_sha=sha)
+        return []
+
+    @property
+    def redis_url(self) -> str:
+        return self._redis_url
+
+    async def consume(
+        self, key: str, per_minute: int, per_hour: int, cost: int = 1, force: bool = False
+    ) -> RateLimitDecision:
+        results = await self.consume_many([BucketCharge(key, per_minute, per_hour, cost, force=force)])
+        return results[0][0]
+
+    async def consume_chunk(
+        self, key: str, per_minute: int, per_hour: int, cost: int, want: int
+    ) -> Tuple[RateLimitDecision, int]:
+        """Consumes `cost` tokens and, while the buckets allow, up to `want` in total.
+
+        Returns the decision and the number of tokens actually granted.
+        """
+        results = await self.consume_many([BucketCharge(key, per_minute, per_hour, cost, want=want)])
+        return results[0]
+
+    async def consume_many(self, charges: Sequence["BucketCharge"]) -> List[Tuple[RateLimitDecision, int]]:
+        """Pipelined consume of several buckets in one round trip.
+
+        Each bucket is charged independently (not atomically across keys).
+        """
+        fallback = [
+            (RateLimitDecision(True, 0, c.per_minute, c.per_hour, enforced=False), 0)
+            for c in charges
+        ]
+        if time.monotonic() < self._unavailable_until:
+            return fallback
 
-    async def consume(self, key: str, per_minute: int, per_hour: int, cost: int = 1) -> RateLimitDecision:
         r = await self._get_redis()
         if not r:
             # fallback to allow (or caller will fallback to memory limiter)
-            return RateLimitDecision(True, 0, per_minute, per_hour, enforced=False)
-
-        sha = await self._ensure_script()
-        if not sha:
-            return RateLimitDecision(True, 0, per_minute, per_hour, enforced=False)
-
-        cap_m = float(per_minute)
-        cap_h = float(per_hour)
-        rate_m = cap_m / 60.0
-        rate_h = cap_h / 3600.0
-        now_ms = int(time.time() * 1000)
-        ttl_seconds = 2 * 3600
+            return fallback
 
         try:
-            allowed, retry_after = await r.evalsha(
-                sha,
-                1,
-                key,
-                cap_m,
-                rate_m,
-                cap_h,
-                rate_h,
-                now_ms,
-                int(cost),
-                int(ttl_seconds),
-            )
+            replies = await self._run(r, [self._script_args(c) for c in charges])
+        except Exception:
+            self._mark_failure()
+            return fallback
+        self._mark_success()
+
+        results = []
+        for charge, reply in zip(charges, replies):
+            allowed, retry_after, granted = reply[:3]
+            remaining = int(reply[3]) if len(reply) > 3 else None
             allowed_bool = bool(int(allowed))
             retry = int(retry_after) if not allowed_bool else 0
-            return RateLimitDecision(allowed_bool, retry, per_minute, per_hour)
-        except Exception:
-            return RateLimitDecision(True, 0, per_minute, per_hour, enforced=False)
+            decision = RateLimitDecision(
+                allowed_bool, retry, charge.per_minute, charge.per_hour, remaining=remaining
+            )
+            results.append((decision, int(granted)))
+        return results
+
+
+class _Lease:
+    __slots__ = ("tokens", "limits", "denied_until")
+
+    def __init__(self, limits: Tuple[int, int]):
+        self.tokens = 0
+        self.limits = limits
+        self.denied_until = 0.0
+
+
+class _LeasedRedisBucket:
+    """Hybrid mode: each worker borrows tokens from Redis in chunks and spends
+    them locally, so requests well below the limit skip the Redis round trip.
+
+    The chunk is `tolerance * per_minute` tokens. A worker can hold at most
+    chunk - 1 unspent tokens per key, which bounds how much stricter than the
+    configured limit a key can appear across workers. Near the limit Redis
+    grants fewer tokens and each request goes back to Redis. Redis denials
+    are remembered locally until their Retry-After.
+    """
+
+    def __init__(self, redis_bucket: _RedisDualTokenBucket, tolerance: float, max_keys: int = 10_000):
+        self._redis = redis_bucket
+        self._tolerance = tolerance
+        self._max_keys = max_keys
+        self._leases = OrderedDict()
+        self.redis_calls = 0
+        self.local_hits = 0
+
+    @property
+    def redis_url(self) -> str:
+        return self._redis.redis_url
+
+    def _lease_for(self, key: str, limits: Tuple[int, int]) -> _Lease:
+        lease = self._leases.get(key)
+        if lease is None or lease.limits != limits:
+            lease = _Lease(limits)
+            self._leases[key] = lease
+            while len(self._leases) > self._max_keys:
+                self._leases.popitem(last=False)
+        else:
+            self._leases.move_to_end(key)
+        return lease
+
+    async def consume(
+        self, key: str, per_minute: int, per_hour: int, cost: int = 1, force: bool = False
+    ) -> RateLimitDecision:
+        if force:
+            # Refunds / settlements go straight to the shared bucket.
+            self.redis_calls += 1
+            return await self._redis.consume(key, per_minute, per_hour, cost=cost, force=True)
+
+        limits = (per_minute, per_hour)
+        lease = self._lease_for(key, limits)
+        now = time.monotonic()
+
+        if lease.denied_until > now:
+            self.local_hits += 1
+            retry = int((lease.denied_until - now) + 0.999)
+            return RateLimitDecision(False, max(retry, 1), per_minute, per_hour)
+        if lease.tokens >= cost:
+            lease.tokens -= cost
+            self.local_hits += 1
+            return RateLimitDecision(True, 0, per_minute, per_hour)
+
+        want = max(cost, int(per_minute * self._tolerance))
+        self.redis_calls += 1
+        decision, granted = await self._redis.consume_chunk(key, per_minute, per_hour, cost=cost, want=want)
+        if not decision.enforced:
+            return decision
+        if decision.allowed:
+            lease.tokens += max(0, granted - cost)
+        else:
+            lease.denied_until = time.monotonic() + decision.retry_after_seconds
+        return decision
 
 
 class RateLimiter:
     def __init__(self):
-        self._memory = _InMemoryDualTokenBucket()
-        self._redis_limiter: Optional[_RedisDualTokenBucket] = None
-
-    def _get_redis_limiter(self) -> Optional[_RedisDualTokenBucket]:
-        redis_url = os.getenv("REDIS_URL", "").strip()
+        settings = get_settings()
+        self._memory = _InMemoryDualTokenBucket(
+            shards=settings.rate_limit_memory_shards,
+            max_keys=settings.rate_limit_memory_max_keys,
+        )
+        self._redis_limiter = None
+
+    def _get_redis_limiter(self):
+        settings = get_settings()
+        redis_url = settings.redis_url
         if not redis_url:
             return None
-        if self._redis_limiter is None or self._redis_limiter._redis_url != redis_url:
-            self._redis_limiter = _RedisDualTokenBucket(redis_url)
+        tolerance = settings.rate_limit_lease_tolerance
+        leased = isinstance(self._redis_limiter, _LeasedRedisBucket)
+        if (
+            self._redis_limiter is None
+            or self._redis_limiter.redis_url != redis_url
+            or leased != (tolerance > 0)
+        ):
+            bucket = _RedisDualTokenBucket(
+                redis_url,
+                max_connections=settings.redis_max_connections,
+                socket_timeout=settings.redis_socket_timeout,
+            )
+            self._redis_limiter = _LeasedRedisBucket(bucket, tolerance) if tolerance > 0 else bucket
         return self._redis_limiter
 
-    async def consume_ai(self, key: str, cost: int = 1) -> RateLimitDecision:
-        per_minute, per_hour = _get_ai_limits()
+    async def _consume_bucket(
+        self, policy: QuotaPolicy, key: str, cost: int, force: bool = False
+    ) -> RateLimitDecision:
+        bucket_key = f"dailywave:{policy.name}:{key}"
 
         redis_limiter = self._get_redis_limiter()
         if redis_limiter:
-            decision = await redis_limiter.consume(f"dailywave:ai:{key}", per_minute, per_hour, cost=cost)
+            decision = await redis_limiter.consume(
+                bucket_key, policy.per_minute, policy.per_hour, cost=cost, force=force
+            )
             if decision.enforced:
                 return decision
             # If Redis is misconfigured/unavailable, fall through to in-memory.
 
-        return await self._memory.consume(f"dailywave:ai:{key}", per_minute, per_hour, cost=cost)
+        return await self._memory.consume(bucket_key, policy.per_minute, policy.per_hour, cost=cost, force=force)
+
+    async def consume(self, policy_name: str, key: str, cost: int = 1) -> RateLimitDecision:
+        return await self._consume_bucket(get_policy(policy_name), key, cost)
+
+    async def adjust(self, policy_name: str, key: str, delta: int) -> RateLimitDecision:
+        """Applies `delta` unconditionally: negative refunds, positive charges (may go into debt)."""
+        return await self._consume_bucket(get_policy(policy_name), key, delta, force=True)
+
+    async def remaining(self, policy_name: str, key: str) -> Optional[int]:
+        return (await self.adjust(policy_name, key, 0)).remaining
+
+    async def consume_all(self, charges: Sequence[Tuple[str, str, int]]) -> List[RateLimitDecision]:
+        """Charges several (policy, key, cost) together; if any is denied, the rest are refunded.
+
+        With a plain Redis backend all charges go out in one pipelined round trip.
+        """
+        policies = [get_policy(name) for name, _, _ in charges]
+        redis_limiter = self._get_redis_limiter()
+        decisions: List[Optional[RateLimitDecision]] = [None] * len(charges)
+
+        if isinstance(redis_limiter, _RedisDualTokenBucket):
+            replies = await redis_limiter.consume_many([
+                BucketCharge(f"dailywave:{p.name}:{key}", p.per_minute, p.per_hour, cost)
+                for p, (_, key, cost) in zip(policies, charges)
+            ])
+            for i, (decision, _) in enumerate(replies):
+                if decision.enforced:
+                    decisions[i] = decision
+
+        for i, (policy, (_, key, cost)) in enumerate(zip(policies, charges)):
+            if decisions[i] is None:
+                decisions[i] = await self._consume_bucket(policy, key, cost)
+
+        if not all(d.allowed for d in decisions):
+            for policy, (_, key, cost), decision in zip(policies, charges, decisions):
+                if decision.allowed:
+                    await self._consume_bucket(policy, key, -cost, force=True)
+        return decisions
 
 
 _GLOBAL_LIMITER: Optional[RateLimiter] = None
@@ -264,3 +561,89 @@ def get_rate_limiter() -> RateLimiter:
     if _GLOBAL_LIMITER is None:
         _GLOBAL_LIMITER = RateLimiter()
     return _GLOBAL_LIMITER
+
+
+def _rate_limit_exceeded(decision: RateLimitDecision) -> HTTPException:
+    return HTTPException(
+        status_code=429,
+        detail="Rate limit exceeded. Please try again shortly.",
+        headers={"Retry-After": str(decision.retry_after_seconds)},
+    )
+
+
+async def enforce_quota(policy_name: str, key: str, cost: int = 1) -> RateLimitDecision:
+    """Charges `cost` units to a policy from inside a handler; raises 429 when over."""
+    decision = await get_rate_limiter().consume(policy_name, key, cost=cost)
+    if not decision.allowed:
+        RATE_LIMIT_DENIALS.inc(policy_name)
+        raise _rate_limit_exceeded(decision)
+    return decision
+
+
+def client_key(scope) -> str:
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def query_token(scope) -> Optional[str]:
+    values = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("token")
+    return values[0] if values else None
+
+
+def quota_key(policy_name: str, scope) -> str:
+    """Bucket key for a request under the policy's `key_by`.
+
+    "user" uses the Supabase user verified earlier in the request (kept on
+    request.state) and "token" a digest of the `?token=` query parameter; both
+    fall back to the client IP when there is none.
+    """
+    key_by = get_policy(policy_name).key_by
+    if key_by == "global":
+        return "global"
+    if key_by == "token":
+        token = query_token(scope)
+        if token:
+            return "token:" + hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+    if key_by == "user":
+        auth = scope.get("state", {}).get("supabase_auth")
+        user_id = getattr(auth, "user_id", None)
+        if user_id:
+            return user_id
+    return client_key(scope)
+
+
+class RateLimitMiddleware:
+    """Charges the per-route policy in ROUTE_POLICIES before the request reaches the app.
+
+    It runs before authentication, so "user" policies here are keyed by IP.
+    """
+
+    def __init__(self, app, route_policies=None, token_route_policies=None):
+        self.app = app
+        self.route_policies = dict(ROUTE_POLICIES if route_policies is None else route_policies)
+        self.token_route_policies = dict(
+            TOKEN_ROUTE_POLICIES if token_route_policies is None else token_route_policies
+        )
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        route = (scope["method"], scope["path"])
+        policy_name = self.route_policies.get(route)
+        if route in self.token_route_policies and query_token(scope):
+            policy_name = self.token_route_policies[route]
+        if policy_name is None:
+            await self.app(scope, receive, send)
+            return
+
+        decision = await get_rate_limiter().consume(policy_name, quota_key(policy_name, scope))
+        if not decision.allowed:
+            RATE_LIMIT_DENIALS.inc(policy_name)
+            exc = _rate_limit_exceeded(decision)
+            response = JSONResponse({"detail": exc.detail}, status_code=exc.status_code, headers=exc.headers)
+            await response(scope, receive, send)
+            return
+
+        await self.app(scope, receive, send)
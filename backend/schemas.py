@@ -1,5 +1,8 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Dict, Any, Optional
+import pytz
+
+from calendar_gen import CALENDAR_TIMEZONE, MAX_HORIZON_DAYS, CalendarOptions
 
 class Position(BaseModel):
     x: float
@@ -32,3 +35,20 @@ class Workflow(BaseModel):
     edges: List[Edge]
     created_at: Optional[str] = None
     updated_at: Optional[str] = None
+
+class CalendarSubscription(BaseModel):
+    routines: List[Dict[str, Any]] = []
+    pipelines: List[Dict[str, Any]] = []
+    timezone: str = CALENDAR_TIMEZONE
+    past_days: int = Field(7, ge=0, le=MAX_HORIZON_DAYS)
+    future_days: int = Field(30, ge=1, le=MAX_HORIZON_DAYS)
+
+    @field_validator("timezone")
+    @classmethod
+    def _known_timezone(cls, value: str) -> str:
+        if value not in pytz.all_timezones_set:
+            raise ValueError(f"Unknown timezone: {value}")
+        return value
+
+    def calendar_options(self) -> CalendarOptions:
+        return CalendarOptions(timezone=self.timezone, past_days=self.past_days, future_days=self.future_days)
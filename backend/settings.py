@@ -0,0 +1,335 @@
+"""
+Runtime settings read from the environment.
+
+`get_settings()` returns one validated, immutable Settings object built on
+first use, so request handlers read attributes instead of parsing env vars.
+`reload_settings()` rebuilds it (SIGHUP and POST /api/admin/settings/reload
+re-read .env first) and notifies `on_reload` subscribers.
+
+Components built once at startup (upstream limiter, model registry, memU
+client, JWKS/token caches, in-memory limiter shards) keep the values they were
+built with; changing those needs a restart.
+"""
+import logging
+import os
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class QuotaPolicy:
+    """A named dual token bucket (per minute + per hour).
+
+    `key_by` says what a bucket is keyed on ("user", "ip", "token" or
+    "global"); see rate_limiter.quota_key.
+    """
+
+    name: str
+    per_minute: int
+    per_hour: int
+    key_by: str = "ip"
+
+
+# name -> (env prefix, default per minute, default per hour, key_by).
+# Tokens are requests, except workflow_nodes (nodes) and ai_tokens* (AI tokens).
+QUOTA_POLICY_DEFAULTS = {
+    "ai": ("AI_RATE_LIMIT", 30, 300, "user"),
+    "workflow": ("RATE_LIMIT_WORKFLOW", 30, 300, "ip"),
+    "workflow_nodes": ("RATE_LIMIT_WORKFLOW_NODES", 300, 3000, "ip"),
+    "persistence_save": ("RATE_LIMIT_PERSISTENCE_SAVE", 60, 1200, "ip"),
+    "memory_track": ("RATE_LIMIT_MEMORY_TRACK", 120, 3000, "ip"),
+    "calendar_feed": ("RATE_LIMIT_CALENDAR_FEED", 60, 1200, "ip"),
+    "calendar_feed_token": ("RATE_LIMIT_CALENDAR_FEED_TOKEN", 10, 300, "token"),
+    "ai_tokens": ("AI_TOKEN_BUDGET", 20_000, 200_000, "user"),
+    "ai_tokens_global": ("AI_GLOBAL_TOKEN_BUDGET", 200_000, 2_000_000, "global"),
+}
+
+_TRUE = {"1", "true", "yes", "y", "on"}
+_FALSE = {"0", "false", "no", "n", "off"}
+
+
+class _EnvReader:
+    """Typed env access that falls back to defaults and records what was invalid."""
+
+    def __init__(self, environ: Mapping[str, str]):
+        self._environ = environ
+        self.problems: List[str] = []
+
+    def get_str(self, name: str, default: str = "") -> str:
+        return (self._environ.get(name) or default).strip()
+
+    def get_bool(self, name: str) -> Optional[bool]:
+        raw = self._environ.get(name)
+        if raw is None or not raw.strip():
+            return None
+        lowered = raw.strip().lower()
+        if lowered in _TRUE:
+            return True
+        if lowered in _FALSE:
+            return False
+        self.problems.append(f"{name}={raw!r} is not a boolean; ignored")
+        return None
+
+    def get_int(self, name: str, default: int, minimum: int = 1) -> int:
+        raw = self._environ.get(name, "").strip()
+        if not raw:
+            return default
+        try:
+            value = int(raw)
+        except ValueError:
+            self.problems.append(f"{name}={raw!r} is not an integer; using {default}")
+            return default
+        if value < minimum:
+            self.problems.append(f"{name}={value} is below {minimum}; using {default}")
+            return default
+        return value
+
+    def get_float(self, name: str, default: float, minimum: float = 0.0) -> float:
+        raw = self._environ.get(name, "").strip()
+        if not raw:
+            return default
+        try:
+            value = float(raw)
+        except ValueError:
+            self.problems.append(f"{name}={raw!r} is not a number; using {default}")
+            return default
+        if value < minimum:
+            self.problems.append(f"{name}={value} is below {minimum}; using {default}")
+            return default
+        return value
+
+
+@dataclass(frozen=True)
+class Settings:
+    api_secret_key: str = ""
+    admin_api_key: str = ""
+    gemini_api_key: str = ""
+
+    supabase_base_url: str = ""
+    supabase_anon_key: str = ""
+    supabase_jwt_secret: str = ""
+    supabase_jwt_audiences: Tuple[str, ...] = ("authenticated",)
+    supabase_jwt_issuer: str = ""
+    supabase_jwks_url: str = ""
+    supabase_user_endpoint_cache_seconds: float = 60.0
+    supabase_service_role_key: str = ""
+    supabase_jwks_ttl: float = 600.0
+    supabase_jwks_refresh_ahead: float = 60.0
+    supabase_jwks_max_stale: float = 86400.0
+    supabase_jwks_min_refresh: float = 30.0
+    supabase_token_cache_size: int = 10_000
+    require_supabase_auth_for_ai: bool = False
+
+    redis_url: str = ""
+    redis_max_connections: int = 50
+    redis_socket_timeout: float = 0.5
+    rate_limit_lease_tolerance: float = 0.0
+    quota_policies: Mapping[str, QuotaPolicy] = field(default_factory=dict)
+    rate_limit_memory_shards: int = 16
+    rate_limit_memory_max_keys: int = 100_000
+
+    memu_url: str = "http://localhost:8100"
+    memu_cb_failure_threshold: int = 3
+    memu_cb_reset_seconds: float = 30.0
+    memu_health_interval: float = 30.0
+    memu_retrieve_budget_seconds: float = 0.8
+    memu_context_cache_ttl: float = 60.0
+
+    # Empty model / base URL settings fall back to the defaults in ai_models.
+    gemini_api_base_url: str = ""
+    gemini_model: str = ""
+    gemini_fallback_model: str = ""
+    gemini_small_prompt_model: str = ""
+    ai_small_prompt_tokens: int = 400
+    ai_hedge_delay_ms: int = 2000
+    ai_hedge_min_delay_ms: int = 200
+
+    upstream_max_concurrency: int = 16
+    upstream_min_concurrency: int = 1
+    upstream_queue_timeout: float = 10.0
+    upstream_max_queue: int = 200
+    upstream_global_concurrency: int = 0
+    ai_input_token_budget: int = 6000
+    ai_context_history_days: int = 14
+    ai_context_max_list_items: int = 50
+    ai_batch_max_items: int = 8
+    ai_batch_concurrency: int = 3
+
+    server_timing: bool = False
+    trace_sample_rate: float = 0.0
+    trace_export_file: str = ""
+    trace_export_url: str = ""
+
+    # Timezones the public feed accepts in `?tz=` besides the default one.
+    calendar_feed_timezones: Tuple[str, ...] = ()
+
+    profiler_enabled: bool = False
+    profiler_max_seconds: float = 60.0
+    loop_lag_threshold: float = 0.1
+
+    @classmethod
+    def from_env(cls, environ: Optional[Mapping[str, str]] = None) -> Tuple["Settings", List[str]]:
+        """Builds settings from `environ` (default os.environ); returns them with any validation problems."""
+        env = _EnvReader(os.environ if environ is None else environ)
+
+        base_url = (env.get_str("SUPABASE_PROJECT_URL") or env.get_str("SUPABASE_URL")).rstrip("/")
+        anon_key = env.get_str("SUPABASE_ANON_KEY")
+        jwt_secret = env.get_str("SUPABASE_JWT_SECRET")
+        audiences = tuple(a.strip() for a in env.get_str("SUPABASE_JWT_AUD", "authenticated").split(",") if a.strip())
+
+        require_auth = env.get_bool("REQUIRE_SUPABASE_AUTH_FOR_AI")
+        if require_auth is None:
+            # Safe fallback: do not require auth unless the backend is configured to verify it.
+            require_auth = bool(jwt_secret or base_url)
+
+        policies = {}
+        for name, (prefix, default_m, default_h, key_by) in QUOTA_POLICY_DEFAULTS.items():
+            policies[name] = QuotaPolicy(
+                name=name,
+                per_minute=env.get_int(f"{prefix}_PER_MINUTE", default_m),
+                per_hour=env.get_int(f"{prefix}_PER_HOUR", default_h),
+                key_by=key_by,
+            )
+
+        settings = cls(
+            api_secret_key=env.get_str("API_SECRET_KEY"),
+            admin_api_key=env.get_str("ADMIN_API_KEY"),
+            gemini_api_key=env.get_str("GEMINI_API_KEY"),
+            supabase_base_url=base_url,
+            supabase_anon_key=anon_key,
+            supabase_jwt_secret=jwt_secret,
+            supabase_jwt_audiences=audiences or ("authenticated",),
+            supabase_jwt_issuer=env.get_str("SUPABASE_JWT_ISSUER"),
+            supabase_jwks_url=env.get_str("SUPABASE_JWKS_URL") or (f"{base_url}/auth/v1/certs" if base_url else ""),
+            supabase_user_endpoint_cache_seconds=env.get_float("SUPABASE_USER_ENDPOINT_CACHE_SECONDS", 60.0),
+            supabase_service_role_key=env.get_str("SUPABASE_SERVICE_ROLE_KEY") or env.get_str("SUPABASE_SERVICE_ROLE"),
+            supabase_jwks_ttl=env.get_float("SUPABASE_JWKS_TTL_SECONDS", 600.0),
+            supabase_jwks_refresh_ahead=env.get_float("SUPABASE_JWKS_REFRESH_AHEAD_SECONDS", 60.0),
+            supabase_jwks_max_stale=env.get_float("SUPABASE_JWKS_MAX_STALE_SECONDS", 86400.0),
+            supabase_jwks_min_refresh=env.get_float("SUPABASE_JWKS_MIN_REFRESH_SECONDS", 30.0),
+            supabase_token_cache_size=env.get_int("SUPABASE_TOKEN_CACHE_SIZE", 10_000),
+            require_supabase_auth_for_ai=require_auth,
+            redis_url=env.get_str("REDIS_URL"),
+            redis_max_connections=env.get_int("REDIS_MAX_CONNECTIONS", 50),
+            redis_socket_timeout=env.get_float("REDIS_SOCKET_TIMEOUT_SECONDS", 0.5, minimum=0.001),
+            rate_limit_lease_tolerance=env.get_float("RATE_LIMIT_LEASE_TOLERANCE", 0.0),
+            quota_policies=policies,
+            rate_limit_memory_shards=env.get_int("RATE_LIMIT_MEMORY_SHARDS", 16),
+            rate_limit_memory_max_keys=env.get_int("RATE_LIMIT_MEMORY_MAX_KEYS", 100_000),
+            memu_url=env.get_str("MEMU_URL", "http://localhost:8100"),
+            memu_cb_failure_threshold=env.get_int("MEMU_CB_FAILURE_THRESHOLD", 3),
+            memu_cb_reset_seconds=env.get_float("MEMU_CB_RESET_SECONDS", 30.0, minimum=0.001),
+            memu_health_interval=env.get_float("MEMU_HEALTH_INTERVAL_SECONDS", 30.0, minimum=0.001),
+            memu_retrieve_budget_seconds=env.get_int("MEMU_RETRIEVE_BUDGET_MS", 800, minimum=0) / 1000.0,
+            memu_context_cache_ttl=env.get_float("MEMU_CONTEXT_CACHE_TTL_SECONDS", 60.0),
+            ai_input_token_budget=env.get_int("AI_INPUT_TOKEN_BUDGET", 6000),
+            ai_context_history_days=env.get_int("AI_CONTEXT_HISTORY_DAYS", 14),
+            ai_context_max_list_items=env.get_int("AI_CONTEXT_MAX_LIST_ITEMS", 50),
+            ai_batch_max_items=env.get_int("AI_BATCH_MAX_ITEMS", 8),
+            ai_batch_concurrency=env.get_int("AI_BATCH_CONCURRENCY", 3),
+            gemini_api_base_url=env.get_str("GEMINI_API_BASE_URL"),
+            gemini_model=env.get_str("GEMINI_MODEL"),
+            gemini_fallback_model=env.get_str("GEMINI_FALLBACK_MODEL"),
+            gemini_small_prompt_model=env.get_str("GEMINI_SMALL_PROMPT_MODEL"),
+            ai_small_prompt_tokens=env.get_int("AI_SMALL_PROMPT_TOKENS", 400),
+            ai_hedge_delay_ms=env.get_int("AI_HEDGE_DELAY_MS", 2000),
+            ai_hedge_min_delay_ms=env.get_int("AI_HEDGE_MIN_DELAY_MS", 200),
+            upstream_max_concurrency=env.get_int("UPSTREAM_MAX_CONCURRENCY", 16),
+            upstream_min_concurrency=env.get_int("UPSTREAM_MIN_CONCURRENCY", 1),
+            upstream_queue_timeout=env.get_float("UPSTREAM_QUEUE_TIMEOUT_SECONDS", 10.0),
+            upstream_max_queue=env.get_int("UPSTREAM_MAX_QUEUE", 200),
+            upstream_global_concurrency=env.get_int("UPSTREAM_GLOBAL_CONCURRENCY", 0, minimum=0),
+            server_timing=env.get_bool("SERVER_TIMING") is True,
+            trace_sample_rate=min(1.0, env.get_float("TRACE_SAMPLE_RATE", 0.0)),
+            trace_export_file=env.get_str("TRACE_EXPORT_FILE"),
+            trace_export_url=env.get_str("TRACE_EXPORT_URL"),
+            calendar_feed_timezones=tuple(
+                t.strip() for t in env.get_str("CALENDAR_FEED_TIMEZONES").split(",") if t.strip()
+            ),
+            profiler_enabled=env.get_bool("PROFILER_ENABLED") is True,
+            profiler_max_seconds=env.get_float("PROFILER_MAX_SECONDS", 60.0, minimum=0.1),
+            loop_lag_threshold=env.get_int("LOOP_LAG_THRESHOLD_MS", 100, minimum=0) / 1000.0,
+        )
+        return settings, env.problems
+
+    def diff(self, other: "Settings") -> List[str]:
+        """Names of fields whose values differ (secrets are compared, never shown)."""
+        return [f.name for f in fields(self) if getattr(self, f.name) != getattr(other, f.name)]
+
+
+_SETTINGS: Optional[Settings] = None
+_RELOAD_CALLBACKS: List[Callable[[Settings], None]] = []
+# Variables the process was started with (before any .env was applied); these
+# always win over .env, on reload as at startup.
+_PROCESS_ENV_KEYS = frozenset(os.environ)
+# .env values this process has put into os.environ.
+_DOTENV_APPLIED: Dict[str, str] = {}
+
+
+def load_env_file(path: Optional[str] = None):
+    """Applies the .env file (found as by python-dotenv when `path` is None) to os.environ.
+
+    Only variables the process environment did not set are taken from it, and
+    variables an earlier call applied but that are no longer in the file are
+    removed again.
+    """
+    from dotenv import dotenv_values
+
+    values = {
+        name: value
+        for name, value in dotenv_values(path).items()
+        if value is not None and name not in _PROCESS_ENV_KEYS
+    }
+    for name, value in list(_DOTENV_APPLIED.items()):
+        if name not in values:
+            if os.environ.get(name) == value:
+                del os.environ[name]
+            del _DOTENV_APPLIED[name]
+    for name, value in values.items():
+        os.environ[name] = value
+        _DOTENV_APPLIED[name] = value
+
+
+def _build() -> Settings:
+    settings, problems = Settings.from_env()
+    for problem in problems:
+        logger.warning("Invalid setting: %s", problem)
+    return settings
+
+
+def get_settings() -> Settings:
+    global _SETTINGS
+    if _SETTINGS is None:
+        _SETTINGS = _build()
+    return _SETTINGS
+
+
+def reload_settings(dotenv: bool = False) -> Sequence[str]:
+    """Rebuilds settings from the environment; returns the names of changed fields.
+
+    With `dotenv`, the .env file is re-read first (see load_env_file), so edits
+    to it take effect; the process environment still takes precedence.
+    """
+    global _SETTINGS
+    if dotenv:
+        load_env_file()
+    previous = _SETTINGS
+    _SETTINGS = _build()
+    changed = previous.diff(_SETTINGS) if previous is not None else []
+    if changed:
+        logger.info("Settings reloaded; changed: %s", ", ".join(changed))
+    for callback in list(_RELOAD_CALLBACKS):
+        try:
+            callback(_SETTINGS)
+        except Exception:
+            logger.exception("Settings reload callback failed.")
+    return changed
+
+
+def on_reload(callback: Callable[[Settings], None]) -> Callable[[Settings], None]:
+    """Registers `callback(settings)` to run after every reload."""
+    _RELOAD_CALLBACKS.append(callback)
+    return callback
+
@@ -2,7 +2,9 @@ import json
 import os
 import threading
 import logging
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
+
+from tracing import span
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 DATA_FILE = os.path.join(DATA_DIR, "workflow_data.json")
@@ -25,6 +27,7 @@ class StorageManager:
         if not os.path.exists(DATA_DIR):
             os.makedirs(DATA_DIR)
 
+    @span("storage.save")
     def save_state(self, data: Dict[str, Any]):
         """Saves the workflow state to a JSON file with thread safety."""
         try:
@@ -41,6 +44,19 @@ class StorageManager:
             logger.exception("Unexpected error while saving state.")
             return False
 
+    def state_version(self) -> Optional[Tuple[int, int, int]]:
+        """Cheap change marker for the state file (None when it does not exist).
+
+        Saves replace the file, so inode, size or mtime differ after every write,
+        including writes from other worker processes.
+        """
+        try:
+            st = os.stat(DATA_FILE)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    @span("storage.load")
     def load_state(self) -> Dict[str, Any]:
         """Loads the workflow state from a JSON file. Returns empty state if empty/missing."""
         data = None
@@ -1,14 +1,14 @@
-import os
 from typing import Optional
 
 import httpx
 from fastapi import HTTPException
 
+from settings import get_settings
 from supabase_auth import _get_supabase_base_url
 
 
 def _get_service_role_key() -> str:
-    return (os.getenv("SUPABASE_SERVICE_ROLE_KEY") or os.getenv("SUPABASE_SERVICE_ROLE") or "").strip()
+    return get_settings().supabase_service_role_key
 
 
 def _get_admin_base_url() -> str:
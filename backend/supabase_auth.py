@@ -1,61 +1,42 @@
 import asyncio
+import hashlib
 import json
-import os
 import time
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Any, Dict, Optional, Sequence, Tuple
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
 
 import httpx
 import jwt
 from fastapi import HTTPException, Request
 
-
-def _parse_bool(value: Optional[str]) -> Optional[bool]:
-    if value is None:
-        return None
-    lowered = value.strip().lower()
-    if lowered in {"1", "true", "yes", "y", "on"}:
-        return True
-    if lowered in {"0", "false", "no", "n", "off"}:
-        return False
-    return None
+from metrics import cache_lookup
+from settings import Settings, get_settings
+from tracing import span
 
 
 def _get_supabase_base_url() -> str:
-    return (os.getenv("SUPABASE_PROJECT_URL") or os.getenv("SUPABASE_URL") or "").rstrip("/")
+    return get_settings().supabase_base_url
 
 
 def _get_supabase_anon_key() -> str:
-    return os.getenv("SUPABASE_ANON_KEY", "")
+    return get_settings().supabase_anon_key
 
 
 def _get_supabase_jwt_secret() -> str:
-    return os.getenv("SUPABASE_JWT_SECRET", "")
+    return get_settings().supabase_jwt_secret
 
 
 def _get_expected_audiences() -> Sequence[str]:
-    raw = os.getenv("SUPABASE_JWT_AUD", "authenticated")
-    items = [x.strip() for x in raw.split(",") if x.strip()]
-    return items or ["authenticated"]
+    return get_settings().supabase_jwt_audiences
 
 
 def _get_expected_issuer() -> str:
-    return os.getenv("SUPABASE_JWT_ISSUER", "")
+    return get_settings().supabase_jwt_issuer
 
 
 def is_supabase_auth_required_for_ai() -> bool:
-    override = _parse_bool(os.getenv("REQUIRE_SUPABASE_AUTH_FOR_AI"))
-    if override is not None:
-        return override
-
-    # Safe fallback: do not require auth unless the backend is configured to verify it.
-    if _get_supabase_jwt_secret():
-        return True
-    if _get_supabase_base_url() and _get_supabase_anon_key():
-        return True
-    if _get_supabase_base_url():
-        return True
-    return False
+    return get_settings().require_supabase_auth_for_ai
 
 
 @dataclass(frozen=True)
@@ -64,15 +45,11 @@ class VerifiedSupabaseToken:
     claims: Dict[str, Any]
 
 
-_JWKS_CACHE: Dict[str, Any] = {"value": None, "fetched_at": 0.0}
-_JWKS_LOCK = asyncio.Lock()
-_JWKS_TTL_SECONDS = 600
+def _get_jwks_url(base_url: str) -> str:
+    return get_settings().supabase_jwks_url or f"{base_url}/auth/v1/certs"
 
 
-async def _fetch_jwks(base_url: str) -> Optional[Dict[str, Any]]:
-    jwks_url = os.getenv("SUPABASE_JWKS_URL", "").strip()
-    url = jwks_url or f"{base_url}/auth/v1/certs"
-
+async def _fetch_jwks(url: str) -> Optional[Dict[str, Any]]:
     try:
         async with httpx.AsyncClient(timeout=5.0) as client:
             res = await client.get(url)
@@ -86,26 +63,144 @@ async def _fetch_jwks(base_url: str) -> Optional[Dict[str, Any]]:
     return None
 
 
-async def _get_cached_jwks(base_url: str) -> Optional[Dict[str, Any]]:
-    now = time.time()
-    cached = _JWKS_CACHE.get("value")
-    fetched_at = float(_JWKS_CACHE.get("fetched_at") or 0.0)
-    if cached and (now - fetched_at) < _JWKS_TTL_SECONDS:
-        return cached
-
-    async with _JWKS_LOCK:
-        now = time.time()
-        cached = _JWKS_CACHE.get("value")
-        fetched_at = float(_JWKS_CACHE.get("fetched_at") or 0.0)
-        if cached and (now - fetched_at) < _JWKS_TTL_SECONDS:
-            return cached
-
-        jwks = await _fetch_jwks(base_url)
-        if jwks:
-            _JWKS_CACHE["value"] = jwks
-            _JWKS_CACHE["fetched_at"] = now
+class _JWKSCache:
+    """Stale-while-revalidate JWKS cache.
+
+    - fresh (age < ttl - refresh_ahead): served from memory;
+    - refresh window / expired but within max_stale: served from memory while a
+      single background fetch refreshes it;
+    - cold or too stale: callers wait on one shared fetch. Keys older than
+      ttl + max_stale are dropped first, so if that fetch fails verification
+      fails closed instead of trusting keys that may have been revoked.
+
+    An unknown `kid` forces a refresh (key rotation), at most once per
+    `min_refresh_interval` so forged kids cannot hammer the JWKS endpoint.
+    The same interval is the backoff after a failed fetch: until it passes,
+    callers get the cached keys (or None) without starting another fetch.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 600.0,
+        refresh_ahead: float = 60.0,
+        max_stale: float = 86400.0,
+        min_refresh_interval: float = 30.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.ttl = ttl
+        self.refresh_ahead = min(refresh_ahead, ttl)
+        self.max_stale = max_stale
+        self.min_refresh_interval = min_refresh_interval
+        self._clock = clock
+        self._url: Optional[str] = None
+        self._value: Optional[Dict[str, Any]] = None
+        self._fetched_at = 0.0
+        self._last_attempt = float("-inf")
+        self._last_failure = float("-inf")
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.fetches = 0
+
+    @property
+    def has_keys(self) -> bool:
+        return self._value is not None
+
+    def _age(self) -> float:
+        return self._clock() - self._fetched_at
+
+    async def _fetch(self, url: str) -> Optional[Dict[str, Any]]:
+        self._last_attempt = self._clock()
+        self.fetches += 1
+        jwks = await _fetch_jwks(url)
+        if url == self._url:
+            if jwks:
+                self._value = jwks
+                self._fetched_at = self._clock()
+                self._last_failure = float("-inf")
+            else:
+                self._last_failure = self._clock()
         return jwks
 
+    def _refresh(self, url: str) -> Optional["asyncio.Task"]:
+        """Starts (or joins) the single in-flight fetch; None while backing off after a failure."""
+        task = self._refresh_task
+        if task is not None and not task.done():
+            return task
+        if self._clock() - self._last_failure < self.min_refresh_interval:
+            return None
+        task = self._refresh_task = asyncio.create_task(self._fetch(url))
+        return task
+
+    async def _wait_refresh(self, url: str):
+        task = self._refresh(url)
+        if task is not None:
+            await asyncio.shield(task)
+
+    def _use_url(self, url: str):
+        if url != self._url:
+            self._url = url
+            self._value = None
+            self._fetched_at = 0.0
+            self._last_attempt = float("-inf")
+            self._last_failure = float("-inf")
+
+    async def get(self, url: str) -> Optional[Dict[str, Any]]:
+        self._use_url(url)
+        if self._value is not None:
+            age = self._age()
+            if age < self.ttl - self.refresh_ahead:
+                return self._value
+            if age < self.ttl + self.max_stale:
+                self._refresh(url)
+                return self._value
+            self._value = None
+        await self._wait_refresh(url)
+        return self._value
+
+    async def get_key(self, url: str, kid: str) -> Optional[Dict[str, Any]]:
+        """Returns the JWK for `kid`, refreshing once (rate limited) if it is unknown."""
+        jwks = await self.get(url)
+        key = _find_jwk(jwks, kid)
+        if key is not None:
+            return key
+        if self._clock() - self._last_attempt >= self.min_refresh_interval:
+            await self._wait_refresh(url)
+        elif self._refresh_task is not None and not self._refresh_task.done():
+            await asyncio.shield(self._refresh_task)
+        return _find_jwk(self._value, kid)
+
+
+def _find_jwk(jwks: Optional[Dict[str, Any]], kid: str) -> Optional[Dict[str, Any]]:
+    keys = (jwks or {}).get("keys") or []
+    return next((k for k in keys if isinstance(k, dict) and k.get("kid") == kid), None)
+
+
+def _build_jwks_cache() -> _JWKSCache:
+    settings = get_settings()
+    return _JWKSCache(
+        ttl=settings.supabase_jwks_ttl,
+        refresh_ahead=settings.supabase_jwks_refresh_ahead,
+        max_stale=settings.supabase_jwks_max_stale,
+        min_refresh_interval=settings.supabase_jwks_min_refresh,
+    )
+
+
+_JWKS_CACHE: Optional[_JWKSCache] = None
+
+
+def _get_jwks_cache() -> _JWKSCache:
+    global _JWKS_CACHE
+    if _JWKS_CACHE is None:
+        _JWKS_CACHE = _build_jwks_cache()
+    return _JWKS_CACHE
+
+
+async def warm_jwks_cache() -> bool:
+    """Prefetches the JWKS at startup so the first RS256 request does not wait on it."""
+    base_url = _get_supabase_base_url()
+    if not base_url:
+        return False
+    return bool(await _get_jwks_cache().get(_get_jwks_url(base_url)))
+
 
 def _extract_user_id(claims: Dict[str, Any]) -> str:
     sub = claims.get("sub")
@@ -134,6 +229,25 @@ def _decode_with_secret(token: str, secret: str) -> Dict[str, Any]:
     )
 
 
+# kid -> (serialized JWK, parsed RSA public key); rebuilt only if the JWK changes.
+_PUBLIC_KEYS: "OrderedDict[str, Tuple[str, Any]]" = OrderedDict()
+_PUBLIC_KEYS_MAX = 32
+
+
+def _public_key_for(kid: str, key_obj: Dict[str, Any]) -> Any:
+    serialized = json.dumps(key_obj, sort_keys=True)
+    cached = _PUBLIC_KEYS.get(kid)
+    if cached is not None and cached[0] == serialized:
+        _PUBLIC_KEYS.move_to_end(kid)
+        return cached[1]
+    public_key = jwt.algorithms.RSAAlgorithm.from_jwk(serialized)
+    _PUBLIC_KEYS[kid] = (serialized, public_key)
+    _PUBLIC_KEYS.move_to_end(kid)
+    while len(_PUBLIC_KEYS) > _PUBLIC_KEYS_MAX:
+        _PUBLIC_KEYS.popitem(last=False)
+    return public_key
+
+
 async def _decode_with_jwks(token: str, base_url: str) -> Dict[str, Any]:
     header = jwt.get_unverified_header(token)
     kid = header.get("kid")
@@ -141,16 +255,12 @@ async def _decode_with_jwks(token: str, base_url: str) -> Dict[str, Any]:
     if not kid:
         raise ValueError("JWT is missing kid header")
 
-    jwks = await _get_cached_jwks(base_url)
-    if not jwks:
-        raise ValueError("JWKS unavailable")
-
-    keys = jwks.get("keys") or []
-    key_obj = next((k for k in keys if isinstance(k, dict) and k.get("kid") == kid), None)
+    cache = _get_jwks_cache()
+    key_obj = await cache.get_key(_get_jwks_url(base_url), kid)
     if not key_obj:
-        raise ValueError("JWKS kid not found")
+        raise ValueError("JWKS kid not found" if cache.has_keys else "JWKS unavailable")
 
-    public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(key_obj))
+    public_key = _public_key_for(kid, key_obj)
     audiences = list(_get_expected_audiences())
     issuer = _get_expected_issuer()
     options = {"verify_aud": bool(audiences), "verify_iss": bool(issuer)}
@@ -178,7 +288,127 @@ async def _verify_via_supabase_user_endpoint(token: str, base_url: str, anon_key
     return user_id.strip(), {}
 
 
+class _VerifiedTokenCache:
+    """LRU of verified tokens keyed by sha256(token) + verification config.
+
+    Entries live until the token's `exp` (or a short TTL for tokens verified
+    via the Supabase user endpoint, so revocations are seen quickly). Failed
+    verifications are never cached.
+    """
+
+    def __init__(self, max_entries: int = 10_000, clock: Callable[[], float] = time.time):
+        self.max_entries = max_entries
+        self._clock = clock
+        self._entries: "OrderedDict[str, Tuple[float, VerifiedSupabaseToken]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[VerifiedSupabaseToken]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            cache_lookup("supabase_token", False)
+            return None
+        expires_at, verified = entry
+        if self._clock() >= expires_at:
+            del self._entries[key]
+            self.misses += 1
+            cache_lookup("supabase_token", False)
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        cache_lookup("supabase_token", True)
+        return verified
+
+    def put(self, key: str, verified: VerifiedSupabaseToken, expires_at: float):
+        if expires_at <= self._clock() or self.max_entries <= 0:
+            return
+        self._entries[key] = (expires_at, verified)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+_TOKEN_CACHE: Optional[_VerifiedTokenCache] = None
+
+
+def _get_token_cache() -> _VerifiedTokenCache:
+    global _TOKEN_CACHE
+    if _TOKEN_CACHE is None:
+        _TOKEN_CACHE = _VerifiedTokenCache(max_entries=get_settings().supabase_token_cache_size)
+    return _TOKEN_CACHE
+
+
+def clear_token_cache():
+    _get_token_cache().clear()
+
+
+_FINGERPRINT: Tuple[Optional[Settings], str] = (None, "")
+
+
+def _config_fingerprint() -> str:
+    """Changes whenever a setting that affects verification does, so cached results cannot outlive it."""
+    global _FINGERPRINT
+    settings = get_settings()
+    if _FINGERPRINT[0] is not settings:
+        parts = [
+            settings.supabase_jwt_secret,
+            settings.supabase_base_url,
+            settings.supabase_anon_key,
+            ",".join(settings.supabase_jwt_audiences),
+            settings.supabase_jwt_issuer,
+        ]
+        _FINGERPRINT = (settings, hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()[:16])
+    return _FINGERPRINT[1]
+
+
+def _cache_until(token: str, verified: VerifiedSupabaseToken) -> float:
+    exp = verified.claims.get("exp")
+    if isinstance(exp, (int, float)):
+        return float(exp)
+    # Verified remotely (no claims): short TTL, never past the token's own exp.
+    until = time.time() + get_settings().supabase_user_endpoint_cache_seconds
+    try:
+        unverified_exp = jwt.decode(token, options={"verify_signature": False}).get("exp")
+    except Exception:
+        unverified_exp = None
+    if isinstance(unverified_exp, (int, float)):
+        until = min(until, float(unverified_exp))
+    return until
+
+
+_INFLIGHT_VERIFICATIONS: Dict[str, "asyncio.Future[VerifiedSupabaseToken]"] = {}
+
+
 async def verify_supabase_access_token(token: str) -> VerifiedSupabaseToken:
+    """Verifies a Supabase access token.
+
+    Repeat tokens are answered from the verified-token cache; concurrent calls
+    for the same uncached token share one verification.
+    """
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest() + ":" + _config_fingerprint()
+    cache = _get_token_cache()
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    task = _INFLIGHT_VERIFICATIONS.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_verify_token(token))
+        _INFLIGHT_VERIFICATIONS[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT_VERIFICATIONS.pop(key, None))
+    verified = await asyncio.shield(task)
+    cache.put(key, verified, _cache_until(token, verified))
+    return verified
+
+
+async def _verify_token(token: str) -> VerifiedSupabaseToken:
     secret = _get_supabase_jwt_secret()
     base_url = _get_supabase_base_url()
     anon_key = _get_supabase_anon_key()
@@ -210,25 +440,56 @@ async def verify_supabase_access_token(token: str) -> VerifiedSupabaseToken:
     return VerifiedSupabaseToken(user_id=user_id, claims=claims)
 
 
-async def get_supabase_user_id_from_request(request: Request, required: bool) -> Optional[str]:
+@dataclass(frozen=True)
+class RequestAuth:
+    """Outcome of verifying a request's bearer token: a user id, or the 401 detail."""
+
+    user_id: Optional[str]
+    error: Optional[str] = None
+
+
+async def _authenticate_request(request: Request) -> RequestAuth:
     auth = request.headers.get("Authorization", "")
     if not auth:
-        if required:
-            raise HTTPException(status_code=401, detail="Missing Authorization header")
-        return None
+        return RequestAuth(None, "Missing Authorization header")
 
     parts = auth.split(" ", 1)
     if len(parts) != 2 or parts[0].lower() != "bearer" or not parts[1].strip():
-        if required:
-            raise HTTPException(status_code=401, detail="Invalid Authorization header")
-        return None
+        return RequestAuth(None, "Invalid Authorization header")
 
     token = parts[1].strip()
     try:
-        verified = await verify_supabase_access_token(token)
-        return verified.user_id
+        with span("auth.verify_token"):
+            verified = await verify_supabase_access_token(token)
+        return RequestAuth(verified.user_id)
     except Exception:
-        if required:
-            raise HTTPException(status_code=401, detail="Invalid or expired token")
-        return None
+        return RequestAuth(None, "Invalid or expired token")
+
+
+async def get_request_auth(request: Request) -> RequestAuth:
+    """Verifies the bearer token once per request; later calls reuse the result on `request.state`."""
+    cached = getattr(request.state, "supabase_auth", None)
+    if isinstance(cached, RequestAuth):
+        return cached
+    result = await _authenticate_request(request)
+    request.state.supabase_auth = result
+    return result
+
+
+async def get_supabase_user_id_from_request(request: Request, required: bool) -> Optional[str]:
+    result = await get_request_auth(request)
+    if result.user_id:
+        return result.user_id
+    if required:
+        raise HTTPException(status_code=401, detail=result.error or "Invalid or expired token")
+    return None
+
+
+async def require_supabase_user(request: Request) -> str:
+    """FastAPI dependency: the verified Supabase user id, or 401."""
+    return await get_supabase_user_id_from_request(request, required=True)
+
 
+async def optional_supabase_user(request: Request) -> Optional[str]:
+    """FastAPI dependency: the verified Supabase user id, or None."""
+    return await get_supabase_user_id_from_request(request, required=False)
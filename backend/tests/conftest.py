@@ -5,7 +5,25 @@ import os
 os.environ["API_SECRET_KEY"] = ""
 os.environ["GEMINI_API_KEY"] = "test-key"
 
+import ai_proxy
 from main import app
+from settings import reload_settings
+
+
+@pytest.fixture(autouse=True)
+def _reload_settings_after_test():
+    """Settings are cached; rebuild them from the restored environment after each test."""
+    yield
+    reload_settings()
+
+
+@pytest.fixture(autouse=True)
+def _fresh_gemini_clients():
+    """Tests swap httpx.AsyncClient for fakes; don't let a pooled client outlive its test."""
+    ai_proxy._GEMINI_CLIENTS.clear()
+    yield
+    ai_proxy._GEMINI_CLIENTS.clear()
+
 
 @pytest.fixture
 def client():
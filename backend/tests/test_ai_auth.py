@@ -2,6 +2,8 @@ import time
 
 import jwt
 
+from settings import reload_settings
+
 
 class _DummyResponse:
     status_code = 200
@@ -46,6 +48,7 @@ def _make_token(secret: str, sub: str) -> str:
 def test_ai_requires_auth_when_enabled(client, monkeypatch):
     monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "1")
     monkeypatch.setenv("SUPABASE_JWT_SECRET", "test-secret")
+    reload_settings()
 
     res = client.post("/api/ai/ask", json={"prompt": "hi"})
     assert res.status_code == 401
@@ -54,6 +57,7 @@ def test_ai_requires_auth_when_enabled(client, monkeypatch):
 def test_ai_rejects_invalid_token(client, monkeypatch):
     monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "1")
     monkeypatch.setenv("SUPABASE_JWT_SECRET", "test-secret")
+    reload_settings()
 
     res = client.post(
         "/api/ai/ask",
@@ -66,11 +70,12 @@ def test_ai_rejects_invalid_token(client, monkeypatch):
 def test_ai_accepts_valid_token(client, monkeypatch):
     monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "1")
     monkeypatch.setenv("SUPABASE_JWT_SECRET", "test-secret")
+    reload_settings()
 
     import ai_proxy
 
     monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _DummyAsyncClient)
-    monkeypatch.setattr(ai_proxy, "retrieve_user_context", _noop)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", _noop)
     monkeypatch.setattr(ai_proxy, "memorize_user_action", _noop)
 
     token = _make_token("test-secret", "00000000-0000-0000-0000-000000000001")
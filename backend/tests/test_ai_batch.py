@@ -0,0 +1,141 @@
+import asyncio
+import json
+import time
+
+import jwt
+
+from settings import reload_settings
+
+
+class _DummyResponse:
+    status_code = 200
+    text = '{"ok": true}'
+
+    def __init__(self, prompt_text):
+        self._prompt_text = prompt_text
+
+    def json(self):
+        reply = self._prompt_text.rsplit("User request: ", 1)[-1]
+        return {"candidates": [{"content": {"parts": [{"text": f"re:{reply}"}]}}]}
+
+
+class _ConcurrencyTrackingClient:
+    in_flight = 0
+    max_in_flight = 0
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def post(self, *args, **kwargs):
+        cls = _ConcurrencyTrackingClient
+        cls.in_flight += 1
+        cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        try:
+            await asyncio.sleep(0.02)
+        finally:
+            cls.in_flight -= 1
+        return _DummyResponse(kwargs["json"]["contents"][0]["parts"][0]["text"])
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def _make_token(secret: str, sub: str) -> str:
+    payload = {
+        "sub": sub,
+        "aud": "authenticated",
+        "exp": int(time.time()) + 60,
+        "iat": int(time.time()),
+    }
+    return jwt.encode(payload, secret, algorithm="HS256")
+
+
+def _patch_upstream(monkeypatch, memories=None):
+    import ai_proxy
+
+    calls = {"memory": 0}
+
+    async def fake_memories(user_id, query):
+        calls["memory"] += 1
+        return memories
+
+    _ConcurrencyTrackingClient.in_flight = 0
+    _ConcurrencyTrackingClient.max_in_flight = 0
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _ConcurrencyTrackingClient)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", fake_memories)
+    monkeypatch.setattr(ai_proxy, "memorize_user_action", _noop)
+    return calls
+
+
+def test_batch_returns_results_in_order_with_one_memory_lookup(client, monkeypatch):
+    monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "1")
+    monkeypatch.setenv("SUPABASE_JWT_SECRET", "test-secret")
+    monkeypatch.setenv("AI_BATCH_CONCURRENCY", "2")
+    reload_settings()
+    calls = _patch_upstream(monkeypatch, memories=["likes mornings"])
+
+    token = _make_token("test-secret", "00000000-0000-0000-0000-0000000b0001")
+    res = client.post(
+        "/api/ai/batch",
+        json={"items": [{"id": "a", "prompt": "one"}, {"id": "b", "prompt": "two"}, {"id": "c", "prompt": "three"}]},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert res.status_code == 200
+    results = res.json()["results"]
+    assert [r["id"] for r in results] == ["a", "b", "c"]
+    assert [r["text"] for r in results] == ["re:one", "re:two", "re:three"]
+    assert results[0]["meta"]["prompt"]["memories_used"] == 1
+    assert calls["memory"] == 1
+    assert _ConcurrencyTrackingClient.max_in_flight <= 2
+
+
+def test_batch_charges_rate_limiter_with_combined_cost(client, monkeypatch):
+    monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "1")
+    monkeypatch.setenv("SUPABASE_JWT_SECRET", "test-secret")
+    monkeypatch.setenv("AI_RATE_LIMIT_PER_MINUTE", "2")
+    monkeypatch.setenv("AI_RATE_LIMIT_PER_HOUR", "100")
+    reload_settings()
+    _patch_upstream(monkeypatch)
+
+    token = _make_token("test-secret", "00000000-0000-0000-0000-0000000b0002")
+    res = client.post(
+        "/api/ai/batch",
+        json={"items": [{"prompt": "one"}, {"prompt": "two"}, {"prompt": "three"}]},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert res.status_code == 429
+    assert "Retry-After" in res.headers
+
+
+def test_batch_streams_ndjson(client, monkeypatch):
+    monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "0")
+    reload_settings()
+    _patch_upstream(monkeypatch)
+
+    res = client.post(
+        "/api/ai/batch",
+        json={"items": [{"prompt": "one"}, {"prompt": "two"}], "stream": True},
+    )
+
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in res.text.splitlines() if line]
+    assert sorted(r["index"] for r in lines) == [0, 1]
+
+
+def test_batch_rejects_too_many_items(client, monkeypatch):
+    monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "0")
+    monkeypatch.setenv("AI_BATCH_MAX_ITEMS", "2")
+    reload_settings()
+    _patch_upstream(monkeypatch)
+
+    res = client.post("/api/ai/batch", json={"items": [{"prompt": str(i)} for i in range(3)]})
+    assert res.status_code == 400
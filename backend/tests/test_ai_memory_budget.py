@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from settings import reload_settings
+
+
+class _DummyResponse:
+    status_code = 200
+    text = '{"ok": true}'
+
+    def json(self):
+        return {
+            "candidates": [
+                {"content": {"parts": [{"text": "hello"}]}}
+            ]
+        }
+
+
+class _RecordingAsyncClient:
+    payloads = []
+
+    def __init__(self, *args, **kwargs):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def post(self, *args, **kwargs):
+        _RecordingAsyncClient.payloads.append(kwargs.get("json"))
+        return _DummyResponse()
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def _prompt_text(payload):
+    return payload["contents"][0]["parts"][0]["text"]
+
+
+def test_memory_context_injected_within_budget(client, monkeypatch):
+    monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "0")
+    reload_settings()
+    import ai_proxy
+
+    async def fast_retrieve(user_id, query):
+        return [f"memory-for-{user_id}"]
+
+    _RecordingAsyncClient.payloads = []
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _RecordingAsyncClient)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", fast_retrieve)
+    monkeypatch.setattr(ai_proxy, "memorize_user_action", _noop)
+
+    res = client.post("/api/ai/ask", json={"prompt": "hi", "user_id": "budget-user-1"})
+    assert res.status_code == 200
+    assert "memory-for-budget-user-1" in _prompt_text(_RecordingAsyncClient.payloads[-1])
+
+
+def test_slow_memory_retrieval_is_dropped_after_budget(client, monkeypatch):
+    monkeypatch.setenv("REQUIRE_SUPABASE_AUTH_FOR_AI", "0")
+    monkeypatch.setenv("MEMU_RETRIEVE_BUDGET_MS", "50")
+    reload_settings()
+    import ai_proxy
+
+    async def slow_retrieve(user_id, query):
+        await asyncio.sleep(2)
+        return ["too-late"]
+
+    _RecordingAsyncClient.payloads = []
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _RecordingAsyncClient)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", slow_retrieve)
+    monkeypatch.setattr(ai_proxy, "memorize_user_action", _noop)
+
+    started = time.monotonic()
+    res = client.post("/api/ai/ask", json={"prompt": "hi", "user_id": "budget-user-2"})
+    elapsed = time.monotonic() - started
+
+    assert res.status_code == 200
+    assert elapsed < 1.0
+    assert "too-late" not in _prompt_text(_RecordingAsyncClient.payloads[-1])
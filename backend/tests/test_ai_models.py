@@ -0,0 +1,130 @@
+import asyncio
+
+import ai_proxy
+from ai_models import ModelRegistry
+
+
+class _Response:
+    text = "upstream error"
+    headers = {}
+
+    def __init__(self, status_code, reply):
+        self.status_code = status_code
+        self._reply = reply
+
+    def json(self):
+        return {"candidates": [{"content": {"parts": [{"text": self._reply}]}}]}
+
+
+def _mock_upstream(behaviour):
+    """Fake httpx.AsyncClient; `behaviour` maps model name -> (delay seconds, status)."""
+
+    class _Client:
+        urls = []
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            return False
+
+        async def post(self, url, **kwargs):
+            _Client.urls.append(url)
+            model = url.rsplit("/models/", 1)[1].split(":", 1)[0]
+            delay, status = behaviour[model]
+            await asyncio.sleep(delay)
+            return _Response(status, f"from {model}")
+
+    return _Client
+
+
+async def _no_memories(user_id, query):
+    return None
+
+
+def _install(monkeypatch, registry, behaviour):
+    import ai_models
+    import ai_proxy
+
+    client_cls = _mock_upstream(behaviour)
+    monkeypatch.setattr(ai_models, "_REGISTRY", registry)
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", client_cls)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", _no_memories)
+    return client_cls
+
+
+def test_small_prompts_route_to_cheaper_model():
+    registry = ModelRegistry(primary="pro", fallback="flash", small_prompt_model="flash", small_prompt_tokens=100)
+
+    assert registry.route(50) == ("flash", None)
+    assert registry.route(500) == ("pro", "flash")
+    assert ModelRegistry(primary="pro").route(50) == ("pro", None)
+
+
+def test_hedge_delay_tracks_p95_once_warm():
+    registry = ModelRegistry(primary="pro", hedge_delay_ms=2000, hedge_min_delay_ms=10)
+    assert registry.hedge_delay("pro") == 2.0
+
+    stats = registry.stats_for("pro")
+    for i in range(100):
+        stats.record((i + 1) / 1000.0, ok=True)
+    assert registry.hedge_delay("pro") == 0.095
+    assert registry.snapshot()["models"]["pro"]["p95_ms"] == 95
+
+
+def test_slow_primary_is_hedged_to_fallback(client, monkeypatch):
+    registry = ModelRegistry(base_url="http://mock-gemini/v1beta/", primary="pro", fallback="flash", hedge_delay_ms=20)
+    client_cls = _install(monkeypatch, registry, {"pro": (1.0, 200), "flash": (0.0, 200)})
+
+    res = client.post("/api/ai/ask", json={"prompt": "hello"})
+    assert res.status_code == 200
+    assert res.json()["text"] == "from flash"
+    assert res.json()["meta"]["model"] == "flash"
+    assert client_cls.urls[0] == "http://mock-gemini/v1beta/models/pro:generateContent"
+    assert registry.hedges == 1 and registry.hedge_wins == 1
+
+
+def test_fast_primary_is_not_hedged(client, monkeypatch):
+    registry = ModelRegistry(primary="pro", fallback="flash", hedge_delay_ms=1000)
+    client_cls = _install(monkeypatch, registry, {"pro": (0.0, 200), "flash": (0.0, 200)})
+
+    res = client.post("/api/ai/ask", json={"prompt": "hello"})
+    assert res.json()["meta"]["model"] == "pro"
+    assert len(client_cls.urls) == 1
+    assert registry.hedges == 0
+
+
+def test_failing_primary_falls_back_without_waiting(client, monkeypatch):
+    registry = ModelRegistry(primary="pro", fallback="flash", hedge_delay_ms=5000)
+    _install(monkeypatch, registry, {"pro": (0.0, 500), "flash": (0.0, 200)})
+
+    res = client.post("/api/ai/ask", json={"prompt": "hello"})
+    assert res.status_code == 200
+    assert res.json()["meta"]["model"] == "flash"
+    assert registry.snapshot()["models"]["pro"]["errors"] == 1
+
+
+def test_client_error_is_not_hedged(client, monkeypatch):
+    registry = ModelRegistry(primary="pro", fallback="flash", hedge_delay_ms=5000)
+    client_cls = _install(monkeypatch, registry, {"pro": (0.0, 400), "flash": (0.0, 200)})
+
+    res = client.post("/api/ai/ask", json={"prompt": "hello"})
+    assert res.status_code != 200
+    assert len(client_cls.urls) == 1
+    assert registry.hedges == 0
+
+
+def test_gemini_calls_share_one_pooled_client(client, monkeypatch):
+    registry = ModelRegistry(primary="pro", fallback="flash", hedge_delay_ms=1000)
+    client_cls = _install(monkeypatch, registry, {"pro": (0.0, 200), "flash": (0.0, 200)})
+    created = []
+    monkeypatch.setattr(
+        ai_proxy.httpx, "AsyncClient", lambda **kwargs: created.append(kwargs) or client_cls()
+    )
+
+    for _ in range(3):
+        assert client.post("/api/ai/ask", json={"prompt": "hello"}).status_code == 200
+    assert len(created) == 1
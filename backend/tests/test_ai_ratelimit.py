@@ -2,6 +2,8 @@ import time
 
 import jwt
 
+from settings import reload_settings
+
 
 class _DummyResponse:
     status_code = 200
@@ -48,11 +50,12 @@ def test_ai_rate_limit_blocks_excess(client, monkeypatch):
     monkeypatch.setenv("SUPABASE_JWT_SECRET", "test-secret")
     monkeypatch.setenv("AI_RATE_LIMIT_PER_MINUTE", "1")
     monkeypatch.setenv("AI_RATE_LIMIT_PER_HOUR", "1")
+    reload_settings()
 
     import ai_proxy
 
     monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _DummyAsyncClient)
-    monkeypatch.setattr(ai_proxy, "retrieve_user_context", _noop)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", _noop)
     monkeypatch.setattr(ai_proxy, "memorize_user_action", _noop)
 
     token = _make_token("test-secret", "00000000-0000-0000-0000-00000000abcd")
@@ -0,0 +1,118 @@
+from settings import reload_settings
+
+
+class _UsageResponse:
+    status_code = 200
+    text = '{"ok": true}'
+
+    def __init__(self, usage):
+        self._usage = usage
+
+    def json(self):
+        data = {"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}
+        if self._usage is not None:
+            data["usageMetadata"] = {"totalTokenCount": self._usage}
+        return data
+
+
+def _client_with_usage(usage):
+    class _Client:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            return False
+
+        async def post(self, *args, **kwargs):
+            return _UsageResponse(usage)
+
+    return _Client
+
+
+async def _no_memories(user_id, query):
+    return None
+
+
+async def _noop(*args, **kwargs):
+    return None
+
+
+def _setup(monkeypatch, usage):
+    import ai_proxy
+    import rate_limiter
+
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    reload_settings()
+    monkeypatch.setattr(rate_limiter, "_GLOBAL_LIMITER", rate_limiter.RateLimiter())
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _client_with_usage(usage))
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", _no_memories)
+    monkeypatch.setattr(ai_proxy, "memorize_user_action", _noop)
+
+
+def test_ask_reserves_estimate_and_settles_with_actual_usage(client, monkeypatch):
+    monkeypatch.setenv("AI_TOKEN_BUDGET_PER_MINUTE", "5000")
+    _setup(monkeypatch, usage=120)
+
+    res = client.post("/api/ai/ask", json={"prompt": "plan my day", "max_tokens": 1000})
+    assert res.status_code == 200
+    assert res.json()["meta"]["usage_tokens"] == 120
+
+    budget = client.get("/api/ai/status").json()["token_budget"]
+    assert budget["per_minute"] == 5000
+    # The 1000+ token reservation was refunded down to the real usage.
+    assert 5000 - 120 - 1 <= budget["remaining"] <= 5000 - 120
+
+
+def test_ask_denied_when_token_budget_exhausted(client, monkeypatch):
+    monkeypatch.setenv("AI_TOKEN_BUDGET_PER_MINUTE", "1500")
+    _setup(monkeypatch, usage=1400)
+
+    assert client.post("/api/ai/ask", json={"prompt": "hi", "max_tokens": 500}).status_code == 200
+
+    res = client.post("/api/ai/ask", json={"prompt": "hi", "max_tokens": 500})
+    assert res.status_code == 429
+    assert int(res.headers["Retry-After"]) >= 1
+
+
+def test_failed_upstream_call_refunds_reservation(client, monkeypatch):
+    import ai_proxy
+
+    monkeypatch.setenv("AI_TOKEN_BUDGET_PER_MINUTE", "3000")
+    _setup(monkeypatch, usage=None)
+
+    class _FailingClient(_client_with_usage(None)):
+        async def post(self, *args, **kwargs):
+            resp = _UsageResponse(None)
+            resp.status_code = 500
+            return resp
+
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", _FailingClient)
+
+    res = client.post("/api/ai/ask", json={"prompt": "hi", "max_tokens": 1000})
+    assert res.status_code >= 500
+    assert client.get("/api/ai/status").json()["token_budget"]["remaining"] == 3000
+
+
+def test_global_token_budget_shared_across_callers(monkeypatch):
+    import asyncio
+
+    import rate_limiter
+
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    monkeypatch.setenv("AI_GLOBAL_TOKEN_BUDGET_PER_MINUTE", "100")
+    reload_settings()
+    limiter = rate_limiter.RateLimiter()
+
+    async def run():
+        first = await limiter.consume_all([("ai_tokens", "a", 80), ("ai_tokens_global", "global", 80)])
+        second = await limiter.consume_all([("ai_tokens", "b", 80), ("ai_tokens_global", "global", 80)])
+        return first, second, await limiter.remaining("ai_tokens", "b")
+
+    first, second, b_remaining = asyncio.run(run())
+    assert all(d.allowed for d in first)
+    assert not all(d.allowed for d in second)
+    # The user-level charge for "b" was rolled back when the global one was denied.
+    assert b_remaining == rate_limiter.get_policy("ai_tokens").per_minute
@@ -49,3 +49,45 @@ class TestAPIKeyAuth:
         # This is a basic sanity check on the middleware class
         middleware = APIKeyAuthMiddleware(app=None)
         assert middleware is not None
+
+    def test_bearer_token_verified_once_per_request(self, monkeypatch):
+        """Middleware and handler share one verification via request.state"""
+        from fastapi.testclient import TestClient
+
+        import supabase_admin
+        import supabase_auth
+        from auth import APIKeyAuthMiddleware
+        from main import app
+        from supabase_auth import VerifiedSupabaseToken
+
+        calls = []
+
+        async def fake_verify(token: str):
+            calls.append(token)
+            return VerifiedSupabaseToken(user_id="user-1", claims={})
+
+        async def fake_delete_user(user_id: str):
+            pass
+
+        monkeypatch.setattr(supabase_auth, "verify_supabase_access_token", fake_verify)
+        monkeypatch.setattr(supabase_admin, "delete_user", fake_delete_user)
+        client = TestClient(APIKeyAuthMiddleware(app, api_key="server-key"))
+
+        response = client.delete("/api/auth/account", headers={"Authorization": "Bearer abc"})
+        assert response.status_code == 204
+        assert calls == ["abc"]
+
+    def test_api_key_required_when_configured(self):
+        """Protected paths need the key; public paths and valid keys pass"""
+        from fastapi.testclient import TestClient
+
+        from auth import APIKeyAuthMiddleware
+        from main import app
+
+        client = TestClient(APIKeyAuthMiddleware(app, api_key="server-key"))
+
+        assert client.get("/api/persistence/load").status_code == 401
+        assert client.get("/api/persistence/load", headers={"X-API-Key": "wrong"}).status_code == 401
+        assert client.get("/api/persistence/load", headers={"X-API-Key": "server-key"}).status_code == 200
+        assert client.get("/health").status_code == 200
+        assert client.post("/api/ai/ask", json={"prompt": "hi"}).json()["detail"] == "Invalid or missing API key"
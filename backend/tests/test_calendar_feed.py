@@ -0,0 +1,233 @@
+import json
+import os
+from datetime import datetime
+
+import pytz
+
+from calendar_feed import CalendarFeedCache
+
+SEOUL = pytz.timezone("Asia/Seoul")
+
+
+class _Storage:
+    def __init__(self, data):
+        self.data = data
+        self.version = (1, 1, 1_700_000_000 * 10**9)
+        self.loads = 0
+
+    def state_version(self):
+        return self.version
+
+    def load_state(self):
+        self.loads += 1
+        return self.data
+
+    def save(self, data):
+        self.data = data
+        self.version = (self.version[0] + 1, 1, self.version[2] + 10**9)
+
+
+class _Clock:
+    def __init__(self, when):
+        self.now = SEOUL.localize(when).timestamp()
+
+    def __call__(self):
+        return self.now
+
+
+def _routine(title="Morning Exercise"):
+    return {"id": "r1", "title": title, "time": "08:00", "type": "health"}
+
+
+def _cache(storage, clock):
+    return CalendarFeedCache(storage, render=lambda data, options, now: f"ICS {data['routines']}", clock=clock)
+
+
+def test_feed_is_rendered_once_until_state_or_date_changes():
+    storage = _Storage({"routines": [_routine()], "pipelines": []})
+    clock = _Clock(datetime(2026, 3, 2, 12, 0))
+    cache = _cache(storage, clock)
+
+    first = cache.get()
+    assert cache.get() is first
+    assert cache.renders == 1
+    assert storage.loads == 1
+
+    # A save that does not touch routines/pipelines re-reads the file but keeps the feed.
+    storage.save({"routines": [_routine()], "pipelines": [], "completionHistory": [{"id": "e1"}]})
+    assert cache.get().etag == first.etag
+    assert cache.renders == 1
+
+    storage.save({"routines": [_routine("Run")], "pipelines": []})
+    changed = cache.get()
+    assert changed.etag != first.etag
+    assert cache.renders == 2
+
+    clock.now = SEOUL.localize(datetime(2026, 3, 3, 0, 0, 1)).timestamp()
+    rolled = cache.get()
+    assert rolled.etag != changed.etag
+    assert rolled.last_modified.timestamp() == SEOUL.localize(datetime(2026, 3, 3)).timestamp()
+    assert cache.renders == 3
+
+
+def test_conditional_headers():
+    storage = _Storage({"routines": [_routine()], "pipelines": []})
+    feed = _cache(storage, _Clock(datetime(2026, 3, 2, 12, 0))).get()
+    last_modified = feed.headers["Last-Modified"]
+
+    assert feed.is_not_modified(feed.etag, None)
+    assert feed.is_not_modified(f'"other", W/{feed.etag}', None)
+    assert not feed.is_not_modified('"other"', last_modified)
+    assert feed.is_not_modified(None, last_modified)
+    assert not feed.is_not_modified(None, "Mon, 02 Mar 2020 00:00:00 GMT")
+    assert not feed.is_not_modified(None, "not a date")
+
+
+def test_feed_endpoint_answers_304_for_matching_etag(client):
+    res = client.get("/api/calendar/feed")
+    assert res.status_code == 200
+    assert "BEGIN:VCALENDAR" in res.text
+
+    etag = res.headers["ETag"]
+    again = client.get("/api/calendar/feed", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.content == b""
+    assert again.headers["ETag"] == etag
+
+    since = client.get("/api/calendar/feed", headers={"If-Modified-Since": res.headers["Last-Modified"]})
+    assert since.status_code == 304
+
+
+def test_store_publishes_precompressed_feed_and_rerenders_only_on_change(tmp_path):
+    import gzip
+
+    from calendar_feed import CalendarFeedStore
+
+    clock = _Clock(datetime(2026, 3, 2, 12, 0))
+    store = CalendarFeedStore(str(tmp_path), render=lambda data, options, now: f"ICS {data['routines']}", clock=clock)
+
+    token = store.publish("user-1", {"routines": [_routine()], "pipelines": []})
+    assert store.publish("user-1", {"routines": [_routine()], "pipelines": []}) == token
+    assert store.renders == 1
+
+    gz = store.open(token, "gzip, deflate")
+    assert gz.content_encoding == "gzip"
+    assert gz.headers["Content-Encoding"] == "gzip"
+    with open(gz.path, "rb") as f:
+        assert gzip.decompress(f.read()).decode("utf-8") == f"ICS {[_routine()]}"
+    plain = store.open(token, "gzip;q=0")
+    assert plain.content_encoding is None
+    # Each stored representation has its own strong ETag.
+    assert gz.etag == plain.etag[:-1] + '-gz"'
+    assert not gz.is_not_modified(plain.etag, None)
+    assert store.peek(token, "gzip") == gz
+
+    # Polls read only validators; the published data lives beside them.
+    with open(tmp_path / "feeds" / os.path.basename(os.path.dirname(gz.path)) / "meta.json") as f:
+        assert "data" not in json.load(f)
+
+    # Date rollover is rendered lazily on the next poll, never by peek.
+    clock.now = SEOUL.localize(datetime(2026, 3, 3, 8, 0)).timestamp()
+    assert store.peek(token) is None
+    assert store.open(token).etag != plain.etag
+    assert store.renders == 2
+    assert store.peek(token) is not None
+
+    store.publish("user-1", {"routines": [_routine("Run")], "pipelines": []})
+    assert store.renders == 3
+
+    assert store.open("unknown-token") is None
+    assert store.revoke("user-1") is True
+    assert store.open(token) is None
+    assert store.publish("user-1", {"routines": [], "pipelines": []}) != token
+
+
+def test_subscription_endpoints_serve_private_feed(client, monkeypatch, tmp_path):
+    import main
+    import supabase_auth
+    from calendar_feed import CalendarFeedStore
+    from supabase_auth import VerifiedSupabaseToken
+
+    async def fake_verify(token: str):
+        return VerifiedSupabaseToken(user_id=f"user-{token}", claims={})
+
+    monkeypatch.setattr(supabase_auth, "verify_supabase_access_token", fake_verify)
+    monkeypatch.setattr(main, "feed_store", CalendarFeedStore(str(tmp_path)))
+
+    assert client.put("/api/calendar/subscription", json={"routines": []}).status_code == 401
+
+    res = client.put(
+        "/api/calendar/subscription",
+        json={"routines": [_routine("Private Routine")], "pipelines": []},
+        headers={"Authorization": "Bearer a"},
+    )
+    assert res.status_code == 200
+    feed_url = res.json()["feed_url"]
+    assert "/api/calendar/feed?token=" in feed_url
+
+    feed = client.get(feed_url, headers={"Accept-Encoding": "gzip"})
+    assert feed.status_code == 200
+    assert feed.headers["content-encoding"] == "gzip"
+    assert feed.headers["content-type"] == "text/calendar; charset=utf-8"
+    assert "Private Routine" in feed.text
+    assert client.get(feed_url, headers={"If-None-Match": feed.headers["ETag"]}).status_code == 304
+
+    assert client.delete("/api/calendar/subscription", headers={"Authorization": "Bearer a"}).status_code == 204
+    assert client.get(feed_url).status_code == 404
+
+
+def test_feed_endpoint_accepts_allowlisted_timezone_and_horizon(client, monkeypatch):
+    from settings import reload_settings
+
+    monkeypatch.setenv("CALENDAR_FEED_TIMEZONES", "Europe/Berlin, UTC")
+    reload_settings()
+
+    res = client.get("/api/calendar/feed", params={"tz": "Europe/Berlin", "past_days": 0, "future_days": 7})
+    assert res.status_code == 200
+    assert "X-WR-TIMEZONE:Europe/Berlin" in res.text
+    assert res.headers["ETag"] != client.get("/api/calendar/feed").headers["ETag"]
+
+    # Anything outside the allowlists is refused before it can add a cache variant.
+    assert client.get("/api/calendar/feed", params={"tz": "America/New_York"}).status_code == 400
+    assert client.get("/api/calendar/feed", params={"tz": "Mars/Base"}).status_code == 400
+    assert client.get("/api/calendar/feed", params={"past_days": 1}).status_code == 400
+    assert client.get("/api/calendar/feed", params={"future_days": 366}).status_code == 400
+
+
+def test_peek_serves_only_current_cached_feeds():
+    storage = _Storage({"routines": [_routine()], "pipelines": []})
+    cache = _cache(storage, _Clock(datetime(2026, 3, 2, 12, 0)))
+
+    assert cache.peek() is None
+    feed = cache.get()
+    assert cache.peek() is feed
+
+    storage.save({"routines": [_routine("Run")], "pipelines": []})
+    assert cache.peek() is None
+    assert storage.loads == 1
+
+
+def test_feed_endpoint_has_its_own_quota(client, monkeypatch):
+    import rate_limiter
+    from settings import reload_settings
+
+    monkeypatch.setenv("RATE_LIMIT_CALENDAR_FEED_PER_MINUTE", "2")
+    reload_settings()
+    monkeypatch.setattr(rate_limiter, "_GLOBAL_LIMITER", rate_limiter.RateLimiter())
+
+    assert [client.get("/api/calendar/feed").status_code for _ in range(3)] == [200, 200, 429]
+
+
+def test_private_feed_quota_is_keyed_by_token(client, monkeypatch):
+    import rate_limiter
+    from settings import reload_settings
+
+    monkeypatch.setenv("RATE_LIMIT_CALENDAR_FEED_PER_MINUTE", "2")
+    monkeypatch.setenv("RATE_LIMIT_CALENDAR_FEED_TOKEN_PER_MINUTE", "2")
+    reload_settings()
+    monkeypatch.setattr(rate_limiter, "_GLOBAL_LIMITER", rate_limiter.RateLimiter())
+
+    # Calendar services poll many feeds from one IP: each token has its own bucket.
+    assert [client.get("/api/calendar/feed?token=a").status_code for _ in range(3)] == [404, 404, 429]
+    assert client.get("/api/calendar/feed?token=b").status_code == 404
+    assert [client.get("/api/calendar/feed").status_code for _ in range(2)] == [200, 200]
@@ -151,3 +151,90 @@ class TestCalendarGeneration:
             ics = generate_calendar_ics(data)
             assert f"{day.upper()} Mission" in ics
             assert f"mission-week-{day}-" in ics
+
+    def test_routine_is_one_recurring_event(self):
+        """Each routine should be a single daily RRULE event covering the same 37-day window"""
+        from datetime import date, timedelta
+
+        from icalendar import Calendar
+
+        data = {
+            "pipelines": [],
+            "routines": [{"id": "r1", "title": "Morning Exercise", "time": "08:00", "type": "health"}],
+            "sopLibrary": []
+        }
+
+        cal = Calendar.from_ical(generate_calendar_ics(data))
+        events = cal.walk("VEVENT")
+        assert len(events) == 1
+        assert len(cal.walk("VTIMEZONE")) == 1
+
+        event = events[0]
+        assert event["RRULE"]["FREQ"] == ["DAILY"]
+        assert event["RRULE"]["COUNT"] == [37]
+        start = event.decoded("DTSTART")
+        assert (start.hour, start.minute) == (8, 0)
+        assert start.date() + timedelta(days=7) >= date.today() - timedelta(days=1)
+
+    def test_mission_is_one_weekly_event(self):
+        """Each weekly pipeline should be a single all-day weekly RRULE event"""
+        from datetime import date
+
+        from icalendar import Calendar
+
+        data = {
+            "pipelines": [{"id": "week-wed", "title": "Review", "subtitle": "", "steps": []}],
+            "routines": [],
+            "sopLibrary": []
+        }
+
+        events = Calendar.from_ical(generate_calendar_ics(data)).walk("VEVENT")
+        assert len(events) == 1
+        assert events[0]["RRULE"]["FREQ"] == ["WEEKLY"]
+        assert events[0]["RRULE"]["COUNT"] == [6]
+        start = events[0].decoded("DTSTART")
+        assert isinstance(start, date) and start.weekday() == 2
+
+    def test_timezone_and_horizon_options(self):
+        """Timezone and window come from CalendarOptions; `now` pins the render date"""
+        from datetime import date, datetime
+
+        import pytz
+        from icalendar import Calendar
+
+        from calendar_gen import CalendarOptions
+
+        data = {
+            "pipelines": [{"id": "week-mon", "title": "Plan", "subtitle": "", "steps": []}],
+            "routines": [{"id": "r1", "title": "Standup", "time": "09:30", "type": "work"}],
+        }
+        options = CalendarOptions(timezone="America/New_York", past_days=0, future_days=14)
+        now = pytz.utc.localize(datetime(2026, 3, 4, 12, 0))  # a Wednesday
+
+        ics = generate_calendar_ics(data, options, now=now)
+        assert "X-WR-TIMEZONE:America/New_York" in ics
+        routine, mission = Calendar.from_ical(ics).walk("VEVENT")
+        assert routine.decoded("DTSTART") == pytz.timezone("America/New_York").localize(datetime(2026, 3, 4, 9, 30))
+        assert routine["RRULE"]["COUNT"] == [14]
+        assert mission.decoded("DTSTART") == date(2026, 3, 2)
+        assert mission["RRULE"]["COUNT"] == [2]
+
+    def test_invalid_options_rejected(self):
+        """Unknown timezones and out-of-range horizons raise ValueError"""
+        from calendar_gen import CalendarOptions
+
+        for kwargs in ({"timezone": "Mars/Base"}, {"past_days": -1}, {"future_days": 0}, {"future_days": 1000}):
+            with pytest.raises(ValueError):
+                CalendarOptions(**kwargs)
+
+    def test_vtimezone_built_once_per_tzid(self):
+        """Renders reuse the cached VTIMEZONE instead of rebuilding it"""
+        from calendar_gen import _vtimezone
+
+        data = {"pipelines": [], "routines": [{"id": "r1", "title": "Standup", "time": "09:30", "type": "work"}]}
+        first = generate_calendar_ics(data)
+        misses = _vtimezone.cache_info().misses
+
+        assert "BEGIN:VTIMEZONE" in generate_calendar_ics(data)
+        assert _vtimezone.cache_info().misses == misses
+        assert first.count("BEGIN:VTIMEZONE") == 1
@@ -0,0 +1,133 @@
+import asyncio
+
+import pytest
+
+import memory_service
+
+
+@pytest.fixture(autouse=True)
+def _fresh_cache(monkeypatch):
+    monkeypatch.setattr(memory_service, "_MEMU_CLIENT", None)
+    memory_service.clear_context_cache()
+    yield
+    memory_service.clear_context_cache()
+
+
+def _counting_fetch(monkeypatch, memories=None, delay=0.0):
+    calls = []
+
+    async def fake_fetch(user_id, query):
+        calls.append((user_id, query))
+        if delay:
+            await asyncio.sleep(delay)
+        return list(memories or [f"memory of {user_id}"])
+
+    monkeypatch.setattr(memory_service, "_fetch_user_memories", fake_fetch)
+    return calls
+
+
+async def test_repeated_queries_hit_cache(monkeypatch):
+    calls = _counting_fetch(monkeypatch)
+
+    first = await memory_service.retrieve_user_context("u1", "What next?")
+    second = await memory_service.retrieve_user_context("u1", "  what   NEXT? ")
+
+    assert first == second == "memory of u1"
+    assert len(calls) == 1
+    stats = memory_service.get_context_cache_stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+    assert stats["hit_ratio"] == 0.5
+
+
+async def test_concurrent_queries_share_one_fetch(monkeypatch):
+    calls = _counting_fetch(monkeypatch, delay=0.05)
+
+    results = await asyncio.gather(
+        *(memory_service.retrieve_user_memories("u1", "plan my day") for _ in range(5))
+    )
+
+    assert all(r == ["memory of u1"] for r in results)
+    assert len(calls) == 1
+
+
+class _FakeMemU:
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.paths = []
+
+    async def post(self, path, payload, timeout):
+        self.paths.append(path)
+        return type("Response", (), {"status_code": self.status_code})()
+
+
+async def test_memorize_invalidates_user_entries(monkeypatch):
+    calls = _counting_fetch(monkeypatch)
+    monkeypatch.setattr(memory_service, "get_memu_client", lambda: _FakeMemU())
+
+    await memory_service.retrieve_user_memories("u1", "q")
+    await memory_service.retrieve_user_memories("u2", "q")
+    await memory_service.memorize_user_action("u1", "routine_completed", {})
+    await memory_service.retrieve_user_memories("u1", "q")
+    await memory_service.retrieve_user_memories("u2", "q")
+
+    assert calls.count(("u1", "q")) == 2
+    assert calls.count(("u2", "q")) == 1
+
+
+@pytest.mark.parametrize("action_type,status_code", [("ai_interaction", 200), ("routine_completed", 503)])
+async def test_memorize_keeps_cache_when_nothing_changed(monkeypatch, action_type, status_code):
+    calls = _counting_fetch(monkeypatch)
+    memu = _FakeMemU(status_code)
+    monkeypatch.setattr(memory_service, "get_memu_client", lambda: memu)
+
+    await memory_service.retrieve_user_memories("u1", "q")
+    await memory_service.memorize_user_action("u1", action_type, {})
+    await memory_service.retrieve_user_memories("u1", "q")
+
+    assert memu.paths == ["/memorize"]
+    assert len(calls) == 1
+    assert memory_service.get_context_cache_stats()["invalidations"] == 0
+
+
+async def test_abandoned_lookup_still_fills_cache(monkeypatch):
+    calls = _counting_fetch(monkeypatch, delay=0.05)
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(memory_service.retrieve_user_memories("u1", "q"), timeout=0.01)
+    await asyncio.sleep(0.08)
+
+    assert await memory_service.retrieve_user_memories("u1", "q") == ["memory of u1"]
+    assert len(calls) == 1
+
+
+async def test_memorize_during_fetch_discards_result_and_prunes_generation(monkeypatch):
+    calls = _counting_fetch(monkeypatch, delay=0.05)
+    monkeypatch.setattr(memory_service, "get_memu_client", lambda: _FakeMemU())
+    cache = memory_service._CONTEXT_CACHE
+
+    lookup = asyncio.ensure_future(memory_service.retrieve_user_memories("u1", "q"))
+    await asyncio.sleep(0.01)
+    await memory_service.memorize_user_action("u1", "routine_completed", {})
+    await lookup
+    await memory_service.retrieve_user_memories("u1", "q")
+
+    assert len(calls) == 2
+    # Generations exist only while a user's fetch is in flight, so arbitrary user ids don't accumulate.
+    for user in ("u2", "u3"):
+        await memory_service.memorize_user_action(user, "routine_completed", {})
+    assert cache._generation == {}
+
+
+async def test_failed_fetch_is_not_cached(monkeypatch):
+    calls = []
+
+    async def failing_fetch(user_id, query):
+        calls.append(user_id)
+        return None
+
+    monkeypatch.setattr(memory_service, "_fetch_user_memories", failing_fetch)
+
+    assert await memory_service.retrieve_user_context("u1", "q") is None
+    assert await memory_service.retrieve_user_context("u1", "q") is None
+    assert len(calls) == 2
@@ -0,0 +1,108 @@
+import httpx
+import pytest
+
+import memory_service
+from memory_service import MemUClient, MemUUnavailableError
+
+
+class _Response:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def json(self):
+        return {"memories": [{"content": "likes mornings"}]}
+
+
+class _FakeHttp:
+    def __init__(self, calls, status_code=200, fail=False):
+        self.calls = calls
+        self.status_code = status_code
+        self.fail = fail
+        self.closed = False
+
+    async def post(self, url, **kwargs):
+        self.calls.append(url)
+        if self.fail:
+            raise httpx.ConnectError("refused")
+        return _Response(self.status_code)
+
+    async def get(self, url, **kwargs):
+        return await self.post(url, **kwargs)
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def test_circuit_opens_after_consecutive_failures():
+    calls = []
+    client = MemUClient(
+        "http://memu.test", failure_threshold=2, reset_timeout=60, http_client=_FakeHttp(calls, fail=True)
+    )
+
+    for _ in range(2):
+        with pytest.raises(httpx.ConnectError):
+            await client.post("/retrieve", {}, timeout=1.0)
+
+    assert client.breaker.state == "open"
+    with pytest.raises(MemUUnavailableError):
+        await client.post("/retrieve", {}, timeout=1.0)
+    assert len(calls) == 2
+
+
+async def test_half_open_trial_closes_circuit_on_success():
+    calls = []
+    client = MemUClient("http://memu.test", failure_threshold=1, reset_timeout=0.01, http_client=_FakeHttp(calls))
+    client.breaker.trip()
+    client.breaker._opened_at -= 1
+
+    assert client.breaker.state == "half_open"
+    res = await client.post("/retrieve", {}, timeout=1.0)
+    assert res.status_code == 200
+    assert client.breaker.state == "closed"
+
+
+async def test_probe_updates_circuit():
+    calls = []
+    http = _FakeHttp(calls, fail=True)
+    client = MemUClient("http://memu.test", failure_threshold=3, reset_timeout=60, http_client=http)
+
+    assert await client.probe() is False
+    assert client.available is False
+
+    http.fail = False
+    assert await client.probe() is True
+    assert client.available is True
+    assert calls == ["http://memu.test/health"] * 2
+
+
+async def test_client_reuses_one_pool_until_closed(monkeypatch):
+    created = []
+
+    def make_client(**kwargs):
+        created.append(_FakeHttp([]))
+        return created[-1]
+
+    monkeypatch.setattr(memory_service.httpx, "AsyncClient", make_client)
+    client = MemUClient("http://memu.test")
+
+    await client.probe()
+    await client.post("/retrieve", {}, timeout=1.0)
+    await client.post("/memorize", {}, timeout=1.0)
+    assert len(created) == 1
+    assert created[0].calls == ["http://memu.test/health", "http://memu.test/retrieve", "http://memu.test/memorize"]
+
+    await client.aclose()
+    assert created[0].closed
+    await client.post("/retrieve", {}, timeout=1.0)
+    assert len(created) == 2
+
+
+async def test_retrieve_fails_fast_when_memu_down(monkeypatch):
+    memory_service.clear_context_cache()
+    calls = []
+    client = MemUClient("http://memu.test", failure_threshold=1, reset_timeout=60, http_client=_FakeHttp(calls))
+    client.breaker.trip()
+    monkeypatch.setattr(memory_service, "_MEMU_CLIENT", client)
+
+    assert await memory_service.retrieve_user_context("u1", "q") is None
+    assert calls == []
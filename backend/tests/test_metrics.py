@@ -0,0 +1,54 @@
+from metrics import Counter, Histogram, Registry
+
+
+def test_histogram_and_counter_exposition():
+    registry = Registry()
+    latency = registry.register(Histogram("t_seconds", "Latency.", ("stage",), buckets=(0.1, 1.0)))
+    hits = registry.register(Counter("t_hits_total", "Hits.", ("cache", "result")))
+
+    latency.observe(0.05, "a")
+    latency.observe(0.5, "a")
+    latency.observe(5.0, "a")
+    hits.inc("tokens", "hit")
+    hits.inc("tokens", "hit")
+
+    text = registry.render()
+    assert "# TYPE t_seconds histogram" in text
+    assert 't_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 't_seconds_bucket{stage="a",le="1.0"} 2' in text
+    assert 't_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 't_seconds_count{stage="a"} 3' in text
+    assert 't_hits_total{cache="tokens",result="hit"} 2' in text
+
+
+
+def test_updates_from_worker_threads_are_not_lost():
+    from concurrent.futures import ThreadPoolExecutor
+
+    latency = Histogram("t_seconds", "Latency.", ("stage",), buckets=(0.1,))
+    hits = Counter("t_hits_total", "Hits.", ("stage",))
+
+    def record(i):
+        for _ in range(1000):
+            latency.observe(0.05, f"s{i % 4}")
+            hits.inc(f"s{i % 4}")
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(record, range(8)))
+    assert sum(latency.count(f"s{i}") for i in range(4)) == 8000
+    assert sum(hits.value(f"s{i}") for i in range(4)) == 8000
+
+
+def test_metrics_endpoint_reports_routes_and_stages(client):
+    client.get("/health")
+    client.get("/api/persistence/load")
+    client.get("/no-such-route")
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert res.headers["content-type"].startswith("text/plain; version=0.0.4")
+    body = res.text
+    assert 'dailywave_http_request_duration_seconds_count{method="GET",route="/health",status="200"}' in body
+    assert 'route="unmatched",status="404"' in body
+    assert 'dailywave_stage_duration_seconds_count{stage="storage.load"}' in body
+    assert 'dailywave_upstream_slots{state="limit"}' in body
@@ -0,0 +1,99 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+
+from profiler import LoopLagMonitor, profile
+from settings import reload_settings
+
+ADMIN = {"X-Admin-Key": "admin-secret"}
+
+
+def _spin_until(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(100))
+
+
+def test_profile_endpoint_is_opt_in(client, monkeypatch):
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    monkeypatch.delenv("PROFILER_ENABLED", raising=False)
+    reload_settings()
+
+    assert client.get("/api/admin/profile?seconds=0.1").status_code == 401
+    assert client.get("/api/admin/profile?seconds=0.1", headers=ADMIN).status_code == 404
+
+
+def test_profile_returns_collapsed_stacks(client, monkeypatch):
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    monkeypatch.setenv("PROFILER_ENABLED", "1")
+    monkeypatch.setenv("PROFILER_MAX_SECONDS", "5")
+    reload_settings()
+
+    assert client.get("/api/admin/profile?seconds=10", headers=ADMIN).status_code == 400
+
+    stop = threading.Event()
+    worker = threading.Thread(target=_spin_until, args=(stop,), name="busy worker")
+    worker.start()
+    try:
+        res = client.get("/api/admin/profile?seconds=0.3&interval_ms=2", headers=ADMIN)
+    finally:
+        stop.set()
+        worker.join()
+
+    assert res.status_code == 200
+    # TestClient runs the app off the main thread, so only wall mode is available.
+    assert res.headers["x-profile-mode"] == "wall"
+    assert res.headers["content-disposition"].startswith('attachment; filename="profile-')
+    assert int(res.headers["x-profile-samples"]) > 10
+    lines = res.text.splitlines()
+    busy = [line for line in lines if line.startswith("busy_worker;")]
+    assert busy and "_spin_until (tests/test_profiler.py:" in busy[0]
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0 and ";" in stack
+
+    assert client.get("/api/admin/profile?seconds=0.1&mode=cpu", headers=ADMIN).status_code == 400
+
+
+def test_cpu_profile_attributes_event_loop_work():
+    async def encode_forever(stop):
+        while not stop.is_set():
+            json.dumps({"items": list(range(500))})
+            await asyncio.sleep(0)
+
+    async def run():
+        stop = asyncio.Event()
+        task = asyncio.create_task(encode_forever(stop))
+        sampler = await profile(0.3, 0.002)
+        stop.set()
+        await task
+        return sampler
+
+    sampler = asyncio.run(run())
+    assert sampler.mode == "cpu"
+    busy = sum(n for stack, n in sampler.counts.items() if "encode_forever" in stack)
+    assert busy > 0.5 * sum(sampler.counts.values())
+
+
+def test_loop_lag_monitor_reports_blocking_callback(caplog):
+    def blocking_json_dump():
+        time.sleep(0.25)
+
+    async def run():
+        monitor = LoopLagMonitor(threshold=0.05, interval=0.01)
+        task = asyncio.create_task(monitor.run())
+        await asyncio.sleep(0.05)
+        blocking_json_dump()
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return monitor
+
+    with caplog.at_level(logging.WARNING, logger="profiler"):
+        monitor = asyncio.run(run())
+
+    assert monitor.stalls == 1
+    [record] = [r for r in caplog.records if "Event loop blocked" in r.getMessage()]
+    message = record.getMessage()
+    assert "threshold 50 ms" in message
+    assert "blocking_json_dump" in message
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+from prompt_builder import build_prompt, compact_context, estimate_tokens, rank_memories
+
+NOW = datetime(2026, 2, 1, tzinfo=timezone.utc)
+
+
+def test_estimate_tokens_counts_non_ascii_heavier():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("abcd" * 10) == 10
+    assert estimate_tokens("아침 운동") > estimate_tokens("abcde")
+
+
+def test_compact_context_drops_old_history_and_reports_counts():
+    history = [
+        {"id": "old", "at": (NOW - timedelta(days=30)).isoformat()},
+        {"id": "new", "at": (NOW - timedelta(days=1)).isoformat().replace("+00:00", "Z")},
+        {"id": "undated"},
+    ]
+    compacted = compact_context({"completionHistory": history}, NOW - timedelta(days=14), 50)
+
+    assert [h["id"] for h in compacted["completionHistory"]] == ["new", "undated"]
+    assert compacted["completionHistory_summary"] == {"total": 3, "included": 2}
+
+
+def test_compact_context_caps_long_lists_keeping_latest():
+    compacted = compact_context({"items": list(range(10))}, NOW, 3)
+    assert compacted["items"] == [7, 8, 9]
+    assert compacted["items_summary"] == {"total": 10, "included": 3}
+
+
+def test_rank_memories_prefers_overlap_and_dedupes():
+    ranked = rank_memories(
+        ["likes tea", "morning workout streak", "likes tea", ""],
+        "plan my morning workout",
+    )
+    assert ranked == ["morning workout streak", "likes tea"]
+
+
+def test_build_prompt_stays_within_budget():
+    context = {"completionHistory": [{"id": i, "note": "x" * 40} for i in range(500)]}
+    memories = [f"memory {i} " + "y" * 200 for i in range(20)]
+
+    built = build_prompt(
+        "What next?",
+        system_prompt="You are a coach.",
+        memories=memories,
+        context=context,
+        budget=800,
+        now=NOW,
+    )
+
+    assert built.estimated_tokens <= 800
+    assert built.context_compacted is True
+    assert built.memories_dropped > 0
+    assert built.text.startswith("You are a coach.")
+    assert built.text.endswith("User request: What next?")
+
+
+def test_build_prompt_small_request_unchanged():
+    built = build_prompt("hi", context={"energy": "high"}, memories=["likes mornings"], budget=1000, now=NOW)
+    assert built.context_compacted is False
+    assert built.memories_used == 1
+    assert 'Context: {"energy":"high"}' in built.text
+    assert built.metadata()["budget"] == 1000
+
+
+def test_build_prompt_truncates_non_ascii_context_by_tokens():
+    built = build_prompt("hi", context={"note": "가" * 20000}, budget=1000, now=NOW)
+
+    assert built.context_compacted is True
+    assert 900 < built.estimated_tokens <= 1000
+    assert built.text.endswith("User request: hi")
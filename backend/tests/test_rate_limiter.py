@@ -0,0 +1,244 @@
+from rate_limiter import _InMemoryDualTokenBucket
+from settings import reload_settings
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+async def test_memory_bucket_enforces_minute_limit():
+    clock = _Clock()
+    bucket = _InMemoryDualTokenBucket(shards=4, clock=clock)
+
+    assert (await bucket.consume("k", 2, 100)).allowed
+    assert (await bucket.consume("k", 2, 100)).allowed
+    denied = await bucket.consume("k", 2, 100)
+    assert not denied.allowed
+    assert denied.retry_after_seconds >= 1
+
+    clock.now += 30
+    assert (await bucket.consume("k", 2, 100)).allowed
+
+
+async def test_memory_bucket_evicts_refilled_keys():
+    clock = _Clock()
+    bucket = _InMemoryDualTokenBucket(shards=1, clock=clock)
+
+    for i in range(5):
+        await bucket.consume(f"ip-{i}", 60, 3600)
+    assert len(bucket) == 5
+
+    # One token refills in 1s on both buckets; afterwards the idle keys are dropped.
+    clock.now += 2
+    await bucket.consume("fresh", 60, 3600)
+    assert len(bucket) == 1
+    assert bucket.evictions == 5
+
+
+async def test_memory_bucket_stays_bounded_under_key_spray():
+    clock = _Clock()
+    bucket = _InMemoryDualTokenBucket(shards=4, max_keys=40, clock=clock)
+
+    for i in range(1000):
+        await bucket.consume(f"spray-{i}", 30, 300)
+
+    assert len(bucket) <= 40
+
+
+class _FakeRedis:
+    """Python stand-in for the dual-bucket Lua script (no refill: time is frozen)."""
+
+    def __init__(self):
+        self.buckets = {}
+        self.evalsha_calls = 0
+
+    async def script_load(self, script):
+        return "sha"
+
+    async def evalsha(self, sha, numkeys, key, cap_m, rate_m, cap_h, rate_h, now_ms, cost, ttl, want=None, force=0):
+        self.evalsha_calls += 1
+        m, h = self.buckets.get(key, (cap_m, cap_h))
+        if force:
+            m, h = min(cap_m, m - cost), min(cap_h, h - cost)
+            self.buckets[key] = (m, h)
+            return [1, 0, cost, max(0, int(min(m, h)))]
+        want = max(want or cost, cost)
+        if m < cost or h < cost:
+            self.buckets[key] = (m, h)
+            return [0, 5, 0, max(0, int(min(m, h)))]
+        grant = max(cost, int(min(want, m, h)))
+        self.buckets[key] = (m - grant, h - grant)
+        return [1, 0, grant, int(min(m - grant, h - grant))]
+
+
+def _redis_bucket(fake):
+    from rate_limiter import _RedisDualTokenBucket
+
+    bucket = _RedisDualTokenBucket("redis://fake")
+    bucket._redis = fake
+    return bucket
+
+
+async def test_leased_bucket_cuts_redis_round_trips():
+    from rate_limiter import _LeasedRedisBucket
+
+    fake = _FakeRedis()
+    leased = _LeasedRedisBucket(_redis_bucket(fake), tolerance=0.1)
+
+    for _ in range(20):
+        assert (await leased.consume("k", 100, 1000)).allowed
+
+    # Chunks of 10 tokens: 2 Redis calls instead of 20.
+    assert fake.evalsha_calls == 2
+    assert leased.local_hits == 18
+
+
+async def test_leased_bucket_stays_accurate_at_the_limit():
+    from rate_limiter import _LeasedRedisBucket
+
+    fake = _FakeRedis()
+    worker_a = _LeasedRedisBucket(_redis_bucket(fake), tolerance=0.2)
+    worker_b = _LeasedRedisBucket(_redis_bucket(fake), tolerance=0.2)
+
+    allowed = 0
+    for i in range(40):
+        worker = worker_a if i % 2 else worker_b
+        if (await worker.consume("k", 20, 1000)).allowed:
+            allowed += 1
+
+    assert allowed == 20
+    denied = await worker_a.consume("k", 20, 1000)
+    assert not denied.allowed
+    assert denied.retry_after_seconds >= 1
+
+
+class _NoScriptError(Exception):
+    pass
+
+
+class _FlushedRedis(_FakeRedis):
+    """Forgets loaded scripts once, like a Redis restart."""
+
+    def __init__(self):
+        super().__init__()
+        self.loaded = 0
+        self.flushed = False
+
+    async def script_load(self, script):
+        self.loaded += 1
+        return f"sha-{self.loaded}"
+
+    async def evalsha(self, sha, *args):
+        if not self.flushed:
+            self.flushed = True
+            raise _NoScriptError("NOSCRIPT No matching script.")
+        return await super().evalsha(sha, *args)
+
+
+class _DownRedis:
+    def __init__(self):
+        self.calls = 0
+
+    async def script_load(self, script):
+        self.calls += 1
+        raise ConnectionError("connection refused")
+
+
+async def test_redis_bucket_reloads_script_on_noscript():
+    fake = _FlushedRedis()
+    bucket = _redis_bucket(fake)
+    bucket._script_sha = "sha-before-restart"
+
+    decision = await bucket.consume("k", 10, 100)
+
+    assert decision.enforced is True
+    assert decision.allowed is True
+    assert fake.loaded == 1
+    assert (await bucket.consume("k", 10, 100)).enforced is True
+
+
+async def test_redis_bucket_backs_off_then_retries():
+    down = _DownRedis()
+    bucket = _redis_bucket(down)
+
+    assert (await bucket.consume("k", 10, 100)).enforced is False
+    assert (await bucket.consume("k", 10, 100)).enforced is False
+    assert down.calls == 1
+
+    # Backoff window elapsed: Redis is tried again and enforcement resumes.
+    bucket._redis = _FakeRedis()
+    bucket._unavailable_until = 0.0
+    assert (await bucket.consume("k", 10, 100)).enforced is True
+
+
+def _fresh_limiter(monkeypatch):
+    import rate_limiter
+
+    monkeypatch.delenv("REDIS_URL", raising=False)
+    reload_settings()
+    monkeypatch.setattr(rate_limiter, "_GLOBAL_LIMITER", rate_limiter.RateLimiter())
+
+
+def test_policy_limits_read_from_env(monkeypatch):
+    from rate_limiter import get_policy
+
+    monkeypatch.setenv("RATE_LIMIT_WORKFLOW_NODES_PER_MINUTE", "7")
+    reload_settings()
+    policy = get_policy("workflow_nodes")
+    assert policy.per_minute == 7
+    assert get_policy("ai").key_by == "user"
+
+
+def test_middleware_sheds_route_over_quota(client, monkeypatch):
+    _fresh_limiter(monkeypatch)
+    monkeypatch.setenv("RATE_LIMIT_MEMORY_TRACK_PER_MINUTE", "1")
+    reload_settings()
+
+    import main
+
+    async def _noop(*args, **kwargs):
+        return None
+
+    monkeypatch.setattr(main, "memorize_user_action", _noop)
+
+    assert client.post("/api/memory/track", json={"user_id": "u1"}).status_code == 200
+    res = client.post("/api/memory/track", json={"user_id": "u1"})
+    assert res.status_code == 429
+    assert "Retry-After" in res.headers
+    # Other routes use their own policy.
+    assert client.get("/health").status_code == 200
+
+
+def test_workflow_charges_per_node(client, monkeypatch):
+    _fresh_limiter(monkeypatch)
+    monkeypatch.setenv("RATE_LIMIT_WORKFLOW_NODES_PER_MINUTE", "3")
+    reload_settings()
+
+    node = {"id": "n", "type": "input", "position": {"x": 0, "y": 0}, "data": {"label": "start", "task_type": "input"}}
+    workflow = {
+        "id": "wf",
+        "name": "wf",
+        "nodes": [dict(node, id=f"n{i}") for i in range(2)],
+        "edges": [],
+    }
+
+    assert client.post("/execute", json=workflow).status_code == 200
+    assert client.post("/execute", json=workflow).status_code == 429
+
+
+def test_quota_key_follows_policy_key_by():
+    from types import SimpleNamespace
+
+    from rate_limiter import quota_key
+
+    anonymous = {"client": ("203.0.113.7", 5000), "state": {}}
+    signed_in = {"client": ("203.0.113.7", 5000), "state": {"supabase_auth": SimpleNamespace(user_id="user-1")}}
+
+    assert quota_key("ai", anonymous) == "203.0.113.7"
+    assert quota_key("ai", signed_in) == "user-1"
+    assert quota_key("memory_track", signed_in) == "203.0.113.7"
+    assert quota_key("ai_tokens_global", signed_in) == "global"
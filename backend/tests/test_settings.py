@@ -0,0 +1,94 @@
+from settings import Settings, get_settings, reload_settings
+
+
+def test_from_env_falls_back_on_invalid_values():
+    settings, problems = Settings.from_env(
+        {
+            "AI_BATCH_MAX_ITEMS": "lots",
+            "AI_RATE_LIMIT_PER_MINUTE": "0",
+            "REQUIRE_SUPABASE_AUTH_FOR_AI": "maybe",
+            "SUPABASE_URL": "https://proj.supabase.co/",
+        }
+    )
+    assert settings.ai_batch_max_items == 8
+    assert settings.quota_policies["ai"].per_minute == 30
+    # Invalid flag is ignored, so the "configured => required" default applies.
+    assert settings.require_supabase_auth_for_ai is True
+    assert settings.supabase_jwks_url == "https://proj.supabase.co/auth/v1/certs"
+    assert len(problems) == 3
+
+
+def test_startup_components_are_built_from_settings(monkeypatch):
+    import ai_models
+    import memory_service
+    import upstream_limiter
+
+    monkeypatch.setenv("GEMINI_MODEL", "pro")
+    monkeypatch.setenv("MEMU_URL", "http://memu.internal:8100/")
+    monkeypatch.setenv("MEMU_CB_FAILURE_THRESHOLD", "-1")
+    monkeypatch.setenv("UPSTREAM_MAX_CONCURRENCY", "4")
+    monkeypatch.setattr(ai_models, "_REGISTRY", None)
+    monkeypatch.setattr(memory_service, "_MEMU_CLIENT", None)
+    monkeypatch.setattr(upstream_limiter, "_UPSTREAM_LIMITER", None)
+    reload_settings()
+
+    assert ai_models.get_model_registry().primary == "pro"
+    memu = memory_service.get_memu_client()
+    assert memu.base_url == "http://memu.internal:8100"
+    assert memu.breaker.failure_threshold == 3
+    assert upstream_limiter.get_upstream_limiter().max_limit == 4
+
+
+def test_settings_are_cached_until_reload(monkeypatch):
+    monkeypatch.setenv("AI_BATCH_MAX_ITEMS", "4")
+    reload_settings()
+    assert get_settings().ai_batch_max_items == 4
+
+    monkeypatch.setenv("AI_BATCH_MAX_ITEMS", "5")
+    assert get_settings().ai_batch_max_items == 4
+    assert reload_settings() == ["ai_batch_max_items"]
+    assert get_settings().ai_batch_max_items == 5
+
+
+def test_admin_reload_disabled_without_admin_key(client, monkeypatch):
+    monkeypatch.delenv("ADMIN_API_KEY", raising=False)
+    reload_settings()
+    assert client.post("/api/admin/settings/reload").status_code == 403
+
+
+def test_admin_reload_requires_admin_key_and_applies_changes(client, monkeypatch):
+    monkeypatch.setenv("ADMIN_API_KEY", "admin-secret")
+    reload_settings()
+
+    assert client.post("/api/admin/settings/reload", headers={"X-Admin-Key": "wrong"}).status_code == 401
+
+    monkeypatch.setenv("AI_BATCH_CONCURRENCY", "2")
+    res = client.post("/api/admin/settings/reload", headers={"X-Admin-Key": "admin-secret"})
+    assert res.status_code == 200
+    assert res.json() == {"status": "reloaded", "changed": ["ai_batch_concurrency"]}
+    assert get_settings().ai_batch_concurrency == 2
+
+
+def test_env_file_never_overrides_process_environment(tmp_path, monkeypatch):
+    import os
+
+    import settings
+
+    monkeypatch.setenv("MEMU_URL", "http://memu:8000")
+    monkeypatch.delenv("GEMINI_MODEL", raising=False)
+    monkeypatch.setattr(settings, "_PROCESS_ENV_KEYS", frozenset(os.environ))
+    monkeypatch.setattr(settings, "_DOTENV_APPLIED", {})
+    env_file = tmp_path / ".env"
+    env_file.write_text("MEMU_URL=http://localhost:8100\nGEMINI_MODEL=pro\n")
+    try:
+        settings.load_env_file(str(env_file))
+        assert os.environ["MEMU_URL"] == "http://memu:8000"
+        assert os.environ["GEMINI_MODEL"] == "pro"
+
+        # Removing a key from .env unsets it on the next reload.
+        env_file.write_text("MEMU_URL=http://localhost:8100\n")
+        settings.load_env_file(str(env_file))
+        assert "GEMINI_MODEL" not in os.environ
+        assert os.environ["MEMU_URL"] == "http://memu:8000"
+    finally:
+        os.environ.pop("GEMINI_MODEL", None)
@@ -0,0 +1,282 @@
+import asyncio
+import json
+import time
+
+import jwt
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+import supabase_auth
+from settings import reload_settings
+from supabase_auth import _JWKSCache
+
+URL = "https://example.supabase.co/auth/v1/certs"
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _jwk(private_key, kid):
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({"kid": kid, "alg": "RS256", "use": "sig"})
+    return jwk
+
+
+@pytest.fixture(autouse=True)
+def _clean_caches():
+    supabase_auth.clear_token_cache()
+    supabase_auth._PUBLIC_KEYS.clear()
+    yield
+    supabase_auth.clear_token_cache()
+
+
+@pytest.fixture
+def jwks_server(monkeypatch):
+    """Fake JWKS endpoint: serves `state["keys"]` and counts fetches."""
+    state = {"keys": [], "fetches": 0, "delay": 0.0, "fail": False}
+
+    async def fake_fetch(url):
+        state["fetches"] += 1
+        await asyncio.sleep(state["delay"])
+        if state["fail"]:
+            return None
+        return {"keys": list(state["keys"])}
+
+    monkeypatch.setattr(supabase_auth, "_fetch_jwks", fake_fetch)
+    return state
+
+
+def test_concurrent_cold_lookups_share_one_fetch(jwks_server):
+    jwks_server["keys"] = [{"kid": "a"}]
+    jwks_server["delay"] = 0.01
+    cache = _JWKSCache()
+
+    async def run():
+        return await asyncio.gather(*(cache.get(URL) for _ in range(20)))
+
+    results = asyncio.run(run())
+    assert all(r == {"keys": [{"kid": "a"}]} for r in results)
+    assert jwks_server["fetches"] == 1
+
+
+def test_stale_keys_are_served_while_refreshing_in_background(jwks_server):
+    clock = _Clock()
+    cache = _JWKSCache(ttl=600, refresh_ahead=60, clock=clock)
+    jwks_server["keys"] = [{"kid": "old"}]
+
+    async def run():
+        await cache.get(URL)
+        clock.now += 100
+        assert await cache.get(URL) == {"keys": [{"kid": "old"}]}
+        assert jwks_server["fetches"] == 1
+
+        # Inside the refresh-ahead window: old keys now, new keys after the background fetch.
+        jwks_server["keys"] = [{"kid": "new"}]
+        jwks_server["delay"] = 0.01
+        clock.now += 460
+        assert await cache.get(URL) == {"keys": [{"kid": "old"}]}
+        await asyncio.sleep(0.02)
+        assert await cache.get(URL) == {"keys": [{"kid": "new"}]}
+
+    asyncio.run(run())
+    assert jwks_server["fetches"] == 2
+
+
+def test_keys_past_max_stale_fail_closed_when_refresh_fails(jwks_server):
+    clock = _Clock()
+    cache = _JWKSCache(ttl=600, refresh_ahead=60, max_stale=3600, min_refresh_interval=30, clock=clock)
+    jwks_server["keys"] = [{"kid": "a"}]
+
+    async def run():
+        assert await cache.get_key(URL, "a") == {"kid": "a"}
+        jwks_server["fail"] = True
+
+        # Within max_stale the old keys are still served while refreshes fail.
+        clock.now += 600 + 100
+        assert await cache.get_key(URL, "a") == {"kid": "a"}
+        await asyncio.sleep(0)
+
+        clock.now += 3600
+        assert await cache.get(URL) is None
+        assert await cache.get_key(URL, "a") is None
+        assert not cache.has_keys
+
+        clock.now += 30
+        jwks_server["fail"] = False
+        assert await cache.get_key(URL, "a") == {"kid": "a"}
+
+    asyncio.run(run())
+
+
+def test_failed_fetch_backs_off_instead_of_refetching_per_request(jwks_server):
+    clock = _Clock()
+    cache = _JWKSCache(min_refresh_interval=30, clock=clock)
+    jwks_server["fail"] = True
+
+    async def run():
+        for _ in range(10):
+            assert await cache.get(URL) is None
+        assert jwks_server["fetches"] == 1
+
+        clock.now += 31
+        assert await cache.get(URL) is None
+        assert jwks_server["fetches"] == 2
+
+    asyncio.run(run())
+
+
+def test_unknown_kid_forces_rate_limited_refresh(jwks_server):
+    clock = _Clock()
+    cache = _JWKSCache(min_refresh_interval=30, clock=clock)
+    jwks_server["keys"] = [{"kid": "a"}]
+
+    async def run():
+        assert await cache.get_key(URL, "a") == {"kid": "a"}
+        clock.now += 31
+        jwks_server["keys"] = [{"kid": "a"}, {"kid": "rotated"}]
+        assert await cache.get_key(URL, "rotated") == {"kid": "rotated"}
+        assert jwks_server["fetches"] == 2
+
+        # Forged kids right after a refresh do not trigger another fetch.
+        assert await cache.get_key(URL, "forged") is None
+        assert jwks_server["fetches"] == 2
+
+    asyncio.run(run())
+
+
+def test_rs256_token_verified_after_key_rotation(jwks_server, monkeypatch):
+    monkeypatch.setenv("SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.delenv("SUPABASE_JWT_SECRET", raising=False)
+    reload_settings()
+    monkeypatch.setattr(supabase_auth, "_JWKS_CACHE", _JWKSCache(min_refresh_interval=0))
+
+    old_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    new_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwks_server["keys"] = [_jwk(old_key, "k1")]
+
+    def token(private_key, kid, sub):
+        payload = {"sub": sub, "aud": "authenticated", "exp": int(time.time()) + 60}
+        return jwt.encode(payload, private_key, algorithm="RS256", headers={"kid": kid})
+
+    async def run():
+        first = await supabase_auth.verify_supabase_access_token(token(old_key, "k1", "user-1"))
+        jwks_server["keys"] = [_jwk(old_key, "k1"), _jwk(new_key, "k2")]
+        second = await supabase_auth.verify_supabase_access_token(token(new_key, "k2", "user-2"))
+        return first.user_id, second.user_id
+
+    assert asyncio.run(run()) == ("user-1", "user-2")
+    assert jwks_server["fetches"] == 2
+
+
+def test_concurrent_verifications_of_same_token_are_coalesced(monkeypatch):
+    calls = {"n": 0}
+
+    async def slow_verify(token):
+        calls["n"] += 1
+        await asyncio.sleep(0.01)
+        return supabase_auth.VerifiedSupabaseToken(user_id="u", claims={})
+
+    monkeypatch.setattr(supabase_auth, "_verify_token", slow_verify)
+
+    async def run():
+        return await asyncio.gather(*(supabase_auth.verify_supabase_access_token("t") for _ in range(10)))
+
+    assert {r.user_id for r in asyncio.run(run())} == {"u"}
+    assert calls["n"] == 1
+    assert supabase_auth._INFLIGHT_VERIFICATIONS == {}
+
+
+def _hs_token(secret, sub, ttl=60):
+    payload = {"sub": sub, "aud": "authenticated", "exp": int(time.time()) + ttl}
+    return jwt.encode(payload, secret, algorithm="HS256")
+
+
+def test_verified_tokens_are_cached_per_config(monkeypatch):
+    monkeypatch.setenv("SUPABASE_JWT_SECRET", "secret-1")
+    reload_settings()
+    calls = {"n": 0}
+    real_decode = supabase_auth._decode_with_secret
+
+    def counting_decode(token, secret):
+        calls["n"] += 1
+        return real_decode(token, secret)
+
+    monkeypatch.setattr(supabase_auth, "_decode_with_secret", counting_decode)
+    token = _hs_token("secret-1", "user-1")
+
+    async def verify():
+        return (await supabase_auth.verify_supabase_access_token(token)).user_id
+
+    assert asyncio.run(verify()) == "user-1"
+    assert asyncio.run(verify()) == "user-1"
+    assert calls["n"] == 1
+
+    # Rotating the secret must not let the cached result through.
+    monkeypatch.setenv("SUPABASE_JWT_SECRET", "secret-2")
+    reload_settings()
+    with pytest.raises(jwt.InvalidSignatureError):
+        asyncio.run(verify())
+
+
+def test_token_cache_entries_end_at_exp():
+    clock = _Clock()
+    cache = supabase_auth._VerifiedTokenCache(max_entries=2, clock=clock)
+    verified = supabase_auth.VerifiedSupabaseToken(user_id="u", claims={})
+
+    cache.put("a", verified, expires_at=clock.now + 10)
+    assert cache.get("a") is verified
+    clock.now += 10
+    assert cache.get("a") is None
+
+    for key in ("b", "c", "d"):
+        cache.put(key, verified, expires_at=clock.now + 10)
+    assert cache.get("b") is None  # evicted (LRU)
+    assert cache.stats()["entries"] == 2
+
+
+def test_user_endpoint_results_cached_briefly(monkeypatch):
+    monkeypatch.delenv("SUPABASE_JWT_SECRET", raising=False)
+    monkeypatch.setenv("SUPABASE_URL", "https://example.supabase.co")
+    monkeypatch.setenv("SUPABASE_ANON_KEY", "anon")
+    monkeypatch.setenv("SUPABASE_USER_ENDPOINT_CACHE_SECONDS", "30")
+    reload_settings()
+    calls = {"n": 0}
+
+    async def fake_user_endpoint(token, base_url, anon_key):
+        calls["n"] += 1
+        return "user-9", {}
+
+    monkeypatch.setattr(supabase_auth, "_verify_via_supabase_user_endpoint", fake_user_endpoint)
+    token = jwt.encode({"sub": "user-9", "exp": int(time.time()) + 3600}, "x", algorithm="HS512")
+    monkeypatch.setattr(supabase_auth.jwt, "get_unverified_header", lambda t: {"alg": "ES256"})
+
+    async def run():
+        for _ in range(3):
+            assert (await supabase_auth.verify_supabase_access_token(token)).user_id == "user-9"
+
+    asyncio.run(run())
+    assert calls["n"] == 1
+    until = supabase_auth._cache_until(token, supabase_auth.VerifiedSupabaseToken("user-9", {}))
+    assert until <= time.time() + 30
+
+
+def test_public_keys_parsed_once_per_kid(monkeypatch):
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    jwk = _jwk(private_key, "k1")
+    calls = {"n": 0}
+    real_from_jwk = jwt.algorithms.RSAAlgorithm.from_jwk
+
+    def counting_from_jwk(data):
+        calls["n"] += 1
+        return real_from_jwk(data)
+
+    monkeypatch.setattr(jwt.algorithms.RSAAlgorithm, "from_jwk", staticmethod(counting_from_jwk))
+
+    first = supabase_auth._public_key_for("k1", jwk)
+    assert supabase_auth._public_key_for("k1", dict(jwk)) is first
+    assert calls["n"] == 1
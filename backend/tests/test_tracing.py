@@ -0,0 +1,81 @@
+import asyncio
+import json
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from settings import reload_settings
+from tracing import TraceExporter, TracingMiddleware, span
+
+
+def _traced_app(exporter):
+    app = FastAPI()
+
+    @app.get("/work/{item}")
+    async def work(item: str):
+        with span("outer", item=item):
+            with span("inner"):
+                await asyncio.sleep(0)
+        return {"ok": True}
+
+    return TestClient(TracingMiddleware(app, exporter=exporter))
+
+
+def test_server_timing_header_lists_stages(client, monkeypatch):
+    monkeypatch.setenv("SERVER_TIMING", "1")
+    reload_settings()
+    res = client.get("/api/persistence/load")
+    assert res.status_code == 200
+    timing = res.headers["Server-Timing"]
+    assert "storage.load;dur=" in timing
+    assert "total;dur=" in timing
+
+
+def test_server_timing_is_off_by_default(client, monkeypatch):
+    monkeypatch.delenv("SERVER_TIMING", raising=False)
+    reload_settings()
+    assert "Server-Timing" not in client.get("/health").headers
+
+
+def test_sampled_traces_are_exported_as_otlp_json(tmp_path, monkeypatch):
+    monkeypatch.setenv("TRACE_SAMPLE_RATE", "1")
+    reload_settings()
+    path = tmp_path / "traces.jsonl"
+    exporter = TraceExporter(file_path=str(path))
+    client = _traced_app(exporter)
+
+    assert client.get("/work/a").status_code == 200
+    asyncio.run(exporter.flush())
+
+    payload = json.loads(path.read_text().splitlines()[0])
+    spans = {s["name"]: s for s in payload["resourceSpans"][0]["scopeSpans"][0]["spans"]}
+    root, outer, inner = spans["GET /work/{item}"], spans["outer"], spans["inner"]
+    assert outer["parentSpanId"] == root["spanId"]
+    assert inner["parentSpanId"] == outer["spanId"]
+    assert {a["key"]: a["value"] for a in outer["attributes"]} == {"item": {"stringValue": "a"}}
+    assert exporter.exported == 1
+
+
+def test_incoming_traceparent_is_continued(tmp_path):
+    exporter = TraceExporter(file_path=str(tmp_path / "traces.jsonl"))
+    client = _traced_app(exporter)
+    trace_id = "4bf92f3577b34da6a3ce929d0e0e4736"
+
+    client.get("/work/b", headers={"traceparent": f"00-{trace_id}-00f067aa0ba902b7-01"})
+    client.get("/work/c", headers={"traceparent": f"00-{'1' * 32}-00f067aa0ba902b7-00"})
+    asyncio.run(exporter.flush())
+
+    spans = json.loads((tmp_path / "traces.jsonl").read_text())["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    # Only the request whose caller sampled it is exported, under the caller's trace.
+    assert {s["traceId"] for s in spans} == {trace_id}
+    root = next(s for s in spans if s["name"] == "GET /work/{item}")
+    assert root["parentSpanId"] == "00f067aa0ba902b7"
+
+
+def test_untraced_requests_pass_through(monkeypatch):
+    monkeypatch.setenv("SERVER_TIMING", "0")
+    reload_settings()
+    exporter = TraceExporter()
+    res = _traced_app(exporter).get("/work/d")
+    assert res.status_code == 200
+    assert "Server-Timing" not in res.headers
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from upstream_limiter import (
+    PRIORITY_BATCH,
+    PRIORITY_INTERACTIVE,
+    AdaptiveConcurrencyLimiter,
+    UpstreamBusyError,
+)
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_waiters_are_served_by_priority():
+    limiter = AdaptiveConcurrencyLimiter(max_limit=1, queue_timeout=1.0)
+    order = []
+
+    async def waiter(name, priority):
+        async with limiter.slot(priority):
+            order.append(name)
+
+    async def run():
+        holder = await limiter.acquire()
+        tasks = [asyncio.create_task(waiter("batch", PRIORITY_BATCH))]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(waiter("ask", PRIORITY_INTERACTIVE)))
+        await asyncio.sleep(0)
+        assert limiter.queued == 2
+        await limiter.release(holder)
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+    assert order == ["ask", "batch"]
+    assert limiter.in_flight == 0
+
+
+def test_queue_timeout_and_full_queue_reject():
+    limiter = AdaptiveConcurrencyLimiter(max_limit=1, queue_timeout=0.01, max_queue=1)
+
+    async def run():
+        await limiter.acquire()
+        waiting = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(UpstreamBusyError):
+            await limiter.acquire()  # queue full
+        with pytest.raises(UpstreamBusyError):
+            await waiting  # timed out
+        assert limiter.queued == 0
+        assert limiter.in_flight == 1
+
+    asyncio.run(run())
+    assert limiter.rejected == 2
+
+
+def test_aimd_halves_once_per_cooldown_and_grows_additively():
+    clock = _Clock()
+    limiter = AdaptiveConcurrencyLimiter(max_limit=16, decrease_cooldown=1.0, clock=clock)
+
+    limiter.on_overload()
+    limiter.on_overload()  # same burst: ignored
+    assert limiter.limit == 8
+
+    clock.now = 2.0
+    limiter.on_overload()
+    assert limiter.limit == 4
+
+    for _ in range(4):
+        limiter.on_success()
+    assert 4.9 < limiter.limit < 5.1
+
+
+class _StatusResponse:
+    text = "busy"
+
+    def __init__(self, status_code, retry_after="0"):
+        self.status_code = status_code
+        self.headers = {"Retry-After": retry_after}
+
+    def json(self):
+        return {"candidates": [{"content": {"parts": [{"text": "ok"}]}}]}
+
+
+def _client_returning(statuses):
+    class _Client:
+        calls = 0
+
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, exc_type, exc, tb):
+            return False
+
+        async def post(self, *args, **kwargs):
+            status = statuses[min(_Client.calls, len(statuses) - 1)]
+            _Client.calls += 1
+            return _StatusResponse(status)
+
+    return _Client
+
+
+async def _no_memories(user_id, query):
+    return None
+
+
+def _patch(monkeypatch, statuses):
+    import ai_proxy
+    import upstream_limiter
+
+    limiter = AdaptiveConcurrencyLimiter(max_limit=8)
+    monkeypatch.setattr(upstream_limiter, "_UPSTREAM_LIMITER", limiter)
+    client_cls = _client_returning(statuses)
+    monkeypatch.setattr(ai_proxy.httpx, "AsyncClient", client_cls)
+    monkeypatch.setattr(ai_proxy, "retrieve_user_memories", _no_memories)
+    return limiter, client_cls
+
+
+def test_upstream_429_is_retried_once(client, monkeypatch):
+    limiter, client_cls = _patch(monkeypatch, [429, 200])
+
+    res = client.post("/api/ai/ask", json={"prompt": "hi"})
+    assert res.status_code == 200
+    assert client_cls.calls == 2
+    assert limiter.overloads == 1
+    assert limiter.limit < 8
+
+
+def test_persistent_upstream_429_becomes_503(client, monkeypatch):
+    limiter, client_cls = _patch(monkeypatch, [429])
+
+    res = client.post("/api/ai/ask", json={"prompt": "hi"})
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    assert client_cls.calls == 2
+    assert limiter.in_flight == 0
+
+    assert client.get("/api/ai/status").json()["upstream"]["overloads"] == 2
@@ -0,0 +1,331 @@
+"""
+Per-request spans: Server-Timing headers and sampled OpenTelemetry export.
+
+`span(name)` times one stage of a request. It always feeds the stage histogram
+in metrics; when the request is being traced it also records a span (with its
+parent, so nested stages form a tree) on the request's Trace, held in a
+contextvar that tasks spawned by the request inherit.
+
+TracingMiddleware starts a Trace only when it is needed: for the Server-Timing
+header (SERVER_TIMING; off by default, since it tells any client how long
+each internal stage took, e.g. cache hit vs miss) or when the request is
+sampled for export (TRACE_SAMPLE_RATE, or an incoming W3C `traceparent` with
+the sampled flag).
+Otherwise it passes the request straight through and `span` costs one
+contextvar lookup on top of the metric.
+
+Sampled traces are exported as OTLP/JSON (resourceSpans) in batches, appended
+as JSON lines to TRACE_EXPORT_FILE and/or POSTed to TRACE_EXPORT_URL (an OTLP
+HTTP collector, e.g. http://localhost:4318/v1/traces).
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import random
+import time
+from contextlib import ContextDecorator
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+from starlette.datastructures import MutableHeaders
+
+from metrics import STAGE_SECONDS
+from settings import Settings, get_settings, on_reload
+
+logger = logging.getLogger(__name__)
+
+SERVICE_NAME = "dailywave-api"
+_SPAN_KIND_INTERNAL = 1
+_SPAN_KIND_SERVER = 2
+_STATUS_ERROR = 2
+
+
+class Trace:
+    """Spans of one request; `spans` holds (span_id, parent_id, name, start_ns, end_ns, attributes, error)."""
+
+    __slots__ = ("trace_id", "sampled", "root_id", "parent_id", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool, parent_id: Optional[str] = None):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.root_id = _new_id(8)
+        # Remote parent from `traceparent`, if any.
+        self.parent_id = parent_id
+        self.spans: List[Tuple[str, Optional[str], str, int, int, Dict[str, Any], bool]] = []
+
+    def server_timing(self, total_ns: int) -> str:
+        """Server-Timing value: time per stage name (summed over repeats) plus the total so far."""
+        durations: Dict[str, int] = {}
+        for _, _, name, start_ns, end_ns, _, _ in self.spans:
+            durations[name] = durations.get(name, 0) + end_ns - start_ns
+        entries = [f"{name};dur={ns / 1e6:.2f}" for name, ns in durations.items()]
+        entries.append(f"total;dur={total_ns / 1e6:.2f}")
+        return ", ".join(entries)
+
+
+# (trace, id of the enclosing span)
+_CURRENT: contextvars.ContextVar[Optional[Tuple[Trace, str]]] = contextvars.ContextVar("dailywave_trace", default=None)
+
+
+def _new_id(nbytes: int) -> str:
+    return random.getrandbits(nbytes * 8).to_bytes(nbytes, "big").hex()
+
+
+class span(ContextDecorator):
+    """Times a stage: `with span("ai.gemini"):` or `@span("storage.save")` on a sync function."""
+
+    __slots__ = ("name", "attributes", "_started", "_start_ns", "_token", "_span_id")
+
+    def __init__(self, name: str, **attributes: Any):
+        self.name = name
+        self.attributes = attributes
+        self._token = None
+
+    def _recreate_cm(self):
+        return span(self.name, **self.attributes)
+
+    def __enter__(self):
+        current = _CURRENT.get()
+        if current is not None:
+            self._span_id = _new_id(8)
+            self._start_ns = time.time_ns()
+            self._token = _CURRENT.set((current[0], self._span_id))
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        STAGE_SECONDS.observe(time.perf_counter() - self._started, self.name)
+        if self._token is not None:
+            trace, parent_id = self._token.old_value
+            _CURRENT.reset(self._token)
+            self._token = None
+            trace.spans.append((
+                self._span_id,
+                parent_id,
+                self.name,
+                self._start_ns,
+                time.time_ns(),
+                self.attributes,
+                exc_type is not None and not issubclass(exc_type, asyncio.CancelledError),
+            ))
+        return False
+
+
+def current_trace() -> Optional[Trace]:
+    current = _CURRENT.get()
+    return current[0] if current is not None else None
+
+
+def _parse_traceparent(value: str) -> Optional[Tuple[str, str, bool]]:
+    """W3C traceparent `00-<trace id>-<parent id>-<flags>` -> (trace id, parent id, sampled)."""
+    parts = value.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16 or len(parts[3]) != 2:
+        return None
+    try:
+        int(parts[1], 16)
+        int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def _attribute(key: str, value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        wrapped = {"boolValue": value}
+    elif isinstance(value, int):
+        wrapped = {"intValue": str(value)}
+    elif isinstance(value, float):
+        wrapped = {"doubleValue": value}
+    else:
+        wrapped = {"stringValue": str(value)}
+    return {"key": key, "value": wrapped}
+
+
+def to_otlp(traces: List[Tuple[Trace, Dict[str, Any]]]) -> Dict[str, Any]:
+    """OTLP/JSON payload for finished traces; each root span is (trace, root fields)."""
+    spans = []
+    for trace, root in traces:
+        spans.append({
+            "traceId": trace.trace_id,
+            "spanId": trace.root_id,
+            **({"parentSpanId": trace.parent_id} if trace.parent_id else {}),
+            "name": root["name"],
+            "kind": _SPAN_KIND_SERVER,
+            "startTimeUnixNano": str(root["start_ns"]),
+            "endTimeUnixNano": str(root["end_ns"]),
+            "attributes": [_attribute(k, v) for k, v in root["attributes"].items()],
+            **({"status": {"code": _STATUS_ERROR}} if root["error"] else {}),
+        })
+        for span_id, parent_id, name, start_ns, end_ns, attributes, error in trace.spans:
+            spans.append({
+                "traceId": trace.trace_id,
+                "spanId": span_id,
+                "parentSpanId": parent_id,
+                "name": name,
+                "kind": _SPAN_KIND_INTERNAL,
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(end_ns),
+                "attributes": [_attribute(k, v) for k, v in attributes.items()],
+                **({"status": {"code": _STATUS_ERROR}} if error else {}),
+            })
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", SERVICE_NAME)]},
+            "scopeSpans": [{"scope": {"name": "dailywave"}, "spans": spans}],
+        }]
+    }
+
+
+def _append_line(path: str, line: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "a", encoding="utf-8") as f:
+        f.write(line + "\n")
+
+
+class TraceExporter:
+    """Buffers sampled traces and ships them in batches (file and/or OTLP HTTP collector)."""
+
+    def __init__(self, file_path: str = "", url: str = "", max_buffer: int = 256, flush_interval: float = 5.0):
+        self.file_path = file_path
+        self.url = url
+        self.max_buffer = max_buffer
+        self.flush_interval = flush_interval
+        self._buffer: List[Tuple[Trace, Dict[str, Any]]] = []
+        self._flushing: Optional[asyncio.Task] = None
+        self.exported = 0
+        self.dropped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.file_path or self.url)
+
+    def submit(self, trace: Trace, root: Dict[str, Any]):
+        if len(self._buffer) >= self.max_buffer * 4:
+            # The sink is not keeping up; never let traces grow memory unbounded.
+            self.dropped += 1
+            return
+        self._buffer.append((trace, root))
+        if len(self._buffer) >= self.max_buffer and (self._flushing is None or self._flushing.done()):
+            self._flushing = asyncio.ensure_future(self.flush())
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        payload = to_otlp(batch)
+        try:
+            if self.file_path:
+                await asyncio.to_thread(_append_line, self.file_path, json.dumps(payload, separators=(",", ":")))
+            if self.url:
+                async with httpx.AsyncClient(timeout=5.0) as client:
+                    response = await client.post(self.url, json=payload)
+                    response.raise_for_status()
+            self.exported += len(batch)
+        except Exception as e:
+            self.dropped += len(batch)
+            logger.warning("Trace export failed (%d traces dropped): %s", len(batch), e)
+
+    async def run(self):
+        """Background flush loop (started from the app lifespan)."""
+        try:
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await self.flush()
+        finally:
+            await self.flush()
+
+
+_EXPORTER: Optional[TraceExporter] = None
+
+
+def get_trace_exporter() -> TraceExporter:
+    global _EXPORTER
+    if _EXPORTER is None:
+        settings = get_settings()
+        _EXPORTER = TraceExporter(settings.trace_export_file, settings.trace_export_url)
+    return _EXPORTER
+
+
+def _route_name(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or scope["path"]
+
+
+class TracingMiddleware:
+    """Starts a Trace per request when Server-Timing or export needs one; see the module docstring."""
+
+    def __init__(self, app, exporter: Optional[TraceExporter] = None):
+        self.app = app
+        self._exporter = exporter
+        self._configure(get_settings())
+        on_reload(self._configure)
+
+    def _configure(self, settings: Settings):
+        self.server_timing = settings.server_timing
+        self.sample_rate = settings.trace_sample_rate
+
+    @property
+    def exporter(self) -> TraceExporter:
+        return self._exporter or get_trace_exporter()
+
+    def _start_trace(self, scope) -> Optional[Trace]:
+        exporting = self.exporter.enabled
+        trace_id, parent_id, sampled = None, None, False
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                parsed = _parse_traceparent(value.decode("latin-1"))
+                if parsed is not None:
+                    trace_id, parent_id, sampled = parsed
+                break
+        if trace_id is None and exporting and self.sample_rate > 0:
+            sampled = random.random() < self.sample_rate
+        sampled = sampled and exporting
+        if not (sampled or self.server_timing):
+            return None
+        return Trace(trace_id or _new_id(16), sampled, parent_id)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        trace = self._start_trace(scope)
+        if trace is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_ns = time.time_ns()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if self.server_timing:
+                    headers = MutableHeaders(scope=message)
+                    headers.append("Server-Timing", trace.server_timing(time.time_ns() - start_ns))
+            await send(message)
+
+        token = _CURRENT.set((trace, trace.root_id))
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _CURRENT.reset(token)
+            if trace.sampled:
+                self.exporter.submit(trace, {
+                    "name": f"{scope['method']} {_route_name(scope)}",
+                    "start_ns": start_ns,
+                    "end_ns": time.time_ns(),
+                    "attributes": {
+                        "http.request.method": scope["method"],
+                        "http.route": _route_name(scope),
+                        "http.response.status_code": status,
+                    },
+                    "error": status >= 500,
+                })
@@ -0,0 +1,286 @@
+"""
+Concurrency limiter for outbound Gemini calls.
+
+Every Gemini request holds a slot for the duration of the HTTP call. Callers
+that find no free slot wait in a priority queue (interactive asks before batch
+items) for at most UPSTREAM_QUEUE_TIMEOUT_SECONDS and are otherwise turned away
+with UpstreamBusyError, which the proxy maps to 503 + Retry-After.
+
+The number of slots adapts AIMD style: each success adds 1/limit (about +1 per
+round of calls), an upstream 429/503 or timeout halves it, at most once per
+cooldown so one burst of rejections counts as a single signal.
+
+With UPSTREAM_GLOBAL_CONCURRENCY and REDIS_URL set, each slot also holds a
+lease in a Redis sorted set so all workers together stay under the global cap.
+Leases expire on their own if a worker dies; Redis errors fail open.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from metrics import REGISTRY, Gauge
+from settings import get_settings
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 10
+
+
+class UpstreamBusyError(Exception):
+    """No upstream slot became free within the queue timeout (or the queue is full)."""
+
+    def __init__(self, retry_after: int):
+        super().__init__("Upstream AI capacity exhausted")
+        self.retry_after = retry_after
+
+
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[2]) then
+  redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+  redis.call('PEXPIRE', KEYS[1], ARGV[5])
+  return 1
+end
+return 0
+"""
+
+
+class _RedisSlots:
+    """Cluster-wide slot pool: a sorted set of lease ids scored by expiry (ms)."""
+
+    _ERROR_BACKOFF_SECONDS = 5.0
+
+    def __init__(self, redis_url: str, capacity: int, lease_seconds: float = 60.0, key: str = "upstream:gemini:slots"):
+        self.capacity = capacity
+        self._redis_url = redis_url
+        self._lease_ms = int(lease_seconds * 1000)
+        self._key = key
+        self._redis = None
+        self._script = None
+        self._unavailable_until = 0.0
+
+    def _get_redis(self):
+        if self._redis is not None:
+            return self._redis
+        try:
+            import redis.asyncio as redis  # type: ignore
+        except Exception:
+            return None
+        self._redis = redis.from_url(self._redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._script = self._redis.register_script(_ACQUIRE_SCRIPT)
+        return self._redis
+
+    def _mark_failure(self):
+        if time.monotonic() >= self._unavailable_until:
+            logger.warning("Redis upstream slot pool unavailable; using local concurrency limits only.")
+        self._unavailable_until = time.monotonic() + self._ERROR_BACKOFF_SECONDS
+
+    async def try_acquire(self, lease_id: str) -> Optional[bool]:
+        """True/False when Redis answered, None when it is unavailable (caller proceeds)."""
+        if time.monotonic() < self._unavailable_until:
+            return None
+        if self._get_redis() is None:
+            return None
+        now_ms = int(time.time() * 1000)
+        try:
+            granted = await self._script(
+                keys=[self._key],
+                args=[now_ms, self.capacity, now_ms + self._lease_ms, lease_id, self._lease_ms * 2],
+            )
+        except Exception:
+            self._mark_failure()
+            return None
+        return bool(int(granted))
+
+    async def release(self, lease_id: str):
+        r = self._get_redis()
+        if r is None:
+            return
+        try:
+            await r.zrem(self._key, lease_id)
+        except Exception:
+            # The lease expires on its own.
+            self._mark_failure()
+
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(
+        self,
+        max_limit: int = 16,
+        min_limit: int = 1,
+        initial_limit: Optional[int] = None,
+        queue_timeout: float = 10.0,
+        max_queue: int = 200,
+        decrease_cooldown: float = 1.0,
+        global_slots: Optional[_RedisSlots] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(min(self.max_limit, max(self.min_limit, initial_limit or self.max_limit)))
+        self.queue_timeout = queue_timeout
+        self.max_queue = max_queue
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self._global = global_slots
+        self._clock = clock
+        self._last_decrease = float("-inf")
+        # Heap of (priority, seq, future); lower priority values are served first.
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self.rejected = 0
+        self.overloads = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def _retry_after(self) -> int:
+        return max(1, int(self.queue_timeout))
+
+    def _wake(self):
+        while self._waiters and self.in_flight < int(self.limit):
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self.in_flight += 1
+            fut.set_result(None)
+
+    async def _acquire_local(self, priority: int, deadline: float):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamBusyError(self._retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), fut)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(fut, max(0.0, deadline - self._clock()))
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # Granted a slot just as we gave up: hand it back.
+                self._release_local()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected += 1
+                raise UpstreamBusyError(self._retry_after()) from None
+            raise
+
+    def _release_local(self):
+        self.in_flight -= 1
+        self._wake()
+
+    async def _acquire_global(self, deadline: float) -> Optional[str]:
+        lease_id = f"{os.getpid()}:{uuid.uuid4().hex}"
+        delay = 0.02
+        while True:
+            granted = await self._global.try_acquire(lease_id)
+            if granted is None:
+                return None
+            if granted:
+                return lease_id
+            if self._clock() + delay > deadline:
+                self.rejected += 1
+                raise UpstreamBusyError(self._retry_after())
+            await asyncio.sleep(delay)
+            delay = min(0.5, delay * 2)
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> Optional[str]:
+        """Waits for a slot; returns the global lease id (if any) to pass to release()."""
+        deadline = self._clock() + self.queue_timeout
+        await self._acquire_local(priority, deadline)
+        if self._global is None:
+            return None
+        try:
+            return await self._acquire_global(deadline)
+        except BaseException:
+            self._release_local()
+            raise
+
+    async def release(self, lease_id: Optional[str] = None):
+        self._release_local()
+        if lease_id is not None and self._global is not None:
+            await self._global.release(lease_id)
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE):
+        lease_id = await self.acquire(priority)
+        try:
+            yield
+        finally:
+            await self.release(lease_id)
+
+    def on_success(self):
+        """Additive increase: about +1 slot per `limit` successful calls."""
+        self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def on_overload(self):
+        """Multiplicative decrease on upstream 429/503/timeouts (once per cooldown)."""
+        self.overloads += 1
+        now = self._clock()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(float(self.min_limit), self.limit / 2.0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": int(self.limit),
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "overloads": self.overloads,
+            "global_limit": self._global.capacity if self._global is not None else None,
+        }
+
+
+def _build_limiter() -> AdaptiveConcurrencyLimiter:
+    settings = get_settings()
+    global_slots = None
+    if settings.upstream_global_concurrency and settings.redis_url:
+        global_slots = _RedisSlots(settings.redis_url, settings.upstream_global_concurrency)
+
+    return AdaptiveConcurrencyLimiter(
+        max_limit=settings.upstream_max_concurrency,
+        min_limit=settings.upstream_min_concurrency,
+        queue_timeout=settings.upstream_queue_timeout,
+        max_queue=settings.upstream_max_queue,
+        global_slots=global_slots,
+    )
+
+
+_UPSTREAM_LIMITER: Optional[AdaptiveConcurrencyLimiter] = None
+
+
+def get_upstream_limiter() -> AdaptiveConcurrencyLimiter:
+    global _UPSTREAM_LIMITER
+    if _UPSTREAM_LIMITER is None:
+        _UPSTREAM_LIMITER = _build_limiter()
+    return _UPSTREAM_LIMITER
+
+
+def _slot_gauge() -> Dict[Tuple[str, ...], float]:
+    stats = get_upstream_limiter().stats()
+    return {(state,): stats[state] for state in ("limit", "in_flight", "queued")}
+
+
+REGISTRY.register(Gauge(
+    "dailywave_upstream_slots",
+    "Upstream Gemini concurrency limiter: current limit, calls in flight, callers queued.",
+    _slot_gauge,
+    ("state",),
+))